@@ -1,11 +1,14 @@
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from fastapi import HTTPException
+from typing import Optional
+from fastapi import HTTPException, Request
 import os
 from dotenv import load_dotenv
 load_dotenv() 
 
 from app.models.models import User
+from app.auth import principal_cache
+from app.metrics import JWT
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
@@ -13,22 +16,39 @@ ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    print(ACCESS_TOKEN_EXPIRE_MINUTES)
     expire = datetime.now() + timedelta(minutes=int(ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
-    print(SECRET_KEY, "hyggh")
-    print(ALGORITHM)
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with JWT.labels("encode").time():
+        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def verify_access_token(token: str):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with JWT.labels("decode").time():
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         return payload
     except JWTError:
         return None
 
-async def get_current_user(token: str):
+def token_payload(token: Optional[str], request: Optional[Request] = None) -> Optional[dict]:
+    # Decoded once per request: the rate limiter and get_current_user share it.
+    if not token:
+        return None
+    if request is None:
+        return verify_access_token(token)
+    cached = getattr(request.state, "token_payload", None)
+    if cached is not None and cached[0] == token:
+        return cached[1]
     payload = verify_access_token(token)
+    request.state.token_payload = (token, payload)
+    return payload
+
+async def get_current_user(token: str, request: Request = None):
+    payload = token_payload(token, request)
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid token")
-    return await User.find_one({"email": payload["email"]})
\ No newline at end of file
+    user = await principal_cache.get(token, payload.get("exp"))
+    if user is None:
+        user = await User.find_one({"email": payload["email"]})
+        if user is not None:
+            await principal_cache.put(token, user, payload.get("exp"))
+    return user
@@ -1,8 +1,75 @@
+import asyncio, os, time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from app.metrics import PASSWORD_HASHING
+from dotenv import load_dotenv
+load_dotenv()
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt releases the GIL, so threads are enough; "process" is there for hosts
+# where hashing still competes with the event loop for the interpreter.
+HASHING_EXECUTOR = os.getenv("HASHING_EXECUTOR", "thread")
+HASHING_CONCURRENCY = int(os.getenv("HASHING_CONCURRENCY", str(os.cpu_count() or 1)))
+HASHING_MAX_QUEUE = int(os.getenv("HASHING_MAX_QUEUE", "64"))
+HASHING_RETRY_AFTER = os.getenv("HASHING_RETRY_AFTER", "1")
+
+_executor = None
+_pending = 0
+
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    with PASSWORD_HASHING.labels("hash").time():
+        return pwd_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    with PASSWORD_HASHING.labels("verify").time():
+        return pwd_context.verify(plain_password, hashed_password)
+
+def _timed(operation: str, *args):
+    # Runs in the pool, which may be another process: the time comes back with
+    # the result and is recorded by the caller, in the registry /metrics serves.
+    start = time.perf_counter()
+    result = pwd_context.hash(*args) if operation == "hash" else pwd_context.verify(*args)
+    return result, time.perf_counter() - start
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if HASHING_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=HASHING_CONCURRENCY)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=HASHING_CONCURRENCY, thread_name_prefix="hashing")
+    return _executor
+
+async def _run_in_pool(operation: str, *args):
+    global _pending
+    # At most HASHING_CONCURRENCY calls run; HASHING_MAX_QUEUE more may wait for a slot.
+    if _pending >= HASHING_CONCURRENCY + HASHING_MAX_QUEUE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password operations in progress, try again shortly.",
+            headers={"Retry-After": HASHING_RETRY_AFTER}
+        )
+    _pending += 1
+    try:
+        result, seconds = await asyncio.get_running_loop().run_in_executor(_get_executor(), _timed, operation, *args)
+        PASSWORD_HASHING.labels(operation).observe(seconds)
+        return result
+    finally:
+        _pending -= 1
+
+async def hash_password_async(password: str) -> str:
+    return await _run_in_pool("hash", password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_in_pool("verify", plain_password, hashed_password)
+
+def pending_operations() -> int:
+    return _pending
+
+def shutdown_hashing_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
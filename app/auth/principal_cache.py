@@ -0,0 +1,181 @@
+import asyncio, hashlib, json, os, time
+from collections import OrderedDict
+from typing import Optional
+
+from redis.exceptions import RedisError
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.models.models import User
+from app.redis_client import get_redis
+
+# Two tiers: an in-process LRU in front of an optional shared Redis tier, and no
+# entry outlives the token's own exp. invalidate() drops the user's Redis
+# entries and publishes the email on PRINCIPAL_INVALIDATE_CHANNEL, which every
+# worker listens to and drops from its own LRU. Pub/sub does not replay what a
+# worker missed while reconnecting, so local entries are also kept short
+# (PRINCIPAL_CACHE_LOCAL_TTL). Without REDIS_URL there is nothing to broadcast
+# on: an edited or deleted user can still authenticate on the other workers for
+# up to PRINCIPAL_CACHE_LOCAL_TTL seconds.
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_LOCAL_TTL = float(os.getenv("PRINCIPAL_CACHE_LOCAL_TTL", "5"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_INVALIDATE_CHANNEL = "principal:invalidate"
+
+_entries: "OrderedDict[str, tuple[float, str, User]]" = OrderedDict()
+_keys_by_email: dict = {}
+stats = {"hits": 0, "redis_hits": 0, "misses": 0, "invalidations": 0}
+# What a principal needs; the password hash never leaves the process.
+PRINCIPAL_FIELDS = {"id", "email", "name", "is_active", "created_at"}
+
+_listener: Optional[asyncio.Task] = None
+_listening: Optional[asyncio.Event] = None
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _ttl(exp: Optional[float], ttl: float = PRINCIPAL_CACHE_TTL) -> float:
+    if exp is None:
+        return ttl
+    return min(ttl, float(exp) - time.time())
+
+def _drop(key: str):
+    entry = _entries.pop(key, None)
+    if entry:
+        keys = _keys_by_email.get(entry[1])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del _keys_by_email[entry[1]]
+
+def _drop_email(email: str):
+    for key in list(_keys_by_email.get(email, ())):
+        _drop(key)
+
+def _store_local(key: str, user: User, exp: Optional[float]):
+    ttl = _ttl(exp, PRINCIPAL_CACHE_LOCAL_TTL)
+    if ttl <= 0:
+        return
+    _drop(key)
+    _entries[key] = (time.monotonic() + ttl, user.email, user)
+    _keys_by_email.setdefault(user.email, set()).add(key)
+    while len(_entries) > PRINCIPAL_CACHE_SIZE:
+        _drop(next(iter(_entries)))
+
+async def _listen(redis):
+    while True:
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(PRINCIPAL_INVALIDATE_CHANNEL)
+            # Whatever was published while (re)connecting is lost: start over.
+            clear_local()
+            _listening.set()
+            async for message in pubsub.listen():
+                _drop_email(message["data"].decode())
+        except asyncio.CancelledError:
+            raise
+        except (RedisError, OSError) as e:
+            _listening.set()
+            clear_local()
+            print(f"Principal invalidation listener failed: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+async def start(redis=None):
+    # Returns once this worker receives invalidations, so none published after it is missed.
+    global _listener, _listening
+    redis = redis or get_redis()
+    if redis is None:
+        return
+    if _listener is None:
+        _listening = asyncio.Event()
+        _listener = asyncio.create_task(_listen(redis))
+    await _listening.wait()
+
+async def stop():
+    global _listener, _listening
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener, _listening = None, None
+
+async def get(token: str, exp: Optional[float] = None) -> Optional[User]:
+    key = _token_key(token)
+    entry = _entries.get(key)
+    if entry:
+        if entry[0] > time.monotonic():
+            _entries.move_to_end(key)
+            stats["hits"] += 1
+            return entry[2]
+        _drop(key)
+
+    redis = get_redis()
+    if redis is not None:
+        await start(redis)
+        try:
+            raw = await redis.get(f"principal:{key}")
+        except RedisError:
+            raw = None
+        if raw:
+            stats["redis_hits"] += 1
+            # Identity only, with a blank hash: a cached principal is never to be saved.
+            user = User.model_validate({**json.loads(raw), "hashed_password": ""})
+            _store_local(key, user, exp)
+            return user
+
+    stats["misses"] += 1
+    return None
+
+async def put(token: str, user: User, exp: Optional[float] = None):
+    ttl = _ttl(exp)
+    if ttl <= 0:
+        return
+    key = _token_key(token)
+    _store_local(key, user, exp)
+
+    redis = get_redis()
+    if redis is not None:
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.set(f"principal:{key}", user.model_dump_json(include=PRINCIPAL_FIELDS), ex=max(1, int(ttl)))
+                pipe.sadd(f"principal:email:{user.email}", key)
+                pipe.expire(f"principal:email:{user.email}", PRINCIPAL_CACHE_TTL)
+                await pipe.execute()
+        except RedisError:
+            pass
+
+async def invalidate(email: str):
+    stats["invalidations"] += 1
+    _drop_email(email)
+
+    redis = get_redis()
+    if redis is not None:
+        try:
+            keys = await redis.smembers(f"principal:email:{email}")
+            names = [f"principal:{key.decode()}" for key in keys]
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.delete(f"principal:email:{email}", *names)
+                pipe.publish(PRINCIPAL_INVALIDATE_CHANNEL, email)
+                await pipe.execute()
+        except RedisError as e:
+            print(f"Principal invalidation failed for {email}: {e}")
+
+def clear_local():
+    _entries.clear()
+    _keys_by_email.clear()
+
+def clear():
+    global _listener, _listening
+    clear_local()
+    if _listener is not None:
+        _listener.cancel()
+        _listener, _listening = None, None
+
+def cache_stats() -> dict:
+    lookups = stats["hits"] + stats["redis_hits"] + stats["misses"]
+    hit_ratio = (stats["hits"] + stats["redis_hits"]) / lookups if lookups else 0.0
+    return {**stats, "size": len(_entries), "hit_ratio": hit_ratio}
@@ -1,54 +1,147 @@
 # celery_worker.py
 from celery import Celery
-from celery import Celery
-import requests, os
-from app.crud.joke_crud import create_joke
+from celery.signals import task_postrun, task_prerun, worker_init, worker_process_init, worker_process_shutdown
+import httpx, os, time
+from app.crud.joke_crud import create_jokes
 import asyncio
-from motor.motor_asyncio import AsyncIOMotorClient
-from beanie import init_beanie
-from app.models.models import User, Joke
-from fastapi import HTTPException, status
+from app import database as db, fetch_scheduler, joke_stats
+from app.joke_api import create_http_client, fetch_joke
+from app.metrics import CELERY_TASKS, CELERY_TASK_LATENCY, start_metrics_server
+from app.redis_client import close_redis
 from dotenv import load_dotenv
-load_dotenv() 
+load_dotenv()
+
+JOKE_BATCH_SIZE = int(os.getenv("JOKE_BATCH_SIZE", "10"))
+# Upstream requests a worker process has open at once.
+FETCH_MAX_IN_FLIGHT = int(os.getenv("FETCH_MAX_IN_FLIGHT", "5"))
+# Port for the worker's /metrics; 0 leaves it off. Prefork children only show up
+# there when PROMETHEUS_MULTIPROC_DIR is set.
+CELERY_METRICS_PORT = int(os.getenv("CELERY_METRICS_PORT", "0"))
 
 celery_app = Celery(
     "tasks",
-    broker="redis://localhost:6379/0", 
+    broker="redis://localhost:6379/0",
     backend="redis://localhost:6379/0"
 )
 
+# The tick only asks whether a fetch is due; fetch_scheduler decides. Ticks that
+# wait in the queue longer than one period are dropped instead of piling up.
 celery_app.conf.beat_schedule = {
     'fetch_random_joke_every_minute': {
         'task': 'tasks.fetch_random_joke',
-        'schedule': 60.0,
+        'schedule': fetch_scheduler.FETCH_TICK_SECONDS,
+        'options': {'expires': fetch_scheduler.FETCH_TICK_SECONDS},
+    },
+    'reconcile_joke_stats': {
+        'task': 'tasks.reconcile_joke_stats',
+        'schedule': joke_stats.STATS_RECONCILE_SECONDS,
+        'options': {'expires': joke_stats.STATS_RECONCILE_SECONDS},
     },
 }
 
 celery_app.conf.timezone = 'UTC'
+# Nothing reads task results; don't write them to the backend.
+celery_app.conf.task_ignore_result = True
+
+# One event loop, Mongo connection and HTTP client per worker process, created after fork.
+_loop = None
+_http_client = None
+
+async def init_db(database=None):
+    # Indexes are finished before the first task so the unique ones are in force.
+    await db.connect(database, indexes="wait")
+
+def start_runtime(database=None, http_client=None):
+    global _loop, _http_client
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    _loop.run_until_complete(init_db(database))
+    _http_client = http_client or create_http_client()
+
+def stop_runtime():
+    global _loop, _http_client
+    if _loop is None:
+        return
+    if _http_client is not None:
+        _loop.run_until_complete(_http_client.aclose())
+    _loop.run_until_complete(close_redis())
+    _loop.run_until_complete(db.disconnect())
+    _loop.close()
+    _loop = _http_client = None
+
+def run_async(coro):
+    # The solo and threads pools never send worker_process_init, so start lazily.
+    if _loop is None:
+        start_runtime()
+    return _loop.run_until_complete(coro)
+
+@worker_process_init.connect
+def init_worker_runtime(**kwargs):
+    start_runtime()
 
-async def init_db():
-    MONGO_URI = os.getenv("MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client['local']
-    await init_beanie(database = database, document_models=[User, Joke])
+@worker_process_shutdown.connect
+def shutdown_worker_runtime(**kwargs):
+    stop_runtime()
+
+@worker_init.connect
+def start_worker_metrics(**kwargs):
+    if CELERY_METRICS_PORT:
+        start_metrics_server(CELERY_METRICS_PORT)
+
+_task_started = {}
+
+@task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_LATENCY.labels(task.name).observe(time.perf_counter() - started)
+    CELERY_TASKS.labels(task.name, state or "UNKNOWN").inc()
+
+async def fetch_and_ingest(count: int, http_client: httpx.AsyncClient = None) -> dict:
+    http_client = http_client or _http_client
+    fetched, received, failed = {}, 0, 0
+    for start in range(0, count, FETCH_MAX_IN_FLIGHT):
+        results = await asyncio.gather(
+            *(fetch_joke(http_client) for _ in range(min(FETCH_MAX_IN_FLIGHT, count - start))), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Failed to fetch joke: {result!r}")
+                failed += 1
+                continue
+            received += 1
+            # The upstream repeats itself, so drop repeats within the batch before writing.
+            fetched.setdefault(result["id"], result["joke"])
+        if failed:
+            # The upstream is failing; don't keep hammering it in this run.
+            break
+
+    created = 0
+    if fetched:
+        results = await create_jokes([(joke_text, None) for joke_text in fetched.values()], author=None)
+        created = sum(1 for result in results if result["status"] == "created")
+    return {"fetched": received, "failed": failed, "created": created}
+
+async def ingest_jokes(count: int, http_client: httpx.AsyncClient = None) -> int:
+    return (await fetch_and_ingest(count, http_client))["created"]
 
 @celery_app.task(name='tasks.fetch_random_joke')
 def fetch_random_joke():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init_db())
-    response = requests.get("https://icanhazdadjoke.com/", headers={"Accept": "application/json"})
-    if response.status_code == 200:
-        joke_data = response.json()
-        print(f"Fetched Joke: {joke_data['joke']}")
-        try:
-            loop.run_until_complete(create_joke(str(joke_data["joke"]), author=None, joke_id=joke_data["id"]))
-        except Exception as e:
-            print(f"Failed to create joke: {str(e)}")
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to create joke in database")
-    elif response.status_code == 503:
-        print("Service unavailable from external API.")
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="External API service unavailable.")
-    else:
-        print(f"Failed to fetch joke from external API, Status Code: {response.status_code}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to fetch joke from external API.")
+    outcome = run_async(fetch_scheduler.run_if_due(fetch_and_ingest))
+    if outcome != "skipped":
+        print(f"Scheduled joke fetch: {outcome}")
+
+@celery_app.task(name='tasks.fetch_random_jokes_batch')
+def fetch_random_jokes_batch(count: int = JOKE_BATCH_SIZE):
+    inserted = run_async(ingest_jokes(count))
+    print(f"Ingested {inserted} of {count} fetched jokes")
+    return inserted
 
+@celery_app.task(name='tasks.reconcile_joke_stats')
+def reconcile_joke_stats():
+    # Rebuilds the /jokes/stats counters from the jokes, undoing any drift.
+    print(f"Reconciled joke stats: {run_async(joke_stats.reconcile())}")
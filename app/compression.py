@@ -0,0 +1,211 @@
+import asyncio, os, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Optional
+from starlette.datastructures import Headers, MutableHeaders
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.metrics import COMPRESSION_INPUT_BYTES, COMPRESSION_OUTPUT_BYTES, COMPRESSION_SECONDS, COMPRESSION_SKIPPED
+
+# Brotli and zstd are offered only when their packages are installed; gzip always is.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Responses are compressed with the best encoding the client accepts (zstd, br,
+# then gzip). Bodies under COMPRESSION_MIN_SIZE go out as they are: the framing
+# would outweigh the savings. Streaming responses (NDJSON lists) are compressed
+# chunk by chunk and flushed after each one, so clients still get every batch
+# as it is produced. Server-Sent Events are never compressed. Compressing
+# COMPRESSION_THREAD_MIN_SIZE bytes or more runs in a thread pool (the codecs
+# release the GIL) instead of on the event loop.
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+COMPRESSION_THREAD_MIN_SIZE = int(os.getenv("COMPRESSION_THREAD_MIN_SIZE", "65536"))
+COMPRESSION_THREADS = int(os.getenv("COMPRESSION_THREADS", str(os.cpu_count() or 1)))
+
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/x-ndjson", "application/javascript",
+    "text/plain", "text/html", "text/css", "text/csv",
+}
+
+class GzipStream:
+    def __init__(self):
+        self.compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes, last: bool = False) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class BrotliStream:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def chunk(self, data: bytes, last: bool = False) -> bytes:
+        return self.compressor.process(data) + (self.compressor.finish() if last else self.compressor.flush())
+
+class ZstdStream:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def chunk(self, data: bytes, last: bool = False) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_FINISH if last else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+def gzip_compress(body: bytes) -> bytes:
+    return zlib.compress(body, COMPRESSION_GZIP_LEVEL, wbits=31)
+
+def brotli_compress(body: bytes) -> bytes:
+    return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+
+def zstd_compress(body: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress(body)
+
+# Encoding: (whole-body compressor, streaming compressor), best first.
+ENCODINGS = {}
+if zstandard is not None:
+    ENCODINGS["zstd"] = (zstd_compress, ZstdStream)
+if brotli is not None:
+    ENCODINGS["br"] = (brotli_compress, BrotliStream)
+ENCODINGS["gzip"] = (gzip_compress, GzipStream)
+
+@lru_cache(maxsize=256)
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    # The highest q-value wins, ties go to the better codec; None means identity.
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    best, best_q = None, 0.0
+    for name in ENCODINGS:
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+def _compress(encoding: str, fn, data: bytes) -> bytes:
+    # Thread CPU time, so time spent waiting for the GIL or a pool slot is not billed.
+    start = time.thread_time()
+    compressed = fn(data)
+    COMPRESSION_SECONDS.labels(encoding).inc(time.thread_time() - start)
+    COMPRESSION_INPUT_BYTES.labels(encoding).inc(len(data))
+    COMPRESSION_OUTPUT_BYTES.labels(encoding).inc(len(compressed))
+    return compressed
+
+_executor = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=COMPRESSION_THREADS, thread_name_prefix="compression")
+    return _executor
+
+async def compress(encoding: str, fn, data: bytes) -> bytes:
+    if len(data) < COMPRESSION_THREAD_MIN_SIZE:
+        return _compress(encoding, fn, data)
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), _compress, encoding, fn, data)
+
+def skip_reason(start: dict) -> Optional[str]:
+    # Whatever can be decided before the body: the size check waits for its first chunk.
+    status = start["status"]
+    if status < 200 or status in (204, 304):
+        return "status"
+    headers = Headers(raw=start["headers"])
+    if "content-encoding" in headers:
+        return "encoded"
+    content_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+    if content_type not in COMPRESSIBLE_TYPES and not content_type.endswith("+json"):
+        return "content_type"
+    return None
+
+class CompressionMiddleware:
+    def __init__(self, app, min_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if not COMPRESSION_ENABLED or scope["type"] != "http" or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+        accept_encoding = next((value for name, value in scope["headers"] if name == b"accept-encoding"), None)
+        encoding = choose_encoding(accept_encoding.decode("latin-1")) if accept_encoding else None
+        if encoding is None:
+            COMPRESSION_SKIPPED.labels("not_accepted").inc()
+            return await self.app(scope, receive, send)
+
+        whole, stream_class = ENCODINGS[encoding]
+        start = None
+        stream = None
+        passthrough = False
+
+        def compressed_headers(message: dict) -> MutableHeaders:
+            headers = MutableHeaders(scope=message)
+            headers["Content-Encoding"] = encoding
+            headers.add_vary_header("Accept-Encoding")
+            # The compressed body is a different byte sequence from the one a strong tag names.
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"
+            return headers
+
+        async def send_compressed(message):
+            nonlocal start, stream, passthrough
+            if message["type"] == "http.response.start":
+                reason = skip_reason(message)
+                if reason is not None:
+                    COMPRESSION_SKIPPED.labels(reason).inc()
+                    passthrough = True
+                    await send(message)
+                    return
+                # Held until the first body chunk shows whether compressing is worth it.
+                start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                if start is not None:
+                    await send(start)
+                    start = None
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if stream is None:
+                if not more_body and len(body) < self.min_size:
+                    COMPRESSION_SKIPPED.labels("small").inc()
+                    passthrough = True
+                    await send(start)
+                    start = None
+                    await send(message)
+                    return
+                if not more_body:
+                    body = await compress(encoding, whole, body)
+                    compressed_headers(start)["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                headers = compressed_headers(start)
+                del headers["Content-Length"]
+                await send(start)
+                start = None
+                stream = stream_class()
+
+            data = await compress(encoding, partial(stream.chunk, last=not more_body), body)
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
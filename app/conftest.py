@@ -0,0 +1,116 @@
+import os, uuid, threading, hashlib, json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Settings the app reads at import time. Redis and the joke API are never the
+# ones a developer's .env points at: tests that need them bring fakeredis or
+# the joke_api_stub fixture below.
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ["REDIS_URL"] = ""
+# Nothing listens on the discard port, so an unstubbed upstream call fails at once.
+os.environ["JOKE_API_URL"] = "http://127.0.0.1:9/"
+
+import pytest
+import pytest_asyncio
+import httpx
+from pytest_asyncio import is_async_test
+from motor.motor_asyncio import AsyncIOMotorClient
+from mongomock_motor import AsyncMongoMockClient
+
+from app import database, fetch_scheduler, joke_api, joke_feed, joke_pool, rate_limit, search
+from app.auth import principal_cache
+from app.auth.auth_jwt import create_access_token
+from app.main import app
+from app.models.models import User
+from app.redis_client import set_redis
+
+# In-memory MongoDB stand-in unless this names a real server. Each test gets a
+# database of its own either way, so tests can run in any order and under
+# pytest-xdist (`pytest -n auto`), where every worker has its own client.
+TEST_MONGO_URI = os.getenv("TEST_MONGO_URI")
+
+def pytest_collection_modifyitems(items):
+    # One event loop for the session, which the session's Motor client is bound to.
+    session_loop = pytest.mark.asyncio(loop_scope="session")
+    needs_mongo = pytest.mark.skip(reason="needs a real MongoDB; set TEST_MONGO_URI")
+    for item in items:
+        if is_async_test(item):
+            item.add_marker(session_loop, append=False)
+        if not TEST_MONGO_URI and "real_mongo" in item.keywords:
+            item.add_marker(needs_mongo)
+
+@pytest.fixture(scope="session")
+def mongo_client():
+    if not TEST_MONGO_URI:
+        yield AsyncMongoMockClient()
+        return
+    client = AsyncIOMotorClient(TEST_MONGO_URI, **database.client_options())
+    yield client
+    client.close()
+
+@pytest_asyncio.fixture
+async def mock_db(mongo_client):
+    # A fresh database per test, through the same component the app uses.
+    name = f"test_{os.getenv('PYTEST_XDIST_WORKER', 'main')}_{uuid.uuid4().hex[:12]}"
+    db = await database.connect(mongo_client[name], indexes="wait", warm=False)
+    try:
+        yield db
+    finally:
+        await database.disconnect()
+        await mongo_client.drop_database(name)
+
+@pytest_asyncio.fixture
+async def api(mock_db):
+    # The whole app (routers, middleware), without its lifespan: mock_db is the connection.
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+@pytest_asyncio.fixture
+async def api_user(mock_db):
+    # A stored user and a token for it, for the routes that need one.
+    user = User(email=f"api-{uuid.uuid4().hex[:8]}@example.com", hashed_password="hashed", name="API User")
+    await user.insert()
+    return user, create_access_token({"email": user.email})
+
+@pytest.fixture(autouse=True)
+def isolated_state():
+    # Module-level singletons would otherwise carry one test's state into the next.
+    def reset():
+        set_redis(None)
+        joke_feed.close_subscriptions()
+        joke_feed.set_log(None)
+        joke_pool.set_pool(None)
+        fetch_scheduler.set_store(None)
+        search.set_search_backend(None)
+        rate_limit.reset()
+        principal_cache.clear()
+    reset()
+    yield
+    reset()
+
+@pytest.fixture
+def joke_api_stub(monkeypatch):
+    served = iter(range(1000))
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Every third response repeats an earlier joke, like the real upstream.
+            n = next(served)
+            n = n - 1 if n % 3 == 2 else n
+            text = f"Stub joke {hashlib.sha1(f'stub-{n}'.encode()).hexdigest()}"
+            body = json.dumps({"id": f"test-stub-joke-{n}", "joke": text, "status": 200}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(joke_api, "JOKE_API_URL", f"http://127.0.0.1:{server.server_port}/")
+    yield server
+    server.shutdown()
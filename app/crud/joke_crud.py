@@ -1,33 +1,260 @@
 from app.models.models import User, Joke
-from app.utils import create_verify_joke_id
+from app.models.schemas import JokeOut
+from app.search import index_joke, unindex_jokes
+from app.insert_batcher import insert_joke
+from app.joke_feed import publish_jokes
+from app import joke_stats
+from app.dedup import DEDUP_ENABLED, DuplicateJokeError, Fingerprint, find_duplicate, find_duplicates, fingerprint_fields, register
+from app.utils import new_joke_id, new_joke_ids, encode_cursor, decode_cursor
 
+import asyncio, uuid
 from bson import ObjectId
-from typing import Optional
+from enum import Enum
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import List, Optional, Tuple
+
+# Newest first; _id breaks ties between jokes sharing a created_at.
+JOKE_PAGE_SORT = [("created_at", DESCENDING), ("_id", DESCENDING)]
+
+JOKE_ID_MAX_ATTEMPTS = 3
+
+# One document per collection whose version every list ETag includes. The epoch
+# is new whenever the document is (re)created, so a reset counter cannot bring
+# back a version a client already holds.
+VERSIONS_COLLECTION = "collection_versions"
+
+def _versions():
+    return Joke.get_motor_collection().database[VERSIONS_COLLECTION]
+
+async def get_jokes_version() -> str:
+    row = await _versions().find_one({"_id": "jokes"})
+    return f"{row['epoch']}.{row['version']}" if row else "0"
+
+async def bump_jokes_version():
+    # Called after every write that can change a list page. Readers take the
+    # version before the page, so a racing write costs them a refetch, never a stale 304.
+    await _versions().update_one(
+        {"_id": "jokes"}, {"$inc": {"version": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex}}, upsert=True
+    )
+
+# After a write, its side effects (dedup registry, search index, stats counters,
+# list version) run concurrently; none depends on another. The feed event goes
+# out last, so a client refetching on it never gets the old list version.
+async def announce_created(jokes: List[Joke], fingerprints: list):
+    # fingerprints: (joke_id, Fingerprint) pairs for the dedup registry.
+    await asyncio.gather(
+        register(fingerprints),
+        *(index_joke(joke.id, joke.joke) for joke in jokes),
+        joke_stats.record_created(jokes),
+        bump_jokes_version(),
+    )
+    await publish_jokes("created", [(joke.id, joke.joke) for joke in jokes])
+
+async def announce_updated(joke_id: str, text: str, fingerprint: Optional[Fingerprint]):
+    await asyncio.gather(
+        register([(joke_id, fingerprint)] if fingerprint else []),
+        index_joke(joke_id, text),
+        bump_jokes_version(),
+    )
+    await publish_jokes("updated", [(joke_id, text)])
+
+async def announce_deleted(rows: List[dict]):
+    # rows: the deleted documents, at least joke_stats.STATS_PROJECTION.
+    joke_ids = [row["_id"] for row in rows]
+    await asyncio.gather(
+        unindex_jokes(joke_ids),
+        joke_stats.record_deleted(rows),
+        bump_jokes_version(),
+    )
+    await publish_jokes("deleted", [(joke_id, None) for joke_id in joke_ids])
+
+def _is_text_conflict(details: Optional[dict]) -> bool:
+    return "text_hash" in (details or {}).get("keyPattern", {})
+
+def _fingerprint_text(joke_text: str):
+    if not DEDUP_ENABLED:
+        return None, {}
+    fingerprint = Fingerprint(joke_text)
+    return fingerprint, fingerprint_fields(fingerprint)
 
 async def create_joke(joke_text: str, author: Optional[User] = None, joke_id: str = None) -> Joke:
-    joke_id = await create_verify_joke_id(joke_id)
-    joke = Joke(joke=joke_text, author=author, id=joke_id)
-    await joke.insert() 
-    return joke
+    fingerprint, fields = _fingerprint_text(joke_text)
+    if fingerprint:
+        duplicate = await find_duplicate(fingerprint)
+        if duplicate:
+            raise DuplicateJokeError(*duplicate)
+    # The unique _id index is the only collision check: a taken id is retried
+    # with a freshly generated one instead of being looked up beforehand.
+    for attempt in range(JOKE_ID_MAX_ATTEMPTS):
+        joke = Joke(joke=joke_text, author=author, author_id=author.id if author else None, id=joke_id or new_joke_id(), **fields)
+        try:
+            await insert_joke(joke)
+        except DuplicateKeyError as e:
+            if _is_text_conflict(e.details):
+                raise DuplicateJokeError("exact")
+            if attempt == JOKE_ID_MAX_ATTEMPTS - 1:
+                raise
+            joke_id = None
+            continue
+        await announce_created([joke], [(joke.id, fingerprint)] if fingerprint else [])
+        return joke
+
+async def create_jokes(items: List[Tuple[str, Optional[str]]], author: Optional[User] = None) -> list:
+    # items are (joke_text, joke_id) pairs; every item gets its own entry in the
+    # returned list, in order. Unlike create_joke, a taken id is reported, not replaced.
+    results = [None] * len(items)
+    candidates = []
+    for index, ((joke_text, joke_id), generated_id) in enumerate(zip(items, new_joke_ids(len(items)))):
+        if not joke_text or not joke_text.strip():
+            results[index] = {"index": index, "status": "error", "detail": "Joke text cannot be empty."}
+            continue
+        candidates.append((index, joke_text, joke_id or generated_id, Fingerprint(joke_text) if DEDUP_ENABLED else None))
+
+    if DEDUP_ENABLED and candidates:
+        duplicates = await find_duplicates([fingerprint for _, _, _, fingerprint in candidates])
+        for (index, _, _, _), duplicate in zip(candidates, duplicates):
+            if duplicate:
+                results[index] = {"index": index, "status": "duplicate", "kind": duplicate[0], "duplicate_of": duplicate[1]}
+        candidates = [candidate for candidate, duplicate in zip(candidates, duplicates) if not duplicate]
+
+    jokes, positions, fingerprints = [], [], []
+    for index, joke_text, joke_id, fingerprint in candidates:
+        fields = fingerprint_fields(fingerprint) if fingerprint else {}
+        jokes.append(Joke(joke=joke_text, author=author, author_id=author.id if author else None, id=joke_id, **fields))
+        positions.append(index)
+        fingerprints.append(fingerprint)
+
+    write_errors = {}
+    if jokes:
+        try:
+            await Joke.insert_many(jokes, ordered=False)
+        except BulkWriteError as e:
+            write_errors = {error["index"]: error for error in e.details["writeErrors"]}
+
+    registered, inserted = [], []
+    for position, (index, joke) in enumerate(zip(positions, jokes)):
+        error = write_errors.get(position)
+        if error is None:
+            results[index] = {"index": index, "status": "created", "joke_id": joke.id}
+            if fingerprints[position]:
+                registered.append((joke.id, fingerprints[position]))
+            inserted.append(joke)
+        elif error["code"] == 11000 and _is_text_conflict(error):
+            results[index] = {"index": index, "status": "duplicate", "kind": "exact", "duplicate_of": None}
+        elif error["code"] == 11000:
+            results[index] = {"index": index, "status": "error", "detail": f"Joke id {joke.id} already exists."}
+        else:
+            results[index] = {"index": index, "status": "error", "detail": error["errmsg"]}
+    if inserted:
+        await announce_created(inserted, registered)
+    return results
 
 async def get_all_jokes():
     return await Joke.find_all().to_list() 
 
-async def get_joke_by_id(joke_id: str):
-    return await Joke.find_one({"_id": joke_id})
+def _after_cursor_query(after: Optional[str]) -> dict:
+    if not after:
+        return {}
+    created_at, joke_id = decode_cursor(after)
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": joke_id}},
+    ]}
+
+async def get_jokes_page(after: Optional[str] = None, limit: int = 50):
+    # Fetch one extra document to know whether another page exists.
+    jokes = await Joke.find(_after_cursor_query(after), sort=JOKE_PAGE_SORT, limit=limit + 1).project(JokeOut).to_list()
+    next_cursor = None
+    if len(jokes) > limit:
+        jokes = jokes[:limit]
+        next_cursor = encode_cursor(jokes[-1].created_at, jokes[-1].id)
+    return jokes, next_cursor
+
+def stream_jokes(after: Optional[str] = None, limit: Optional[int] = None, batch_size: int = 500):
+    # Returns the lazy Beanie query; iterating it pulls from the Motor cursor batch by batch.
+    return Joke.find(_after_cursor_query(after), sort=JOKE_PAGE_SORT, limit=limit or 0, batch_size=batch_size).project(JokeOut)
+
+async def get_joke_by_id(joke_id: str) -> Optional[JokeOut]:
+    return await Joke.find_one({"_id": joke_id}).project(JokeOut)
+
+async def get_jokes_by_ids(joke_ids: List[str]) -> List[JokeOut]:
+    return await Joke.find({"_id": {"$in": joke_ids}}).project(JokeOut).to_list()
 
 async def update_joke(joke_id: str, new_joke_text: str):
-    joke = await Joke.find_one({"_id": joke_id})
-    if joke:
-        joke.joke = new_joke_text
-        await joke.save()
-        return True
-    return False
+    # Edits are held to exact-duplicate checks only (the text_hash index): a
+    # near-duplicate check would keep matching the joke's own previous text.
+    fingerprint, fields = _fingerprint_text(new_joke_text)
+    try:
+        result = await Joke.get_motor_collection().update_one(
+            {"_id": joke_id}, {"$set": {"joke": new_joke_text, **fields}, "$inc": {"revision": 1}}
+        )
+    except DuplicateKeyError as e:
+        if _is_text_conflict(e.details):
+            raise DuplicateJokeError("exact")
+        raise
+    if result.matched_count:
+        await announce_updated(joke_id, new_joke_text, fingerprint)
+    return result.matched_count > 0
 
 async def delete_joke(joke_id: str) -> bool:
-    joke = await Joke.find_one({"_id": joke_id})
-    if joke:
-        await joke.delete()  
-        return True
-    return False
+    joke = await Joke.get_motor_collection().find_one_and_delete({"_id": joke_id}, projection=joke_stats.STATS_PROJECTION)
+    if joke is not None:
+        await announce_deleted([joke])
+    return joke is not None
+
+class JokeMutation(Enum):
+    DONE = "done"
+    NOT_FOUND = "not_found"
+    FORBIDDEN = "forbidden"
+
+def _owner_filter(user: User) -> dict:
+    # Jokes written before author_id existed only carry the DBRef.
+    return {"$or": [{"author_id": user.id}, {"author.$id": user.id}]}
+
+def _owned_by(joke_id: str, user: User) -> dict:
+    return {"_id": joke_id, **_owner_filter(user)}
+
+async def _classify_miss(joke_id: str) -> JokeMutation:
+    # Only reached when the conditional write matched nothing.
+    exists = await Joke.get_motor_collection().find_one({"_id": joke_id}, projection={"_id": 1})
+    return JokeMutation.FORBIDDEN if exists else JokeMutation.NOT_FOUND
+
+async def update_owned_joke(joke_id: str, user: User, new_joke_text: str) -> JokeMutation:
+    fingerprint, fields = _fingerprint_text(new_joke_text)
+    try:
+        joke = await Joke.get_motor_collection().find_one_and_update(
+            _owned_by(joke_id, user), {"$set": {"joke": new_joke_text, **fields}, "$inc": {"revision": 1}}, projection={"_id": 1}
+        )
+    except DuplicateKeyError as e:
+        if _is_text_conflict(e.details):
+            raise DuplicateJokeError("exact")
+        raise
+    if joke is not None:
+        await announce_updated(joke_id, new_joke_text, fingerprint)
+        return JokeMutation.DONE
+    return await _classify_miss(joke_id)
+
+async def delete_owned_joke(joke_id: str, user: User) -> JokeMutation:
+    joke = await Joke.get_motor_collection().find_one_and_delete(_owned_by(joke_id, user), projection=joke_stats.STATS_PROJECTION)
+    if joke is not None:
+        await announce_deleted([joke])
+        return JokeMutation.DONE
+    return await _classify_miss(joke_id)
 
+async def delete_owned_jokes(joke_ids: List[str], user: User) -> int:
+    # The owned jokes are read first: the counters need their day and author,
+    # and only ids that were really deleted are announced.
+    collection = Joke.get_motor_collection()
+    owned = await collection.find({"_id": {"$in": joke_ids}, **_owner_filter(user)}, projection=joke_stats.STATS_PROJECTION).to_list(length=len(joke_ids))
+    if not owned:
+        return 0
+    result = await collection.delete_many({"_id": {"$in": [joke["_id"] for joke in owned]}, **_owner_filter(user)})
+    if result.deleted_count < len(owned):
+        # Some went to a concurrent delete, which accounts for them itself.
+        remaining = await collection.find({"_id": {"$in": [joke["_id"] for joke in owned]}}, projection={"_id": 1}).to_list(length=len(owned))
+        kept = {row["_id"] for row in remaining}
+        owned = [joke for joke in owned if joke["_id"] not in kept]
+    if result.deleted_count:
+        await announce_deleted(owned)
+    return result.deleted_count
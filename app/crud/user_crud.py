@@ -1,8 +1,10 @@
-from app.models.models import User, Joke
-from app.auth.hashing import hash_password
+from app.models.models import User
+from pymongo.errors import DuplicateKeyError
+from app.auth.hashing import hash_password_async
+from app.auth import principal_cache
 
 async def create_user(email: str, password: str, name: str) -> User:
-    hashed_password = hash_password(password)
+    hashed_password = await hash_password_async(password)
     user = User(email=email, hashed_password=hashed_password, name=name)
     await user.insert()
     return user
@@ -11,11 +13,16 @@ async def edit_user(name: str, email: str, old_email: str) -> User:
     try:
         user = await User.find_one({"email": old_email}) 
         if user:
+            # Straight to the collection: Beanie reports a taken email as a revision conflict.
+            await User.get_motor_collection().update_one({"_id": user.id}, {"$set": {"name": name, "email": email}})
             user.name = name
             user.email = email
-            await user.save()
+            await principal_cache.invalidate(old_email)
             return user
         return None
+    except DuplicateKeyError:
+        # The new email is taken; callers answer 409.
+        raise
     except Exception as e:
         raise Exception("Failed to update user: " + str(e))
 
@@ -23,6 +30,7 @@ async def delete_user(email: str) -> bool:
     user = await User.find_one({"email": email})
     if user:
             await user.delete()  
+            await principal_cache.invalidate(email)
             return True
     else:
         return False
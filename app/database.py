@@ -0,0 +1,148 @@
+import asyncio, os
+from contextlib import asynccontextmanager
+from typing import Optional
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from beanie import init_beanie
+from pymongo import DESCENDING, ReadPreference
+from pymongo.errors import PyMongoError
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.models.models import Joke
+from app import joke_stats
+from app.indexes import DOCUMENT_MODELS, sync_indexes, format_report
+
+# The one Motor client of a process: the API, the Celery worker, manage.py and the
+# tests all connect through here. Motor resolves the event loop per operation, so
+# the client can outlive the loop it was created on (Celery tasks, pytest).
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "local")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0"))
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+# Connections opened before traffic is accepted; defaults to the pool's minimum.
+MONGO_WARMUP_CONNECTIONS = int(os.getenv("MONGO_WARMUP_CONNECTIONS", str(MONGO_MIN_POOL_SIZE)))
+MONGO_CONNECT_ATTEMPTS = int(os.getenv("MONGO_CONNECT_ATTEMPTS", "5"))
+READY_PING_TIMEOUT = float(os.getenv("READY_PING_TIMEOUT", "1"))
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+_client: Optional[AsyncIOMotorClient] = None
+_database: Optional[AsyncIOMotorDatabase] = None
+_ready = False
+_index_task: Optional[asyncio.Task] = None
+
+def client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "readPreference": READ_PREFERENCES[MONGO_READ_PREFERENCE].mongos_mode,
+    }
+    if MONGO_SOCKET_TIMEOUT_MS:
+        options["socketTimeoutMS"] = MONGO_SOCKET_TIMEOUT_MS
+    return options
+
+async def _wait_for_server(database: AsyncIOMotorDatabase):
+    # Each attempt already waits up to serverSelectionTimeoutMS for a server.
+    for attempt in range(MONGO_CONNECT_ATTEMPTS):
+        try:
+            await database.command("ping")
+            return
+        except PyMongoError as e:
+            if attempt == MONGO_CONNECT_ATTEMPTS - 1:
+                raise
+            print(f"MongoDB not reachable yet ({e}), retrying")
+            await asyncio.sleep(min(2 ** attempt, 10))
+
+async def _warm_up(database: AsyncIOMotorDatabase, connections: int):
+    # Concurrent pings each check out their own connection, so the pool is filled
+    # now rather than by the first requests. The hot query then pulls the newest
+    # jokes and the created_at index into the server's cache.
+    if connections > 0:
+        await asyncio.gather(*(database.command("ping") for _ in range(connections)))
+    await Joke.get_motor_collection().find({}, projection={"_id": 1}, sort=[("created_at", DESCENDING), ("_id", DESCENDING)], limit=50).to_list(length=50)
+
+async def _sync_indexes():
+    try:
+        for report in await sync_indexes():
+            print(format_report(report))
+        await joke_stats.ensure_indexes()
+    except Exception as e:
+        print(f"Index sync failed: {e}")
+
+async def connect(database: Optional[AsyncIOMotorDatabase] = None, uri: Optional[str] = None, name: Optional[str] = None,
+                  indexes: str = "background", warm: bool = True) -> AsyncIOMotorDatabase:
+    # indexes: "background" syncs them without holding up startup (a build can take
+    # a while on a large collection), "wait" finishes first, "skip" leaves them alone.
+    # Pass database to use one that is already built (e.g. mongomock); it is not closed.
+    global _client, _database, _ready, _index_task
+    if _database is not None:
+        return _database
+    if database is None:
+        _client = AsyncIOMotorClient(uri or MONGO_URI, **client_options())
+        database = _client[name or MONGO_DB_NAME]
+    await _wait_for_server(database)
+    await init_beanie(database=database, document_models=DOCUMENT_MODELS, skip_indexes=True)
+    _database = database
+
+    if indexes == "wait":
+        await _sync_indexes()
+    elif indexes == "background":
+        _index_task = asyncio.create_task(_sync_indexes())
+    if warm:
+        await _warm_up(database, MONGO_WARMUP_CONNECTIONS)
+    _ready = True
+    return database
+
+async def disconnect():
+    global _client, _database, _ready, _index_task
+    _ready = False
+    if _index_task is not None:
+        _index_task.cancel()
+        try:
+            await _index_task
+        except asyncio.CancelledError:
+            pass
+        _index_task = None
+    if _client is not None:
+        _client.close()
+    _client = _database = None
+
+def get_database() -> Optional[AsyncIOMotorDatabase]:
+    return _database
+
+def get_client() -> Optional[AsyncIOMotorClient]:
+    return _client
+
+def is_ready() -> bool:
+    return _ready
+
+async def ping() -> bool:
+    if _database is None:
+        return False
+    try:
+        await asyncio.wait_for(_database.command("ping"), timeout=READY_PING_TIMEOUT)
+        return True
+    except (PyMongoError, asyncio.TimeoutError):
+        return False
+
+@asynccontextmanager
+async def lifespan(**options):
+    await connect(**options)
+    try:
+        yield _database
+    finally:
+        await disconnect()
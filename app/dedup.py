@@ -0,0 +1,142 @@
+import hashlib, os, random, re, struct
+from typing import List, Optional
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.models.models import Joke
+
+# Exact duplicates: a unique index on the hash of the normalized text.
+# Near duplicates: MinHash signatures over character shingles, bucketed with LSH
+# into the joke_lsh collection, so a check reads a handful of buckets instead of
+# scanning. Signatures are stored on the joke to confirm candidates.
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_NEAR_THRESHOLD = float(os.getenv("DEDUP_NEAR_THRESHOLD", "0.7"))
+LSH_COLLECTION = "joke_lsh"
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+_PRIME = (1 << 61) - 1
+# Fixed seed: signatures written by one process must match those of every other.
+_rng = random.Random(0x6A6F6B65)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+stats = {"checked": 0, "unique": 0, "exact": 0, "near": 0}
+
+class DuplicateJokeError(Exception):
+    def __init__(self, kind: str, duplicate_of: Optional[str] = None):
+        self.kind = kind
+        self.duplicate_of = duplicate_of
+        message = f"Joke is an {kind} duplicate" if kind == "exact" else f"Joke is a {kind} duplicate"
+        super().__init__(f"{message} of {duplicate_of}." if duplicate_of else f"{message}.")
+
+class Fingerprint:
+    __slots__ = ("text_hash", "signature", "band_keys")
+
+    def __init__(self, text: str):
+        normalized = normalize(text)
+        self.text_hash = hashlib.sha1(normalized.encode()).hexdigest()
+        self.signature = minhash(normalized)
+        self.band_keys = band_keys(self.signature)
+
+def normalize(text: str) -> str:
+    return " ".join(_NON_WORD.sub(" ", text.lower()).split())
+
+def minhash(normalized: str) -> List[int]:
+    if len(normalized) <= SHINGLE_SIZE:
+        shingles = {normalized}
+    else:
+        shingles = {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+    hashed = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big") for shingle in shingles]
+    return [min((a * value + b) % _PRIME for value in hashed) & 0xFFFFFFFF for a, b in _PERMUTATIONS]
+
+def band_keys(signature: List[int]) -> List[str]:
+    keys = []
+    for band in range(BANDS):
+        rows = struct.pack(f">{ROWS}I", *signature[band * ROWS:(band + 1) * ROWS])
+        keys.append(f"{band}:{hashlib.blake2b(rows, digest_size=8).hexdigest()}")
+    return keys
+
+def similarity(first: List[int], second: List[int]) -> float:
+    return sum(1 for a, b in zip(first, second) if a == b) / NUM_PERMUTATIONS
+
+def _lsh_collection():
+    return Joke.get_motor_collection().database[LSH_COLLECTION]
+
+async def find_duplicates(fingerprints: List[Fingerprint], lsh=None) -> list:
+    # Returns (kind, joke_id) or None per fingerprint. Later entries are also
+    # checked against earlier ones in the same list, which get joke_id None.
+    # lsh: the bucket collection to look in, joke_lsh unless given.
+    results = [None] * len(fingerprints)
+    if not DEDUP_ENABLED or not fingerprints:
+        return results
+
+    all_keys = list({key for fingerprint in fingerprints for key in fingerprint.band_keys})
+    buckets = await (lsh if lsh is not None else _lsh_collection()).find({"_id": {"$in": all_keys}}).to_list(length=None)
+    members = {bucket["_id"]: bucket.get("joke_ids", []) for bucket in buckets}
+    candidate_ids = list({joke_id for ids in members.values() for joke_id in ids})
+    stored = {}
+    if candidate_ids:
+        rows = await Joke.get_motor_collection().find(
+            {"_id": {"$in": candidate_ids}}, projection={"text_hash": 1, "minhash": 1}
+        ).to_list(length=None)
+        stored = {row["_id"]: row for row in rows if row.get("minhash")}
+
+    batch_hashes, batch_buckets = {}, {}
+    for index, fingerprint in enumerate(fingerprints):
+        stats["checked"] += 1
+        match = None
+        if fingerprint.text_hash in batch_hashes:
+            match = ("exact", None)
+        for key in fingerprint.band_keys:
+            if match:
+                break
+            for joke_id in members.get(key, ()):
+                row = stored.get(joke_id)
+                if row is None:
+                    continue
+                if row.get("text_hash") == fingerprint.text_hash:
+                    match = ("exact", joke_id)
+                elif similarity(row["minhash"], fingerprint.signature) >= DEDUP_NEAR_THRESHOLD:
+                    match = ("near", joke_id)
+                if match:
+                    break
+            for other in batch_buckets.get(key, ()):
+                if match:
+                    break
+                if similarity(fingerprints[other].signature, fingerprint.signature) >= DEDUP_NEAR_THRESHOLD:
+                    match = ("near", None)
+        if match:
+            stats[match[0]] += 1
+            results[index] = match
+            continue
+        stats["unique"] += 1
+        batch_hashes[fingerprint.text_hash] = index
+        for key in fingerprint.band_keys:
+            batch_buckets.setdefault(key, []).append(index)
+    return results
+
+async def find_duplicate(fingerprint: Fingerprint):
+    return (await find_duplicates([fingerprint]))[0]
+
+async def register(entries: list, lsh=None):
+    # entries are (joke_id, fingerprint) pairs for jokes that are now stored.
+    # Buckets are not pruned on delete; stale ids simply fail the signature lookup.
+    if not DEDUP_ENABLED or not entries:
+        return
+    operations = [
+        UpdateOne({"_id": key}, {"$addToSet": {"joke_ids": joke_id}}, upsert=True)
+        for joke_id, fingerprint in entries for key in fingerprint.band_keys
+    ]
+    await (lsh if lsh is not None else _lsh_collection()).bulk_write(operations, ordered=False)
+
+def fingerprint_fields(fingerprint: Fingerprint) -> dict:
+    return {"text_hash": fingerprint.text_hash, "minhash": fingerprint.signature}
+
+def dedup_stats() -> dict:
+    duplicates = stats["exact"] + stats["near"]
+    return {**stats, "duplicate_rate": duplicates / stats["checked"] if stats["checked"] else 0.0}
@@ -0,0 +1,151 @@
+import os, random, time, uuid
+from typing import Awaitable, Callable, Optional
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.metrics import JOKE_FETCH_INTERVAL, JOKE_FETCH_RUNS
+from app.redis_client import get_redis
+
+# Beat ticks every FETCH_TICK_SECONDS, but a tick only fetches once the schedule
+# says it is due. After a run the next one is planned from what it saw:
+#  - mostly repeats (FETCH_SLOWDOWN_DUPLICATE_RATE): the interval doubles, up to
+#    FETCH_MAX_INTERVAL; useful runs halve it back towards FETCH_INTERVAL.
+#  - nothing fetched: exponential backoff with jitter, and after
+#    FETCH_BREAKER_THRESHOLD failures in a row the breaker opens for
+#    FETCH_BREAKER_COOLDOWN. The first run after that is a single-joke probe.
+# With Redis the schedule and a run lock are shared by every worker and beat
+# replica, so at most one run is in flight at a time.
+FETCH_INTERVAL = float(os.getenv("FETCH_INTERVAL", "60"))
+FETCH_MAX_INTERVAL = float(os.getenv("FETCH_MAX_INTERVAL", "3600"))
+FETCH_TICK_SECONDS = float(os.getenv("FETCH_TICK_SECONDS", str(FETCH_INTERVAL)))
+FETCH_BATCH_SIZE = int(os.getenv("FETCH_BATCH_SIZE", "1"))
+FETCH_SLOWDOWN_DUPLICATE_RATE = float(os.getenv("FETCH_SLOWDOWN_DUPLICATE_RATE", "0.5"))
+FETCH_BREAKER_THRESHOLD = int(os.getenv("FETCH_BREAKER_THRESHOLD", "5"))
+FETCH_BREAKER_COOLDOWN = float(os.getenv("FETCH_BREAKER_COOLDOWN", "900"))
+# Longer than any run; a worker that dies holding the lock only blocks this long.
+FETCH_LOCK_SECONDS = int(os.getenv("FETCH_LOCK_SECONDS", "300"))
+FETCH_STATE_KEY = "joke_fetch:state"
+FETCH_LOCK_KEY = "joke_fetch:lock"
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def initial_state() -> dict:
+    return {"next_run": 0.0, "interval": FETCH_INTERVAL, "failures": 0}
+
+def breaker_open(state: dict) -> bool:
+    return state["failures"] >= FETCH_BREAKER_THRESHOLD
+
+def next_state(state: dict, stats: dict, now: float) -> dict:
+    # stats: fetched, failed and created counts of the run that just finished.
+    if not stats["fetched"]:
+        failures = state["failures"] + 1
+        if failures >= FETCH_BREAKER_THRESHOLD:
+            delay = FETCH_BREAKER_COOLDOWN
+        else:
+            delay = min(FETCH_MAX_INTERVAL, FETCH_INTERVAL * 2 ** failures) * random.uniform(0.8, 1.2)
+        return {"next_run": now + delay, "interval": state["interval"], "failures": failures}
+
+    repeated = (stats["fetched"] - stats["created"]) / stats["fetched"]
+    if repeated >= FETCH_SLOWDOWN_DUPLICATE_RATE:
+        interval = min(FETCH_MAX_INTERVAL, state["interval"] * 2)
+    else:
+        interval = max(FETCH_INTERVAL, state["interval"] / 2)
+    return {"next_run": now + interval, "interval": interval, "failures": 0}
+
+class MemoryFetchState:
+    # Per process: each prefork child keeps its own schedule.
+    def __init__(self):
+        self.state = initial_state()
+        self.locked = False
+
+    async def load(self) -> dict:
+        return dict(self.state)
+
+    async def save(self, state: dict):
+        self.state = dict(state)
+
+    async def acquire(self) -> Optional[str]:
+        if self.locked:
+            return None
+        self.locked = True
+        return "local"
+
+    async def release(self, token: str):
+        self.locked = False
+
+class RedisFetchState:
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def load(self) -> dict:
+        raw = await self.redis.hgetall(FETCH_STATE_KEY)
+        if not raw:
+            return initial_state()
+        raw = {key.decode(): value.decode() for key, value in raw.items()}
+        return {"next_run": float(raw["next_run"]), "interval": float(raw["interval"]), "failures": int(raw["failures"])}
+
+    async def save(self, state: dict):
+        await self.redis.hset(FETCH_STATE_KEY, mapping={key: str(value) for key, value in state.items()})
+
+    async def acquire(self) -> Optional[str]:
+        token = uuid.uuid4().hex
+        return token if await self.redis.set(FETCH_LOCK_KEY, token, nx=True, ex=FETCH_LOCK_SECONDS) else None
+
+    async def release(self, token: str):
+        await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, FETCH_LOCK_KEY, token)
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        redis = get_redis()
+        _store = RedisFetchState(redis) if redis is not None else MemoryFetchState()
+    return _store
+
+def set_store(store):
+    global _store
+    _store = store
+
+async def run_if_due(ingest: Callable[[int], Awaitable[dict]], batch_size: int = FETCH_BATCH_SIZE, now: Optional[float] = None) -> str:
+    # ingest(count) fetches and stores up to count jokes and returns its stats.
+    # Returns the outcome: "skipped" (not due), "busy" (another run holds the lock), "success" or "failure".
+    store = get_store()
+    now = now if now is not None else time.time()
+    state = await store.load()
+    if now < state["next_run"]:
+        JOKE_FETCH_RUNS.labels("skipped").inc()
+        return "skipped"
+    token = await store.acquire()
+    if token is None:
+        JOKE_FETCH_RUNS.labels("busy").inc()
+        return "busy"
+    try:
+        # Another tick may have run and released the lock since the load above.
+        state = await store.load()
+        if now < state["next_run"]:
+            JOKE_FETCH_RUNS.labels("skipped").inc()
+            return "skipped"
+        probing = breaker_open(state)
+        try:
+            stats = await ingest(1 if probing else batch_size)
+        except Exception as e:
+            print(f"Joke fetch failed: {e!r}")
+            stats = {"fetched": 0, "failed": 1, "created": 0}
+        updated = next_state(state, stats, now)
+        if breaker_open(updated) and not probing:
+            print(f"Joke API failing, pausing fetches for {FETCH_BREAKER_COOLDOWN:.0f}s")
+        elif probing and not breaker_open(updated):
+            print("Joke API recovered, resuming fetches")
+        await store.save(updated)
+    finally:
+        await store.release(token)
+    JOKE_FETCH_INTERVAL.set(updated["interval"])
+    outcome = "success" if stats["fetched"] else "failure"
+    JOKE_FETCH_RUNS.labels(outcome).inc()
+    return outcome
@@ -0,0 +1,81 @@
+from pymongo.errors import OperationFailure
+
+from app.models.models import User, Joke
+
+DOCUMENT_MODELS = [User, Joke]
+
+# Options that change what an index holds or rejects; an index that differs in
+# any of them from its declaration is reported as changed.
+INDEX_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+def _key(spec) -> tuple:
+    return tuple((field, direction) for field, direction in spec)
+
+def _options(spec: dict) -> dict:
+    # Unset and false are the same thing to the server.
+    return {option: spec[option] for option in INDEX_OPTIONS if spec.get(option) not in (None, False)}
+
+def declared_indexes(model) -> dict:
+    indexes = {}
+    for index in getattr(model.Settings, "indexes", []):
+        document = index.document
+        indexes[document["name"]] = {"key": _key(document["key"].items()), **_options(document)}
+    return indexes
+
+def _existing_key(spec: dict) -> tuple:
+    # The server reports text indexes as _fts/_ftsx; map them back to the declared fields.
+    key = []
+    for field, direction in spec["key"]:
+        if field == "_fts":
+            key.extend((text_field, "text") for text_field in sorted(spec.get("weights", {})))
+        elif field != "_ftsx":
+            key.append((field, direction))
+    return tuple(key)
+
+async def existing_indexes(model) -> dict:
+    info = await model.get_motor_collection().index_information()
+    info.pop("_id_", None)
+    return {name: {"key": _existing_key(spec), **_options(spec)} for name, spec in info.items()}
+
+async def diff_indexes(model) -> dict:
+    declared = declared_indexes(model)
+    existing = await existing_indexes(model)
+    return {
+        "collection": model.get_collection_name(),
+        "missing": sorted(name for name in declared if name not in existing),
+        "changed": sorted(name for name in declared if name in existing and existing[name] != declared[name]),
+        "extra": sorted(name for name in existing if name not in declared),
+    }
+
+async def sync_indexes(models=None, drop_extra: bool = False, dry_run: bool = False) -> list:
+    # Changed indexes are only reported: rebuilding one in place is a manual decision.
+    reports = []
+    for model in models or DOCUMENT_MODELS:
+        report = await diff_indexes(model)
+        report["created"], report["dropped"], report["errors"] = [], [], {}
+        collection = model.get_motor_collection()
+        if not dry_run:
+            by_name = {index.document["name"]: index for index in model.Settings.indexes}
+            for name in report["missing"]:
+                try:
+                    await collection.create_indexes([by_name[name]])
+                    report["created"].append(name)
+                except OperationFailure as e:
+                    report["errors"][name] = str(e)
+            if drop_extra:
+                for name in report["extra"]:
+                    await collection.drop_index(name)
+                    report["dropped"].append(name)
+        reports.append(report)
+    return reports
+
+def format_report(report: dict) -> str:
+    lines = [f"{report['collection']}:"]
+    for label in ("missing", "changed", "extra", "created", "dropped"):
+        if report.get(label):
+            lines.append(f"  {label}: {', '.join(report[label])}")
+    for name, error in report.get("errors", {}).items():
+        lines.append(f"  failed {name}: {error}")
+    if len(lines) == 1:
+        lines.append("  up to date")
+    return "\n".join(lines)
@@ -0,0 +1,111 @@
+import asyncio, os
+from typing import List, Optional, Tuple
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.models.models import Joke
+from app.metrics import INSERT_BATCH_SIZE
+
+# Concurrent single-joke inserts are gathered for up to INSERT_BATCH_DELAY_MS or
+# INSERT_BATCH_MAX_SIZE documents and written with one unordered insert_many.
+# Each caller still gets its own outcome: None, or the DuplicateKeyError /
+# WriteError a lone insert would have raised. Callers beyond
+# INSERT_BATCH_MAX_PENDING wait for a slot instead of growing the queue.
+INSERT_BATCH_ENABLED = os.getenv("INSERT_BATCH_ENABLED", "true").lower() == "true"
+INSERT_BATCH_DELAY_MS = float(os.getenv("INSERT_BATCH_DELAY_MS", "2"))
+INSERT_BATCH_MAX_SIZE = int(os.getenv("INSERT_BATCH_MAX_SIZE", "100"))
+INSERT_BATCH_MAX_PENDING = int(os.getenv("INSERT_BATCH_MAX_PENDING", "1000"))
+
+def _write_error(error: dict) -> WriteError:
+    # The same exception, with the same details, that Joke.insert() raises.
+    if error["code"] == 11000:
+        return DuplicateKeyError(error["errmsg"], error["code"], error)
+    return WriteError(error["errmsg"], error["code"], error)
+
+def _discard_outcome(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+class InsertBatcher:
+    def __init__(self, delay: float = INSERT_BATCH_DELAY_MS / 1000, max_size: int = INSERT_BATCH_MAX_SIZE,
+                 max_pending: int = INSERT_BATCH_MAX_PENDING):
+        self.delay = delay
+        self.max_size = max_size
+        self.slots = asyncio.Semaphore(max_pending)
+        self.batch: List[Tuple[Joke, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.flushes = set()
+        self.closed = False
+
+    async def insert(self, joke: Joke):
+        async with self.slots:
+            future = asyncio.get_running_loop().create_future()
+            self.batch.append((joke, future))
+            if len(self.batch) >= self.max_size:
+                self.flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+            # A cancelled caller does not pull its joke out of a batch already being written.
+            try:
+                await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Nobody awaits the outcome now; retrieve it so a failed write is not reported as unretrieved.
+                future.add_done_callback(_discard_outcome)
+                raise
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        task = asyncio.create_task(self._write(batch))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def _write(self, batch: List[Tuple[Joke, asyncio.Future]]):
+        INSERT_BATCH_SIZE.observe(len(batch))
+        errors = {}
+        try:
+            await Joke.insert_many([joke for joke, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            errors = {error["index"]: _write_error(error) for error in e.details["writeErrors"]}
+        except Exception as e:
+            errors = {index: e for index in range(len(batch))}
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in errors:
+                future.set_exception(errors[index])
+            else:
+                future.set_result(None)
+
+    async def close(self):
+        # Writes whatever is queued and waits for every batch still in flight.
+        self.closed = True
+        self.flush()
+        if self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
+
+_batcher: Optional[InsertBatcher] = None
+
+def start_batching():
+    global _batcher
+    if _batcher is None and INSERT_BATCH_ENABLED:
+        _batcher = InsertBatcher()
+
+async def stop_batching():
+    global _batcher
+    if _batcher is not None:
+        batcher, _batcher = _batcher, None
+        await batcher.close()
+
+async def insert_joke(joke: Joke):
+    # Batched only between start_batching and stop_batching (the API's lifespan);
+    # the worker, manage.py and the tests insert directly.
+    if _batcher is None or _batcher.closed:
+        await joke.insert()
+        return
+    await _batcher.insert(joke)
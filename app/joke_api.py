@@ -0,0 +1,39 @@
+import os
+from typing import Optional
+import httpx
+from dotenv import load_dotenv
+load_dotenv()
+
+JOKE_API_URL = os.getenv("JOKE_API_URL", "https://icanhazdadjoke.com/")
+JOKE_API_TIMEOUT = float(os.getenv("JOKE_API_TIMEOUT", "5"))
+JOKE_API_MAX_CONNECTIONS = int(os.getenv("JOKE_API_MAX_CONNECTIONS", "20"))
+
+class JokeAPIError(Exception):
+    # status_code is None when no usable response came back (connection, timeout, bad body).
+    def __init__(self, status_code: Optional[int], message: str = None):
+        self.status_code = status_code
+        super().__init__(message or f"Joke API responded with status {status_code}")
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        headers={"Accept": "application/json"},
+        timeout=JOKE_API_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=JOKE_API_MAX_CONNECTIONS,
+            max_keepalive_connections=JOKE_API_MAX_CONNECTIONS
+        ),
+    )
+
+async def fetch_joke(client: httpx.AsyncClient) -> dict:
+    # Every upstream failure surfaces as JokeAPIError.
+    try:
+        response = await client.get(JOKE_API_URL)
+    except httpx.HTTPError as e:
+        raise JokeAPIError(None, f"Joke API request failed: {e!r}") from e
+    if response.status_code != 200:
+        raise JokeAPIError(response.status_code)
+    try:
+        joke_data = response.json()
+        return {"id": str(joke_data["id"]), "joke": str(joke_data["joke"])}
+    except (ValueError, KeyError, TypeError) as e:
+        raise JokeAPIError(response.status_code, f"Joke API sent an unusable body: {e!r}") from e
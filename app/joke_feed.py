@@ -0,0 +1,288 @@
+import asyncio, json, os, time
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
+from redis.exceptions import RedisError
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.redis_client import get_redis
+
+# Live feed of joke writes for GET /jokes/stream and the /jokes/ws socket.
+# Writers append events to a log: a capped Redis stream shared by the API and
+# the Celery worker, or an in-process deque without Redis. Each API process
+# reads the log once and fans events out to its subscribers, each of which is a
+# bounded queue, so an idle connection costs a queue and a parked coroutine.
+# Event ids ("<ms>-<seq>", the Redis stream id format) let a reconnecting client
+# resume where it stopped for as long as the event is still in the log.
+FEED_ENABLED = os.getenv("FEED_ENABLED", "true").lower() == "true"
+# "crud": joke_crud publishes its own writes. "change_stream": `python -m app.manage
+# feed-relay` publishes from a MongoDB change stream and catches writes made
+# outside the app too (needs a replica set).
+FEED_SOURCE = os.getenv("FEED_SOURCE", "crud")
+FEED_HISTORY = int(os.getenv("FEED_HISTORY", "10000"))
+FEED_BUFFER = int(os.getenv("FEED_BUFFER", "256"))
+FEED_HEARTBEAT = float(os.getenv("FEED_HEARTBEAT", "15"))
+FEED_READ_BLOCK_MS = int(os.getenv("FEED_READ_BLOCK_MS", "5000"))
+FEED_STREAM_KEY = "joke_feed"
+FEED_RESUME_KEY = "joke_feed:resume_token"
+
+CHANGE_TYPES = {"insert": "created", "update": "updated", "replace": "updated", "delete": "deleted"}
+
+def parse_event_id(event_id: str) -> Tuple[int, int]:
+    # Raises ValueError for anything that is not "<ms>-<seq>".
+    ms, _, seq = event_id.partition("-")
+    return int(ms), int(seq or 0)
+
+class FeedEvent:
+    __slots__ = ("id", "key", "type", "data", "_sse")
+
+    def __init__(self, event_id: Optional[str], type: str, data: str):
+        self.id = event_id
+        self.key = parse_event_id(event_id) if event_id else (0, 0)
+        self.type = type
+        self.data = data
+        self._sse = None
+
+    def sse(self) -> str:
+        # Rendered once per event, not once per subscriber.
+        if self._sse is None:
+            event_id = f"id: {self.id}\n" if self.id else ""
+            self._sse = f"{event_id}event: {self.type}\ndata: {self.data}\n\n"
+        return self._sse
+
+    def message(self) -> str:
+        return json.dumps({"id": self.id, "type": self.type, "data": json.loads(self.data)})
+
+def control_event(type: str) -> FeedEvent:
+    # "resync": events were missed (the cursor is older than the log, or the
+    # client fell behind); refetch the list, then follow the feed again.
+    # Control events carry no id, so they never move a client's cursor.
+    return FeedEvent(None, type, "{}")
+
+class Subscription:
+    def __init__(self, buffer: int = FEED_BUFFER):
+        self.queue: asyncio.Queue = asyncio.Queue(buffer)
+        self.last = (0, 0)
+        # Live events that arrive while history is replayed wait here.
+        self.held: Optional[list] = []
+        self.closed = False
+        self.overflowed = False
+
+    def offer(self, event: FeedEvent):
+        if self.closed:
+            return
+        if self.held is not None:
+            self.held.append(event)
+            return
+        if event.key <= self.last:
+            return
+        try:
+            self.queue.put_nowait(event)
+            self.last = event.key
+        except asyncio.QueueFull:
+            # Too slow to keep up: it gets what is queued, then a resync, then the end.
+            self.overflowed = True
+            self.closed = True
+
+    def replay(self, events: Optional[List[FeedEvent]]):
+        held, self.held = self.held, None
+        if events is None:
+            self.queue.put_nowait(control_event("resync"))
+            events = []
+        for event in events + held:
+            self.offer(event)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout: float = FEED_HEARTBEAT) -> Optional[FeedEvent]:
+        # None after timeout with nothing to send (time for a heartbeat). Raises
+        # StopAsyncIteration once the subscription is over.
+        if self.closed and self.queue.empty():
+            if self.overflowed:
+                self.overflowed = False
+                return control_event("resync")
+            raise StopAsyncIteration
+        try:
+            event = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+class MemoryFeedLog:
+    def __init__(self, history: int = FEED_HISTORY):
+        self.events = deque(maxlen=history)
+        self.last = (0, 0)
+
+    def _next_id(self) -> str:
+        ms, seq = int(time.time() * 1000), 0
+        if ms <= self.last[0]:
+            ms, seq = self.last[0], self.last[1] + 1
+        self.last = (ms, seq)
+        return f"{ms}-{seq}"
+
+    async def append(self, entries: List[Tuple[str, str]]):
+        for type, data in entries:
+            event = FeedEvent(self._next_id(), type, data)
+            self.events.append(event)
+            dispatch(event)
+
+    async def history(self, after: Tuple[int, int]) -> Optional[List[FeedEvent]]:
+        # None unless the cursor is still in the log: older events were evicted,
+        # or were published by an earlier process.
+        if after != self.last and not (self.events and after >= self.events[0].key):
+            return None
+        return [event for event in self.events if event.key > after]
+
+class RedisFeedLog:
+    def __init__(self, redis):
+        self.redis = redis
+        self.reader: Optional[asyncio.Task] = None
+        self.reading = asyncio.Event()
+
+    async def append(self, entries: List[Tuple[str, str]]):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for type, data in entries:
+                pipe.xadd(FEED_STREAM_KEY, {"type": type, "data": data}, maxlen=FEED_HISTORY, approximate=True)
+            await pipe.execute()
+
+    async def history(self, after: Tuple[int, int]) -> Optional[List[FeedEvent]]:
+        # The stream outlives API processes; only trimming loses events.
+        oldest = await self.redis.xrange(FEED_STREAM_KEY, count=1)
+        if oldest and after < parse_event_id(oldest[0][0].decode()) and await self.redis.xlen(FEED_STREAM_KEY) >= FEED_HISTORY:
+            return None
+        rows = await self.redis.xrange(FEED_STREAM_KEY, min=f"({after[0]}-{after[1]}")
+        return [self._event(event_id, fields) for event_id, fields in rows]
+
+    def _event(self, event_id: bytes, fields: dict) -> FeedEvent:
+        return FeedEvent(event_id.decode(), fields[b"type"].decode(), fields[b"data"].decode())
+
+    async def start(self):
+        # Returns once the reader knows where the stream ends, so nothing a
+        # subscriber could miss is published in between.
+        if self.reader is None:
+            self.reader = asyncio.create_task(self._read_loop())
+        await self.reading.wait()
+
+    async def _read_loop(self):
+        # One blocking read per process, however many subscribers it has.
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    newest = await self.redis.xrevrange(FEED_STREAM_KEY, count=1)
+                    last_id = newest[0][0].decode() if newest else "0-0"
+                    self.reading.set()
+                response = await self.redis.xread({FEED_STREAM_KEY: last_id}, block=FEED_READ_BLOCK_MS, count=500)
+                for _, rows in response or []:
+                    for event_id, fields in rows:
+                        event = self._event(event_id, fields)
+                        last_id = event.id
+                        dispatch(event)
+            except asyncio.CancelledError:
+                raise
+            except (RedisError, OSError) as e:
+                self.reading.set()
+                print(f"Joke feed read failed: {e}")
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+            self.reader = None
+            self.reading.clear()
+
+_log = None
+_subscribers = set()
+
+def get_log():
+    global _log
+    if _log is None:
+        redis = get_redis()
+        _log = RedisFeedLog(redis) if redis is not None else MemoryFeedLog()
+    return _log
+
+def set_log(log):
+    global _log
+    _log = log
+
+def dispatch(event: FeedEvent):
+    for subscription in list(_subscribers):
+        subscription.offer(event)
+        if subscription.closed:
+            _subscribers.discard(subscription)
+
+def subscriber_count() -> int:
+    return len(_subscribers)
+
+def joke_event(type: str, joke_id: str, text: Optional[str] = None) -> Tuple[str, str]:
+    return type, json.dumps({"joke_id": joke_id, "joke": text})
+
+def change_entry(change: dict) -> Optional[Tuple[str, str]]:
+    # A change stream event as a feed entry; None for changes clients don't see
+    # (e.g. fingerprint backfills, which update a joke but not its text).
+    type = CHANGE_TYPES.get(change["operationType"])
+    if type is None:
+        return None
+    if type == "updated" and "updateDescription" in change and "joke" not in change["updateDescription"]["updatedFields"]:
+        return None
+    document = change.get("fullDocument") or {}
+    return joke_event(type, str(change["documentKey"]["_id"]), document.get("joke") if type != "deleted" else None)
+
+async def publish(entries: List[Tuple[str, str]]):
+    # Never fails the write that triggered it: a lost event costs clients a resync.
+    if not entries:
+        return
+    try:
+        await get_log().append(entries)
+    except (RedisError, OSError) as e:
+        print(f"Joke feed publish failed: {e}")
+
+async def publish_jokes(type: str, jokes: Iterable[Tuple[str, Optional[str]]]):
+    # Called by joke_crud after each write: type is created, updated or deleted,
+    # jokes are (joke_id, text) pairs.
+    if FEED_ENABLED and FEED_SOURCE == "crud":
+        await publish([joke_event(type, joke_id, text) for joke_id, text in jokes])
+
+async def subscribe(after: Optional[str] = None) -> Subscription:
+    # after: the id of the last event the client saw. Raises ValueError if malformed.
+    log = get_log()
+    cursor = parse_event_id(after) if after else None
+    if isinstance(log, RedisFeedLog):
+        await log.start()
+    subscription = Subscription()
+    _subscribers.add(subscription)
+    if cursor is None:
+        subscription.replay([])
+        return subscription
+    try:
+        subscription.replay(await log.history(cursor))
+    except (RedisError, OSError) as e:
+        print(f"Joke feed history failed: {e}")
+        subscription.replay(None)
+    return subscription
+
+def unsubscribe(subscription: Subscription):
+    _subscribers.discard(subscription)
+    subscription.closed = True
+
+def close_subscriptions():
+    # Ends every open stream; clients reconnect and resume from their last event.
+    for subscription in list(_subscribers):
+        subscription.close()
+    _subscribers.clear()
+
+async def stop():
+    close_subscriptions()
+    if isinstance(_log, RedisFeedLog):
+        await _log.stop()
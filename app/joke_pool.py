@@ -0,0 +1,168 @@
+import asyncio, json, os, uuid
+from collections import deque
+from typing import Optional
+from redis.exceptions import RedisError
+from dotenv import load_dotenv
+load_dotenv()
+
+from app import joke_api
+from app.fetch_scheduler import RELEASE_LOCK_SCRIPT
+from app.redis_client import get_redis
+
+# Prefetched upstream jokes, so request handlers never wait on icanhazdadjoke.
+# The refill task tops the pool back up to HIGH whenever it drops below LOW.
+# Every worker runs one, but with Redis the pool and a refill lock are shared:
+# only the worker holding the lock fetches, so upstream traffic does not grow
+# with the number of workers.
+JOKE_POOL_LOW = int(os.getenv("JOKE_POOL_LOW", "10"))
+JOKE_POOL_HIGH = int(os.getenv("JOKE_POOL_HIGH", "50"))
+JOKE_POOL_REFILL_INTERVAL = float(os.getenv("JOKE_POOL_REFILL_INTERVAL", "5"))
+JOKE_POOL_FETCH_CONCURRENCY = int(os.getenv("JOKE_POOL_FETCH_CONCURRENCY", "5"))
+JOKE_POOL_FALLBACK_TIMEOUT = float(os.getenv("JOKE_POOL_FALLBACK_TIMEOUT", "2"))
+# Longer than any refill; a worker that dies holding the lock only blocks this long.
+JOKE_POOL_LOCK_SECONDS = int(os.getenv("JOKE_POOL_LOCK_SECONDS", "60"))
+JOKE_POOL_REDIS_KEY = "joke_pool"
+JOKE_POOL_LOCK_KEY = "joke_pool:lock"
+
+class MemoryJokePool:
+    def __init__(self):
+        self.jokes = deque()
+        self.locked = False
+
+    async def take(self) -> Optional[dict]:
+        return self.jokes.popleft() if self.jokes else None
+
+    async def put_many(self, jokes: list):
+        self.jokes.extend(jokes)
+
+    async def size(self) -> int:
+        return len(self.jokes)
+
+    async def acquire(self) -> Optional[str]:
+        if self.locked:
+            return None
+        self.locked = True
+        return "local"
+
+    async def release(self, token: str):
+        self.locked = False
+
+class RedisJokePool:
+    # Shared by every worker; LPOP/RPUSH keep it a FIFO.
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def take(self) -> Optional[dict]:
+        try:
+            raw = await self.redis.lpop(JOKE_POOL_REDIS_KEY)
+        except RedisError:
+            return None
+        return json.loads(raw) if raw else None
+
+    async def put_many(self, jokes: list):
+        if jokes:
+            await self.redis.rpush(JOKE_POOL_REDIS_KEY, *(json.dumps(joke) for joke in jokes))
+
+    async def size(self) -> int:
+        return await self.redis.llen(JOKE_POOL_REDIS_KEY)
+
+    async def acquire(self) -> Optional[str]:
+        token = uuid.uuid4().hex
+        return token if await self.redis.set(JOKE_POOL_LOCK_KEY, token, nx=True, ex=JOKE_POOL_LOCK_SECONDS) else None
+
+    async def release(self, token: str):
+        await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, JOKE_POOL_LOCK_KEY, token)
+
+_pool = None
+_http_client = None
+_refill_task = None
+_refill_wanted = None
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        redis = get_redis()
+        _pool = RedisJokePool(redis) if redis is not None else MemoryJokePool()
+    return _pool
+
+def set_pool(pool):
+    global _pool
+    _pool = pool
+
+def _get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = joke_api.create_http_client()
+    return _http_client
+
+async def refill_once() -> int:
+    pool = get_pool()
+    if await pool.size() >= JOKE_POOL_LOW:
+        return 0
+    token = await pool.acquire()
+    if token is None:
+        # Another worker is refilling the shared pool.
+        return 0
+    try:
+        # It may also have finished since the size check above.
+        size = await pool.size()
+        if size >= JOKE_POOL_LOW:
+            return 0
+        return await _refill(pool, JOKE_POOL_HIGH - size)
+    finally:
+        await pool.release(token)
+
+async def _refill(pool, missing: int) -> int:
+    client = _get_http_client()
+    fetched = []
+    for start in range(0, missing, JOKE_POOL_FETCH_CONCURRENCY):
+        count = min(JOKE_POOL_FETCH_CONCURRENCY, missing - start)
+        results = await asyncio.gather(*(joke_api.fetch_joke(client) for _ in range(count)), return_exceptions=True)
+        fetched.extend(result for result in results if not isinstance(result, Exception))
+        if len(fetched) < start + count:
+            # The upstream is failing; keep what we have and try again next round.
+            break
+    await pool.put_many(fetched)
+    return len(fetched)
+
+async def _refill_loop():
+    while True:
+        try:
+            await refill_once()
+        except Exception as e:
+            print(f"Joke pool refill failed: {e}")
+        _refill_wanted.clear()
+        try:
+            await asyncio.wait_for(_refill_wanted.wait(), timeout=JOKE_POOL_REFILL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def start_refill():
+    global _refill_task, _refill_wanted
+    if _refill_task is None:
+        _refill_wanted = asyncio.Event()
+        _refill_task = asyncio.create_task(_refill_loop())
+
+async def stop_refill():
+    global _refill_task, _http_client
+    if _refill_task is not None:
+        _refill_task.cancel()
+        try:
+            await _refill_task
+        except asyncio.CancelledError:
+            pass
+        _refill_task = None
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def get_random_joke() -> dict:
+    # Served from the pool; only an empty pool costs an upstream round trip,
+    # bounded by JOKE_POOL_FALLBACK_TIMEOUT. Raises JokeAPIError or TimeoutError.
+    pool = get_pool()
+    joke = await pool.take()
+    if _refill_wanted is not None:
+        _refill_wanted.set()
+    if joke is not None:
+        return joke
+    return await asyncio.wait_for(joke_api.fetch_joke(_get_http_client()), timeout=JOKE_POOL_FALLBACK_TIMEOUT)
@@ -0,0 +1,146 @@
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Tuple
+from bson import ObjectId
+from pymongo import DESCENDING, DeleteMany, IndexModel, ReplaceOne, UpdateOne
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.models.models import Joke
+
+# Counters behind GET /jokes/stats, kept up to date with $inc by every write in
+# joke_crud (the Celery ingester included) instead of aggregating the jokes
+# collection per request. One document per counter:
+#   total             jokes, ingested
+#   day:<YYYY-MM-DD>  jokes, ingested  (by created_at, in the server's local time)
+#   author:<id>       jokes
+# "ingested" counts jokes without an author; user-submitted is the rest.
+# Writes that bypass joke_crud (manage.py, shell sessions) and crashes between a
+# write and its $inc make them drift; reconcile() rebuilds them from the jokes.
+STATS_COLLECTION = "joke_stats"
+STATS_RECONCILE_SECONDS = float(os.getenv("STATS_RECONCILE_SECONDS", "3600"))
+STATS_MAX_DAYS = 366
+STATS_MAX_AUTHORS = 100
+
+# Fields of a deleted joke that record_deleted needs.
+STATS_PROJECTION = {"created_at": 1, "author_id": 1, "author": 1}
+
+STATS_INDEXES = [IndexModel([("kind", DESCENDING), ("jokes", DESCENDING)], name="kind_jokes")]
+
+def _stats():
+    return Joke.get_motor_collection().database[STATS_COLLECTION]
+
+def day_key(created_at: datetime) -> str:
+    return created_at.strftime("%Y-%m-%d")
+
+def joke_author(row: dict) -> Optional[ObjectId]:
+    # Jokes written before author_id existed only carry the DBRef.
+    if row.get("author_id") is not None:
+        return row["author_id"]
+    author = row.get("author")
+    return getattr(author, "id", None) if author is not None else None
+
+def _counter_updates(rows: Iterable[Tuple[datetime, Optional[ObjectId]]], sign: int) -> list:
+    totals = {"jokes": 0, "ingested": 0}
+    days = defaultdict(lambda: {"jokes": 0, "ingested": 0})
+    authors = defaultdict(int)
+    for created_at, author_id in rows:
+        ingested = sign if author_id is None else 0
+        totals["jokes"] += sign
+        totals["ingested"] += ingested
+        day = days[day_key(created_at)]
+        day["jokes"] += sign
+        day["ingested"] += ingested
+        if author_id is not None:
+            authors[author_id] += sign
+
+    # One write per counter touched, however many jokes moved it.
+    updates = [UpdateOne({"_id": "total"}, {"$inc": totals, "$set": {"kind": "total"}}, upsert=True)]
+    updates += [
+        UpdateOne({"_id": f"day:{day}"}, {"$inc": counts, "$set": {"kind": "day", "day": day}}, upsert=True)
+        for day, counts in days.items()
+    ]
+    updates += [
+        UpdateOne({"_id": f"author:{author_id}"}, {"$inc": {"jokes": count}, "$set": {"kind": "author", "author_id": author_id}}, upsert=True)
+        for author_id, count in authors.items()
+    ]
+    return updates
+
+async def record(rows: Iterable[Tuple[datetime, Optional[ObjectId]]], sign: int = 1):
+    # rows: (created_at, author_id) of jokes just created (sign 1) or deleted (-1).
+    rows = list(rows)
+    if rows:
+        await _stats().bulk_write(_counter_updates(rows, sign), ordered=False)
+
+async def record_created(jokes: Iterable[Joke]):
+    await record([(joke.created_at, joke.author_id) for joke in jokes], 1)
+
+async def record_deleted(rows: Iterable[dict]):
+    # rows: deleted joke documents with at least created_at, author_id and author.
+    await record([(row["created_at"], joke_author(row)) for row in rows], -1)
+
+async def get_stats(days: int = 30, authors: int = 10) -> dict:
+    # A fixed number of indexed reads, whatever the size of the jokes collection.
+    collection = _stats()
+    totals = await collection.find_one({"_id": "total"}) or {}
+    first_day = datetime.now().date() - timedelta(days=days - 1)
+    day_ids = [f"day:{first_day + timedelta(days=offset)}" for offset in range(days)]
+    day_rows = {row["_id"]: row for row in await collection.find({"_id": {"$in": day_ids}}).to_list(length=days)}
+    top = await collection.find({"kind": "author", "jokes": {"$gt": 0}}, sort=[("kind", DESCENDING), ("jokes", DESCENDING)], limit=authors).to_list(length=authors)
+
+    def split(row: dict) -> dict:
+        jokes, ingested = row.get("jokes", 0), row.get("ingested", 0)
+        return {"jokes": jokes, "user_submitted": jokes - ingested, "ingested": ingested}
+
+    return {
+        **split(totals),
+        "per_day": [{"day": day_id[4:], **split(day_rows.get(day_id, {}))} for day_id in day_ids],
+        "top_authors": [{"author_id": str(row["author_id"]), "jokes": row["jokes"]} for row in top],
+    }
+
+async def reconcile() -> dict:
+    # One pass over the jokes, grouped by day and author, then every counter is
+    # replaced and counters nothing backs any more are removed. Increments that
+    # land while it runs can be lost; the next run puts them back.
+    totals = {"jokes": 0, "ingested": 0}
+    days = defaultdict(lambda: {"jokes": 0, "ingested": 0})
+    authors = defaultdict(int)
+
+    def count(day: str, author_id: Optional[ObjectId], jokes: int):
+        ingested = jokes if author_id is None else 0
+        totals["jokes"] += jokes
+        totals["ingested"] += ingested
+        days[day]["jokes"] += jokes
+        days[day]["ingested"] += ingested
+        if author_id is not None:
+            authors[author_id] += jokes
+
+    collection = Joke.get_motor_collection()
+    pipeline = [
+        {"$match": {"$or": [{"author_id": {"$ne": None}}, {"author": None}]}},
+        {"$group": {
+            "_id": {"day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}, "author": "$author_id"},
+            "jokes": {"$sum": 1},
+        }},
+    ]
+    async for row in collection.aggregate(pipeline):
+        count(row["_id"]["day"], row["_id"].get("author"), row["jokes"])
+    # Jokes from before author_id: aggregation paths cannot reach into the DBRef
+    # ($id), so these few are read one by one until backfill-author-ids has run.
+    async for row in collection.find({"author_id": None, "author": {"$ne": None}}, projection=STATS_PROJECTION):
+        count(day_key(row["created_at"]), joke_author(row), 1)
+
+    replacements = [ReplaceOne({"_id": "total"}, {"kind": "total", **totals}, upsert=True)]
+    replacements += [ReplaceOne({"_id": f"day:{day}"}, {"kind": "day", "day": day, **counts}, upsert=True) for day, counts in days.items()]
+    replacements += [
+        ReplaceOne({"_id": f"author:{author_id}"}, {"kind": "author", "author_id": author_id, "jokes": count}, upsert=True)
+        for author_id, count in authors.items()
+    ]
+    keep = ["total"] + [f"day:{day}" for day in days] + [f"author:{author_id}" for author_id in authors]
+    collection = _stats()
+    await collection.bulk_write(replacements + [DeleteMany({"_id": {"$nin": keep}})], ordered=False)
+    return {"jokes": totals["jokes"], "days": len(days), "authors": len(authors)}
+
+async def ensure_indexes():
+    await _stats().create_indexes(STATS_INDEXES)
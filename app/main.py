@@ -1,23 +1,40 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response, status
+from fastapi.responses import ORJSONResponse
 from app.routers import user_routers, joke_routers
 import uvicorn
 from starlette.middleware.cors import CORSMiddleware
-from models import models
 import os
-from motor.motor_asyncio import AsyncIOMotorClient
-from beanie import init_beanie
-from app.models.models import User, Joke
+from app import database, joke_pool, insert_batcher, joke_feed
+from app.auth import principal_cache
+from app.redis_client import close_redis
+from app.metrics import CONTENT_TYPE_LATEST, MetricsMiddleware, render_metrics
+from app.rate_limit import ConcurrencyLimitMiddleware
+from app.compression import CompressionMiddleware
 
 
-app = FastAPI()
+AUTO_SYNC_INDEXES = os.getenv("AUTO_SYNC_INDEXES", "true").lower() == "true"
 
-async def init_db():
-    MONGO_URI = os.getenv("MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client['local']
-    await init_beanie(database = database, document_models=[User, Joke])
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Traffic is accepted only after the pool is warm; index builds still run in
+    # the background because they can take a while on a large collection.
+    await database.connect(indexes="background" if AUTO_SYNC_INDEXES else "skip")
+    await joke_pool.start_refill()
+    insert_batcher.start_batching()
+    await principal_cache.start()
+    try:
+        yield
+    finally:
+        # Queued inserts are written before the connection goes away.
+        await insert_batcher.stop_batching()
+        await joke_pool.stop_refill()
+        await joke_feed.stop()
+        await principal_cache.stop()
+        await close_redis()
+        await database.disconnect()
 
-app.add_event_handler("startup", init_db)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,6 +43,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresses large JSON and NDJSON bodies for clients that accept it.
+app.add_middleware(CompressionMiddleware)
+# Sheds excess requests before any work is done (off unless MAX_CONCURRENT_REQUESTS is set).
+app.add_middleware(ConcurrencyLimitMiddleware)
+# Added last so it is the outermost layer and times everything below it.
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(user_routers.router, prefix="/users", tags=["Users"])
 app.include_router(joke_routers.router, prefix="/jokes", tags=["Jokes"])
@@ -34,5 +57,20 @@ app.include_router(joke_routers.router, prefix="/jokes", tags=["Jokes"])
 def root():
     return "Welcome to accounts-v1!"
 
+@app.get("/healthz", include_in_schema=False)
+def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz(response: Response):
+    if not database.is_ready() or not await database.ping():
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "unavailable"}
+    return {"status": "ready"}
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
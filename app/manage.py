@@ -0,0 +1,331 @@
+# Operational commands, run from the project root:
+#
+#   python -m app.manage indexes [--dry-run] [--drop-extra]
+#   python -m app.manage backfill-author-ids
+#   python -m app.manage dedup [--batch-size N]
+#   python -m app.manage feed-relay
+#   python -m app.manage export jokes jokes.ndjson.gz
+#   python -m app.manage import jokes jokes.ndjson.gz [--concurrency N] [--restart]
+#   python -m app.manage stats
+import argparse, asyncio, gzip, json, os, sys, time
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.models.models import Joke, User
+from app.indexes import sync_indexes, format_report
+from app import database, dedup, joke_feed, joke_stats
+from app.auth import principal_cache
+from app.redis_client import get_redis, close_redis
+from app.crud.joke_crud import announce_deleted, bump_jokes_version
+from bson import json_util
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+COLLECTIONS = {"jokes": Joke, "users": User}
+# Extended JSON: ObjectIds, dates and author DBRefs come back as they went out.
+NDJSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+# Buckets of the jokes `dedup` has kept so far; dropped when it finishes.
+DEDUP_SCRATCH_COLLECTION = "joke_lsh_dedup"
+
+async def indexes_command(args) -> int:
+    reports = await sync_indexes(drop_extra=args.drop_extra, dry_run=args.dry_run)
+    for report in reports:
+        print(format_report(report))
+    return 1 if any(report["errors"] for report in reports) else 0
+
+async def backfill_author_ids_command(args) -> int:
+    # Copies author.$id into author_id for jokes created before the field existed.
+    result = await Joke.get_motor_collection().update_many(
+        {"author_id": {"$exists": False}, "author": {"$ne": None}},
+        [{"$set": {"author_id": "$author.$id", "revision": {"$add": [{"$ifNull": ["$revision", 0]}, 1]}}}],
+    )
+    if result.modified_count:
+        await bump_jokes_version()
+    print(f"Backfilled author_id on {result.modified_count} jokes")
+    return 0
+
+async def dedup_command(args) -> int:
+    # Deletes every exact or near duplicate, keeping the oldest copy. The live
+    # duplicate index (text_hash and joke_lsh) stays in place and keeps guarding
+    # the API and the ingester while this runs. Jokes are compared, oldest
+    # first, against a scratch bucket collection holding only the copies already
+    # kept, and each kept joke's hash is overwritten in place and registered in
+    # both. Deletions go through the same side effects as delete_joke.
+    collection = Joke.get_motor_collection()
+    seen = collection.database[DEDUP_SCRATCH_COLLECTION]
+    await seen.drop()
+
+    started = time.perf_counter()
+    scanned = deleted = 0
+    projection = {"joke": 1, **joke_stats.STATS_PROJECTION}
+    cursor = collection.find({}, projection=projection, sort=[("created_at", ASCENDING), ("_id", ASCENDING)], batch_size=args.batch_size)
+    batch = []
+    try:
+        async for row in cursor:
+            batch.append(row)
+            if len(batch) >= args.batch_size:
+                deleted += await _dedup_batch(collection, seen, batch)
+                scanned += len(batch)
+                batch = []
+        if batch:
+            deleted += await _dedup_batch(collection, seen, batch)
+            scanned += len(batch)
+    finally:
+        await seen.drop()
+
+    elapsed = time.perf_counter() - started
+    print(f"Scanned {scanned} jokes in {elapsed:.1f}s, deleted {deleted} duplicates")
+    print(dedup.dedup_stats())
+    return 0
+
+async def _dedup_batch(collection, seen, rows: list) -> int:
+    fingerprints = [dedup.Fingerprint(row.get("joke", "")) for row in rows]
+    duplicates = await dedup.find_duplicates(fingerprints, lsh=seen)
+    doomed = [row["_id"] for row, duplicate in zip(rows, duplicates) if duplicate]
+    kept = [(row["_id"], fingerprint) for row, fingerprint, duplicate in zip(rows, fingerprints, duplicates) if not duplicate]
+    gone = []
+    if doomed:
+        gone = [row for row, duplicate in zip(rows, duplicates) if duplicate]
+        result = await collection.delete_many({"_id": {"$in": doomed}})
+        if result.deleted_count < len(doomed):
+            # Some went to a concurrent delete, which accounted for them itself.
+            remaining = await collection.find({"_id": {"$in": doomed}}, projection={"_id": 1}).to_list(length=len(doomed))
+            left = {row["_id"] for row in remaining}
+            gone = [row for row in gone if row["_id"] not in left]
+        if gone:
+            await announce_deleted(gone)
+    if kept:
+        # A newer copy may hold the hash of a kept joke (e.g. the older one came
+        # in through an import); it is a duplicate that a later batch deletes.
+        await collection.update_many(
+            {"text_hash": {"$in": [fingerprint.text_hash for _, fingerprint in kept]}, "_id": {"$nin": [joke_id for joke_id, _ in kept]}},
+            {"$unset": {"text_hash": ""}},
+        )
+        await collection.bulk_write([
+            UpdateOne({"_id": joke_id}, {"$set": dedup.fingerprint_fields(fingerprint)}) for joke_id, fingerprint in kept
+        ], ordered=False)
+        await asyncio.gather(dedup.register(kept, lsh=seen), dedup.register(kept))
+    return len(gone)
+
+async def feed_relay_command(args) -> int:
+    # Publishes joke writes from a MongoDB change stream to the feed, for
+    # FEED_SOURCE=change_stream. Run one; it resumes where it stopped.
+    redis = get_redis()
+    if redis is None:
+        print("feed-relay needs REDIS_URL: the API processes read the feed from Redis")
+        return 1
+    options = {"full_document": "updateLookup"}
+    resume_token = await redis.get(joke_feed.FEED_RESUME_KEY)
+    if resume_token:
+        options["resume_after"] = json.loads(resume_token)
+    relayed = 0
+    try:
+        async with Joke.get_motor_collection().watch(**options) as stream:
+            print("Relaying joke changes to the feed")
+            async for change in stream:
+                # Whatever else is already waiting goes out in the same round trip.
+                changes = [change]
+                while len(changes) < args.batch_size:
+                    change = await stream.try_next()
+                    if change is None:
+                        break
+                    changes.append(change)
+                await joke_feed.publish([entry for entry in map(joke_feed.change_entry, changes) if entry])
+                await redis.set(joke_feed.FEED_RESUME_KEY, json.dumps(stream.resume_token))
+                relayed += len(changes)
+    finally:
+        print(f"Relayed {relayed} changes")
+        await close_redis()
+    return 0
+
+async def stats_command(args) -> int:
+    await joke_stats.ensure_indexes()
+    result = await joke_stats.reconcile()
+    print(f"Rebuilt joke stats: {result['jokes']} jokes over {result['days']} days from {result['authors']} authors")
+    return 0
+
+def open_ndjson(path: str, mode: str):
+    # Gzip when the name ends in .gz; level 6 is much faster than gzip's default 9 for little size.
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+    return open(path, mode, encoding="utf-8")
+
+def print_rate(verb: str, count: int, started: float):
+    elapsed = time.perf_counter() - started
+    print(f"{verb} {count} documents in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} docs/sec)")
+
+async def export_command(args) -> int:
+    # One document per line, read batch by batch in _id order. Each batch is
+    # written (and compressed) on a thread while the next one is read, and
+    # only one batch is held at a time, so memory stays flat however big the collection.
+    collection = COLLECTIONS[args.collection].get_motor_collection()
+    started = time.perf_counter()
+    exported = 0
+    writing = None
+    with open_ndjson(args.path, "w") as f:
+        try:
+            lines = []
+            async for row in collection.find({}, sort=[("_id", ASCENDING)], batch_size=args.batch_size):
+                lines.append(json_util.dumps(row, json_options=NDJSON_OPTIONS))
+                if len(lines) >= args.batch_size:
+                    if writing is not None:
+                        await writing
+                    writing = asyncio.ensure_future(asyncio.to_thread(f.write, "\n".join(lines) + "\n"))
+                    exported += len(lines)
+                    lines = []
+            if writing is not None:
+                await writing
+                writing = None
+            if lines:
+                f.write("\n".join(lines) + "\n")
+                exported += len(lines)
+        finally:
+            if writing is not None:
+                await asyncio.gather(writing, return_exceptions=True)
+    print_rate(f"Exported {args.collection}:", exported, started)
+    return 0
+
+def read_checkpoint(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+def write_checkpoint(path: str, lines: int):
+    # Replaced in one step, so a crash leaves the old checkpoint or the new one.
+    with open(f"{path}.tmp", "w") as f:
+        f.write(str(lines))
+    os.replace(f"{path}.tmp", path)
+
+async def import_command(args) -> int:
+    # Upserts by _id in unordered bulk writes, --concurrency batches at a time.
+    # The checkpoint is the number of input lines whose batches, and all batches
+    # before them, are written; a rerun skips those lines. Batches after it may
+    # be written again, which upserts make harmless.
+    collection = COLLECTIONS[args.collection].get_motor_collection()
+    checkpoint = args.checkpoint or f"{args.path}.checkpoint"
+    done = 0 if args.restart else read_checkpoint(checkpoint)
+    if done:
+        print(f"Resuming after line {done} (from {checkpoint})")
+
+    started = time.perf_counter()
+    slots = asyncio.Semaphore(args.concurrency)
+    writes = set()
+    finished = {}
+    totals = {"committed": done, "written": 0, "errors": 0}
+    emails = set()
+
+    async def write_batch(first: int, last: int, docs: list):
+        # first and last: the input lines before and at the end of this batch.
+        try:
+            try:
+                if docs and args.collection == "users":
+                    # The emails the documents had before, so a replaced email's principals go too.
+                    replaced = await collection.find({"_id": {"$in": [doc["_id"] for doc in docs]}}, projection={"email": 1}).to_list(length=len(docs))
+                    emails.update(row["email"] for row in replaced if row.get("email"))
+                    emails.update(doc["email"] for doc in docs if doc.get("email"))
+                if docs:
+                    result = await collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs], ordered=False)
+                    totals["written"] += result.upserted_count + result.matched_count
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                totals["written"] += e.details["nUpserted"] + e.details["nMatched"]
+                totals["errors"] += len(errors)
+                print(f"{len(errors)} documents in lines {first + 1}-{last} failed, e.g. {errors[0]['errmsg']}")
+            finished[first] = last
+            while totals["committed"] in finished:
+                totals["committed"] = finished.pop(totals["committed"])
+            write_checkpoint(checkpoint, totals["committed"])
+        finally:
+            slots.release()
+
+    async def submit(first: int, last: int, docs: list):
+        await slots.acquire()
+        writes.add(asyncio.create_task(write_batch(first, last, docs)))
+        for write in [write for write in writes if write.done()]:
+            writes.discard(write)
+            # Raises if the batch failed (e.g. a lost connection) without waiting for the end.
+            write.result()
+
+    with open_ndjson(args.path, "r") as f:
+        batch, first, line_number = [], done, 0
+        for line in f:
+            line_number += 1
+            if line_number <= done:
+                continue
+            if line.strip():
+                batch.append(json_util.loads(line, json_options=NDJSON_OPTIONS))
+            if len(batch) >= args.batch_size:
+                await submit(first, line_number, batch)
+                batch, first = [], line_number
+        if batch or first < line_number:
+            await submit(first, line_number, batch)
+    await asyncio.gather(*writes)
+
+    # Cached principals of imported users would otherwise outlive the documents
+    # they were read from. With Redis every API worker drops them at once.
+    emails = sorted(emails)
+    for start in range(0, len(emails), 100):
+        await asyncio.gather(*(principal_cache.invalidate(email) for email in emails[start:start + 100]))
+    if args.collection == "jokes" and totals["written"]:
+        await joke_stats.reconcile()
+        await bump_jokes_version()
+        print("Run `python -m app.manage dedup` to add imported jokes to the duplicate index.")
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    print_rate(f"Imported {args.collection}:", line_number - done, started)
+    print(f"Written: {totals['written']}, failed: {totals['errors']}")
+    return 1 if totals["errors"] else 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    indexes = commands.add_parser("indexes", help="Diff declared indexes against the database and create missing ones.")
+    indexes.add_argument("--dry-run", action="store_true", help="Only print the diff.")
+    indexes.add_argument("--drop-extra", action="store_true", help="Drop indexes that are not declared on a model.")
+    indexes.set_defaults(handler=indexes_command)
+
+    backfill = commands.add_parser("backfill-author-ids", help="Set author_id on jokes that only have the author link.")
+    backfill.set_defaults(handler=backfill_author_ids_command)
+
+    dedupe = commands.add_parser("dedup", help="Delete exact and near-duplicate jokes, keeping the oldest copy.")
+    dedupe.add_argument("--batch-size", type=int, default=500)
+    dedupe.set_defaults(handler=dedup_command)
+
+    relay = commands.add_parser("feed-relay", help="Publish joke changes from a MongoDB change stream to the live feed.")
+    relay.add_argument("--batch-size", type=int, default=500)
+    relay.set_defaults(handler=feed_relay_command)
+
+    stats = commands.add_parser("stats", help="Rebuild the /jokes/stats counters from the jokes collection.")
+    stats.set_defaults(handler=stats_command)
+
+    export = commands.add_parser("export", help="Stream a collection to NDJSON (gzipped if the path ends in .gz).")
+    export.add_argument("collection", choices=sorted(COLLECTIONS))
+    export.add_argument("path")
+    export.add_argument("--batch-size", type=int, default=1000)
+    export.set_defaults(handler=export_command)
+
+    load = commands.add_parser("import", help="Upsert NDJSON (gzipped if the path ends in .gz) into a collection by _id.")
+    load.add_argument("collection", choices=sorted(COLLECTIONS))
+    load.add_argument("path")
+    load.add_argument("--batch-size", type=int, default=1000)
+    load.add_argument("--concurrency", type=int, default=4, help="Bulk writes in flight at once.")
+    load.add_argument("--checkpoint", default=None, help="Progress file; defaults to PATH.checkpoint.")
+    load.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the first line.")
+    load.set_defaults(handler=import_command)
+
+    return parser
+
+async def run(args) -> int:
+    # One-off commands: no warm-up, and indexes only when asked for.
+    async with database.lifespan(indexes="skip", warm=False):
+        return await args.handler(args)
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return asyncio.run(run(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
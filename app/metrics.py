@@ -0,0 +1,164 @@
+import os, threading, time
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+from dotenv import load_dotenv
+load_dotenv()
+
+# Prometheus metrics for the API and the Celery worker. With several processes
+# (uvicorn workers, prefork Celery) set PROMETHEUS_MULTIPROC_DIR to a shared empty
+# directory so /metrics sums every process; the stats gauges at the bottom
+# always describe only the process that serves the scrape.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route and status.", ["method", "route", "status"])
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency, until the last body byte.", ["method", "route"], buckets=LATENCY_BUCKETS)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled.", multiprocess_mode="livesum")
+HTTP_MONGO_COMMANDS = Histogram("http_request_mongo_commands", "Mongo commands issued per HTTP request.", ["method", "route"], buckets=COUNT_BUCKETS)
+HTTP_MONGO_SECONDS = Counter("http_request_mongo_seconds_total", "Time spent in Mongo commands, by route.", ["method", "route"])
+
+MONGO_COMMANDS = Counter("mongo_commands_total", "Mongo commands by name and outcome.", ["command", "outcome"])
+MONGO_LATENCY = Histogram("mongo_command_duration_seconds", "Mongo command latency as reported by the driver.", ["command"], buckets=LATENCY_BUCKETS)
+
+PASSWORD_HASHING = Histogram("password_hashing_duration_seconds", "bcrypt time per call.", ["operation"], buckets=LATENCY_BUCKETS)
+JWT = Histogram("jwt_duration_seconds", "JWT encode and decode time.", ["operation"], buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005))
+
+INSERT_BATCH_SIZE = Histogram("joke_insert_batch_size", "Jokes written per coalesced insert_many.", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+COMPRESSION_INPUT_BYTES = Counter("http_compression_input_bytes_total", "Response bytes before compression, by encoding.", ["encoding"])
+COMPRESSION_OUTPUT_BYTES = Counter("http_compression_output_bytes_total", "Response bytes after compression, by encoding.", ["encoding"])
+COMPRESSION_SECONDS = Counter("http_compression_cpu_seconds_total", "CPU time spent compressing responses, by encoding.", ["encoding"])
+COMPRESSION_SKIPPED = Counter("http_compression_skipped_total", "Responses sent uncompressed, by reason.", ["reason"])
+
+RATE_LIMITED = Counter("rate_limited_requests_total", "Requests refused with 429, by rate limit policy.", ["policy"])
+REQUESTS_SHED = Counter("shed_requests_total", "Requests refused with 503 by the concurrency cap.")
+
+CELERY_TASKS = Counter("celery_tasks_total", "Celery tasks by name and final state.", ["task", "state"])
+CELERY_TASK_LATENCY = Histogram("celery_task_duration_seconds", "Celery task run time.", ["task"], buckets=LATENCY_BUCKETS + (30, 60))
+JOKE_FETCH_RUNS = Counter("joke_fetch_runs_total", "Scheduled joke fetch ticks by outcome.", ["outcome"])
+JOKE_FETCH_INTERVAL = Gauge("joke_fetch_interval_seconds", "Current interval between scheduled joke fetches.", multiprocess_mode="max")
+
+class RequestStats:
+    __slots__ = ("mongo_commands", "mongo_seconds", "lock")
+
+    def __init__(self):
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        # Driver events arrive on Motor's executor threads.
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.mongo_commands += 1
+            self.mongo_seconds += seconds
+
+# Motor copies the caller's context into its executor threads, so driver events
+# can find the stats of the request that issued the command.
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, "success")
+
+    def failed(self, event):
+        self._record(event, "failure")
+
+    def _record(self, event, outcome: str):
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMANDS.labels(event.command_name, outcome).inc()
+        MONGO_LATENCY.labels(event.command_name).observe(seconds)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.add(seconds)
+
+# Applies to every MongoClient created after this module is imported.
+monitoring.register(MongoCommandMetrics())
+
+def _route_label(scope) -> str:
+    # The route template, never the raw path, keeps label cardinality bounded.
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            _request_stats.reset(token)
+            method, route = scope["method"], _route_label(scope)
+            HTTP_LATENCY.labels(method, route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(method, route, str(status_code)).inc()
+            HTTP_MONGO_COMMANDS.labels(method, route).observe(stats.mongo_commands)
+            HTTP_MONGO_SECONDS.labels(method, route).inc(stats.mongo_seconds)
+
+class AppStatsCollector:
+    # Surfaces the counters the app already keeps in memory.
+    def describe(self):
+        # Lets register() skip a collect() call, which would import modules that import this one.
+        return []
+
+    def collect(self):
+        from app.auth import hashing, principal_cache
+        from app import dedup
+
+        cache = GaugeMetricFamily("principal_cache", "Principal cache counters for this process.", labels=["stat"])
+        for name, value in principal_cache.cache_stats().items():
+            cache.add_metric([name], value)
+        yield cache
+
+        duplicates = GaugeMetricFamily("dedup_checks", "Duplicate check counters for this process.", labels=["stat"])
+        for name, value in dedup.dedup_stats().items():
+            duplicates.add_metric([name], value)
+        yield duplicates
+
+        yield GaugeMetricFamily("password_hashing_pending", "Password operations running or queued.", value=hashing.pending_operations())
+
+REGISTRY.register(AppStatsCollector())
+
+def metrics_registry():
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(AppStatsCollector())
+    return registry
+
+def render_metrics() -> bytes:
+    return generate_latest(metrics_registry())
+
+def start_metrics_server(port: int):
+    start_http_server(port, registry=metrics_registry())
@@ -1,7 +1,8 @@
-from beanie import Document, Link
-from pydantic import EmailStr
+from beanie import Document, Link, PydanticObjectId
+from pydantic import EmailStr, Field
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
 
 
 class User(Document):
@@ -9,16 +10,37 @@ class User(Document):
     hashed_password: str
     name: str
     is_active: bool = True
-    created_at: datetime = datetime.now()
+    created_at: datetime = Field(default_factory=datetime.now)
 
     class Settings:
         name = "users"
+        indexes = [
+            IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        ]
 
 class Joke(Document):
     id: str 
     joke: str
-    created_at: datetime = datetime.now()
+    created_at: datetime = Field(default_factory=datetime.now)
     author: Optional[Link[User]] = None 
+    # Copy of author's id so ownership can be checked in the same filter as _id.
+    author_id: Optional[PydanticObjectId] = None
+    # Bumped by every edit; the joke's ETag is derived from it and created_at.
+    revision: int = 0
+    # Duplicate detection, see app/dedup.py.
+    text_hash: Optional[str] = None
+    minhash: Optional[List[int]] = None
 
     class Settings:
-        name = "jokes"
\ No newline at end of file
+        name = "jokes"
+        indexes = [
+            IndexModel([("author_id", ASCENDING), ("created_at", DESCENDING)], name="author_created_at"),
+            # Also serves plain created_at range queries through its prefix.
+            IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at_id"),
+            IndexModel([("joke", TEXT)], name="joke_text"),
+            # Sparse: jokes stored without a text_hash (dedup off, or older than it) are skipped.
+            IndexModel([("text_hash", ASCENDING)], name="text_hash_unique", unique=True, sparse=True),
+        ]
+        # Unset fields are left out of the document instead of stored as null,
+        # which the sparse text_hash index would otherwise see as duplicates.
+        keep_nulls = False
@@ -0,0 +1,69 @@
+from beanie import PydanticObjectId
+from pydantic import AliasChoices, BaseModel, Field
+from datetime import datetime
+from typing import List, Optional
+import os
+
+JOKE_BATCH_MAX = int(os.getenv("JOKE_BATCH_MAX", "1000"))
+
+class JokeIn(BaseModel):
+    joke: str
+    id: Optional[str] = None
+
+class JokeBatchIn(BaseModel):
+    jokes: List[JokeIn] = Field(min_length=1, max_length=JOKE_BATCH_MAX)
+
+class JokeOut(BaseModel):
+    # Read side of Joke: built straight from a Mongo projection, never a full document.
+    id: str = Field(validation_alias=AliasChoices("_id", "id"))
+    joke: str
+    created_at: datetime
+    author_id: Optional[PydanticObjectId] = None
+    # Read for the ETag only, never rendered. Jokes older than the field count as 0.
+    revision: int = Field(0, exclude=True)
+
+    class Settings:
+        projection = {"_id": 1, "joke": 1, "created_at": 1, "author_id": 1, "revision": 1}
+
+class JokeSearchResult(JokeOut):
+    score: float
+
+    class Settings:
+        projection = {**JokeOut.Settings.projection, "score": {"$meta": "textScore"}}
+
+class JokeListOut(BaseModel):
+    status: str = "success"
+    jokes: List[JokeOut]
+    next_cursor: Optional[str] = None
+
+class JokeDetailOut(BaseModel):
+    status: str = "success"
+    joke: JokeOut
+
+class JokeBatchOut(BaseModel):
+    status: str = "success"
+    jokes: List[JokeOut]
+    missing: List[str]
+
+class JokeSearchOut(BaseModel):
+    status: str = "success"
+    jokes: List[JokeSearchResult]
+    next_offset: Optional[int] = None
+
+class JokeDayStats(BaseModel):
+    day: str
+    jokes: int
+    user_submitted: int
+    ingested: int
+
+class JokeAuthorStats(BaseModel):
+    author_id: str
+    jokes: int
+
+class JokeStatsOut(BaseModel):
+    status: str = "success"
+    jokes: int
+    user_submitted: int
+    ingested: int
+    per_day: List[JokeDayStats]
+    top_authors: List[JokeAuthorStats]
@@ -0,0 +1,214 @@
+import asyncio, logging, math, os, time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+from redis.exceptions import RedisError
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.auth.auth_jwt import token_payload
+from app.metrics import RATE_LIMITED, REQUESTS_SHED
+from app.redis_client import get_redis
+
+# Token buckets per (policy, identity). A limit of "10/60" holds 10 tokens and
+# refills 10 every 60 seconds, so it allows bursts of 10 and 10 a minute after
+# that. Override any of them with RATE_LIMIT_<POLICY>_<KIND>, e.g. RATE_LIMIT_LOGIN_IP=50/60.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Only behind a proxy that sets it: otherwise clients pick their own bucket.
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+RATE_LIMIT_LOCAL_KEYS = int(os.getenv("RATE_LIMIT_LOCAL_KEYS", "100000"))
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = {
+    ("login", "ip"): "20/60",
+    ("login", "user"): "5/60",
+    ("signup", "ip"): "5/60",
+    ("joke_write", "ip"): "300/60",
+    ("joke_write", "user"): "60/60",
+}
+
+# Requests handled at once before new ones are shed; 0 turns the cap off.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "0"))
+CONCURRENCY_QUEUE_TIMEOUT = float(os.getenv("CONCURRENCY_QUEUE_TIMEOUT", "0.05"))
+CONCURRENCY_RETRY_AFTER = os.getenv("CONCURRENCY_RETRY_AFTER", "1")
+# Probes and scrapes are never refused; feed streams stay open for hours and
+# would otherwise hold a slot each.
+UNSHED_PATHS = frozenset(("/healthz", "/readyz", "/metrics", "/jokes/stream"))
+
+def parse_limit(value: str) -> Tuple[float, float]:
+    capacity, period = value.split("/")
+    return float(capacity), float(capacity) / float(period)
+
+def get_limit(policy: str, kind: str) -> Optional[Tuple[float, float]]:
+    value = os.getenv(f"RATE_LIMIT_{policy.upper()}_{kind.upper()}", DEFAULT_LIMITS.get((policy, kind)))
+    return parse_limit(value) if value else None
+
+# All buckets of one request are checked and charged together: a request refused
+# by its user bucket does not use up a token of its IP bucket.
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local states = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    states[i] = {tokens, capacity / rate}
+end
+local allowed = wait == 0
+for i, key in ipairs(KEYS) do
+    local tokens = states[i][1]
+    if allowed then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(states[i][2]) + 1)
+end
+if allowed then
+    return {1, '0'}
+end
+return {0, tostring(wait)}
+"""
+
+class LocalBuckets:
+    # Same algorithm per process, used without Redis or while it is unreachable.
+    def __init__(self, max_keys: int = RATE_LIMIT_LOCAL_KEYS):
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.max_keys = max_keys
+
+    def take(self, limits: List[Tuple[str, float, float]]) -> float:
+        now = time.monotonic()
+        states, wait = [], 0.0
+        for key, capacity, rate in limits:
+            tokens, ts = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+            states.append((key, tokens))
+        for key, tokens in states:
+            self.buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        self.buckets.clear()
+
+_local = LocalBuckets()
+_script = None
+# Set while Redis is failing, so an outage is logged once rather than per request.
+_redis_down = False
+
+async def take(limits: List[Tuple[str, float, float]]) -> float:
+    # limits are (key, capacity, refill per second); returns 0 when allowed,
+    # otherwise the seconds until a token is free in every bucket.
+    global _script, _redis_down
+    redis = get_redis()
+    if redis is not None:
+        try:
+            if _script is None:
+                _script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+            args = [value for _, capacity, rate in limits for value in (capacity, rate)]
+            allowed, wait = await _script(keys=[f"ratelimit:{key}" for key, _, _ in limits], args=args)
+            if _redis_down:
+                _redis_down = False
+                logger.info("Rate limiter back on Redis")
+            return 0.0 if int(allowed) else float(wait)
+        except RedisError as e:
+            if not _redis_down:
+                _redis_down = True
+                logger.warning("Rate limiter falling back to local buckets: %s", e)
+    return _local.take(limits)
+
+def reset():
+    global _script, _redis_down
+    _script = None
+    _redis_down = False
+    _local.clear()
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+async def check(policy: str, identities: dict):
+    # identities: kind -> value, e.g. {"ip": "1.2.3.4", "user": "a@b.c"}.
+    if not RATE_LIMIT_ENABLED:
+        return
+    limits = []
+    for kind, identity in identities.items():
+        limit = get_limit(policy, kind) if identity else None
+        if limit:
+            limits.append((f"{policy}:{kind}:{identity}", *limit))
+    if not limits:
+        return
+    wait = await take(limits)
+    if wait > 0:
+        RATE_LIMITED.labels(policy).inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, slow down.",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))}
+        )
+
+def rate_limit(policy: str):
+    # Route dependency for authenticated routes: the user is read from the token
+    # without a database lookup, so a refused request costs no Mongo round trip.
+    # The decoded token is kept on the request for get_current_user.
+    async def dependency(request: Request, token: Optional[str] = None):
+        payload = token_payload(token, request)
+        await check(policy, {"ip": client_ip(request), "user": payload.get("email") if payload else None})
+    return dependency
+
+def rate_limit_by_email(policy: str):
+    # For login and signup, where the account is named by the email parameter.
+    async def dependency(request: Request, email: Optional[str] = None):
+        await check(policy, {"ip": client_ip(request), "user": email.strip().lower() if email else None})
+    return dependency
+
+class ConcurrencyLimitMiddleware:
+    # Sheds requests beyond MAX_CONCURRENT_REQUESTS with 503 after a short wait
+    # for a slot, so overload shows up as fast refusals instead of a growing queue.
+    def __init__(self, app, limit: int = MAX_CONCURRENT_REQUESTS, queue_timeout: float = CONCURRENCY_QUEUE_TIMEOUT):
+        self.app = app
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.slots = asyncio.Semaphore(limit) if limit > 0 else None
+
+    async def __call__(self, scope, receive, send):
+        if self.slots is None or scope["type"] != "http" or scope["path"] in UNSHED_PATHS:
+            return await self.app(scope, receive, send)
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            REQUESTS_SHED.inc()
+            return await self._shed(send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.slots.release()
+
+    async def _shed(self, send):
+        body = b'{"detail":"Server is busy, try again shortly."}'
+        await send({
+            "type": "http.response.start",
+            "status": status.HTTP_503_SERVICE_UNAVAILABLE,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", CONCURRENCY_RETRY_AFTER.encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
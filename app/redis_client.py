@@ -0,0 +1,25 @@
+import os
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+load_dotenv()
+
+# Optional shared tier: every feature that uses Redis falls back to in-process state without it.
+REDIS_URL = os.getenv("REDIS_URL")
+
+_redis = None
+
+def get_redis():
+    global _redis
+    if _redis is None and REDIS_URL:
+        _redis = aioredis.from_url(REDIS_URL)
+    return _redis
+
+def set_redis(client):
+    global _redis
+    _redis = client
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
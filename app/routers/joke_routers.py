@@ -1,15 +1,94 @@
-from app.crud.joke_crud import create_joke, get_all_jokes, get_joke_by_id, delete_joke, update_joke
+from app.crud.joke_crud import (
+    create_joke, create_jokes, get_jokes_page, get_jokes_version, stream_jokes, get_joke_by_id, get_jokes_by_ids,
+    update_owned_joke, delete_owned_joke, delete_owned_jokes, JokeMutation
+)
 from app.auth.auth_jwt import verify_access_token
 from app.models.models import User
+from app.models.schemas import JokeBatchIn, JokeBatchOut, JokeDetailOut, JokeListOut, JokeSearchOut, JokeStatsOut, JOKE_BATCH_MAX
+from app.search import search_jokes
+from app.joke_api import JokeAPIError
+from app.dedup import DuplicateJokeError
+from app.joke_pool import get_random_joke
+from app.utils import make_etag, etag_matches
+from app.rate_limit import rate_limit
+from app.joke_feed import Subscription, subscribe, unsubscribe
+from app.joke_stats import get_stats, STATS_MAX_AUTHORS, STATS_MAX_DAYS
 from auth.auth_jwt import get_current_user
-from utils import verify_joke_owner
 
-from fastapi import APIRouter, Depends, status, HTTPException
-import requests
+from fastapi import APIRouter, Depends, status, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+import asyncio
 
 router = APIRouter()
 
-@router.post("/jokes/", status_code=status.HTTP_201_CREATED)
+# Every route that writes jokes shares one budget per user and per client address.
+LIMIT_WRITES = [Depends(rate_limit("joke_write"))]
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+JOKE_PAGE_DEFAULT_LIMIT = 50
+JOKE_PAGE_MAX_LIMIT = 500
+NDJSON_BATCH_SIZE = 500
+SEARCH_MAX_LIMIT = 100
+# Each page ranks everything before it, so deep pages are refused, not slow.
+SEARCH_MAX_OFFSET = 1000
+# How long EventSource clients wait before reconnecting with Last-Event-ID.
+FEED_RETRY_MS = 3000
+# Clients may keep a copy but must revalidate it; the token is in the URL, so no shared caches.
+CACHE_CONTROL = "private, no-cache"
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+async def ndjson_lines(jokes, batch_size: int = NDJSON_BATCH_SIZE):
+    lines = []
+    async for joke in jokes:
+        lines.append(joke.model_dump_json())
+        if len(lines) >= batch_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+async def feed_messages(subscription: Subscription):
+    try:
+        yield f"retry: {FEED_RETRY_MS}\n\n"
+        while True:
+            try:
+                event = await subscription.get()
+            except StopAsyncIteration:
+                return
+            # A comment line keeps proxies from closing an idle stream.
+            yield event.sse() if event is not None else ": ping\n\n"
+    finally:
+        unsubscribe(subscription)
+
+async def feed_to_socket(websocket: WebSocket, subscription: Subscription):
+    while True:
+        try:
+            event = await subscription.get()
+        except StopAsyncIteration:
+            await websocket.close()
+            return
+        if event is not None:
+            await websocket.send_text(event.message())
+
+def parse_joke_ids(ids: List[str]) -> List[str]:
+    # Accepts both ?ids=a&ids=b and ?ids=a,b; duplicates are dropped, order is kept.
+    joke_ids = list(dict.fromkeys(joke_id.strip() for value in ids for joke_id in value.split(",") if joke_id.strip()))
+    if not joke_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="At least one joke ID is required."
+        )
+    if len(joke_ids) > JOKE_BATCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {JOKE_BATCH_MAX} joke IDs are allowed per request."
+        )
+    return joke_ids
+
+@router.post("/jokes/", status_code=status.HTTP_201_CREATED, dependencies=LIMIT_WRITES)
 async def add_joke_endpoint(
     joke_text: str, 
     current_user: User = Depends(get_current_user), 
@@ -32,24 +111,236 @@ async def add_joke_endpoint(
             "message": "Joke added successfully.",
             "joke_id": joke.id
         }
+    except DuplicateJokeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(e)
         )
     
-@router.get("/jokes/", status_code=status.HTTP_200_OK)
-async def list_jokes_endpoint(current_user: User = Depends(get_current_user)):
+@router.get("/jokes/", status_code=status.HTTP_200_OK, response_model=JokeListOut)
+async def list_jokes_endpoint(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=JOKE_PAGE_MAX_LIMIT),
+    current_user: User = Depends(get_current_user)
+):
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not authenticated."
+        )
+    try:
+        if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+            jokes = stream_jokes(after=after, limit=limit, batch_size=NDJSON_BATCH_SIZE)
+            return StreamingResponse(ndjson_lines(jokes), media_type=NDJSON_MEDIA_TYPE)
+        limit = limit or JOKE_PAGE_DEFAULT_LIMIT
+        # Read before the page: a write landing in between only makes the tag older.
+        etag = make_etag("jokes", await get_jokes_version(), after or "", limit)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+        jokes, next_cursor = await get_jokes_page(after=after, limit=limit)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = CACHE_CONTROL
+        return JokeListOut(jokes=jokes, next_cursor=next_cursor)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+@router.get("/random", status_code=status.HTTP_200_OK)
+async def random_joke_endpoint(current_user: User = Depends(get_current_user)):
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not authenticated."
+        )
+    try:
+        joke_data = await get_random_joke()
+        return {
+            "status": "success",
+            "joke": joke_data["joke"]
+        }
+    except (JokeAPIError, asyncio.TimeoutError):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Failed to fetch joke from external API."
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+@router.get("/search", status_code=status.HTTP_200_OK, response_model=JokeSearchOut)
+async def search_jokes_endpoint(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=SEARCH_MAX_LIMIT),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    current_user: User = Depends(get_current_user)
+):
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not authenticated."
+        )
+    try:
+        jokes, has_more = await search_jokes(q, limit=limit, offset=offset)
+        return JokeSearchOut(jokes=jokes, next_offset=offset + limit if has_more else None)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+@router.get("/stats", status_code=status.HTTP_200_OK, response_model=JokeStatsOut)
+async def joke_stats_endpoint(
+    days: int = Query(30, ge=1, le=STATS_MAX_DAYS),
+    authors: int = Query(10, ge=0, le=STATS_MAX_AUTHORS),
+    current_user: User = Depends(get_current_user)
+):
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not authenticated."
+        )
+    try:
+        return JokeStatsOut(**await get_stats(days=days, authors=authors))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+@router.get("/stream", status_code=status.HTTP_200_OK)
+async def joke_stream_endpoint(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    after: Optional[str] = None
+):
+    # Server-Sent Events: created, updated and deleted jokes as they happen.
+    # Reconnects resume after the Last-Event-ID header (or ?after=).
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not authenticated."
+        )
+    try:
+        subscription = await subscribe(after or request.headers.get("last-event-id"))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid event id."
+        )
+    return StreamingResponse(
+        feed_messages(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/ws")
+async def joke_feed_socket(websocket: WebSocket, token: str, after: Optional[str] = None):
+    # Same events as /stream, one JSON message each.
+    try:
+        current_user = await get_current_user(token)
+        subscription = await subscribe(after) if current_user else None
+    except (HTTPException, ValueError):
+        subscription = None
+    if subscription is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    sender = asyncio.create_task(feed_to_socket(websocket, subscription))
+    try:
+        # Nothing is expected from the client; receiving notices when it leaves.
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        sender.cancel()
+        # Retrieves whatever ended it, e.g. a send_text that failed on a dead connection.
+        try:
+            await sender
+        except (asyncio.CancelledError, Exception):
+            pass
+        unsubscribe(subscription)
+
+@router.post("/jokes/batch", status_code=status.HTTP_200_OK, dependencies=LIMIT_WRITES)
+async def add_jokes_batch_endpoint(
+    batch: JokeBatchIn,
+    current_user: User = Depends(get_current_user)
+):
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not authenticated."
+        )
+    try:
+        results = await create_jokes([(item.joke, item.id) for item in batch.jokes], author=current_user)
+        created = sum(1 for result in results if result["status"] == "created")
+        return {
+            "status": "success",
+            "created": created,
+            "failed": len(results) - created,
+            "results": results
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+@router.get("/jokes/batch", status_code=status.HTTP_200_OK, response_model=JokeBatchOut)
+async def get_jokes_batch_endpoint(
+    ids: List[str] = Query(...),
+    current_user: User = Depends(get_current_user)
+):
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not authenticated."
+        )
+    joke_ids = parse_joke_ids(ids)
+    try:
+        jokes = await get_jokes_by_ids(joke_ids)
+        found = {joke.id for joke in jokes}
+        return JokeBatchOut(jokes=jokes, missing=[joke_id for joke_id in joke_ids if joke_id not in found])
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+@router.delete("/jokes/batch", status_code=status.HTTP_200_OK, dependencies=LIMIT_WRITES)
+async def delete_jokes_batch_endpoint(
+    ids: List[str] = Query(...),
+    current_user: User = Depends(get_current_user)
+):
     if not current_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not authenticated."
         )
+    joke_ids = parse_joke_ids(ids)
     try:
-        jokes = await get_all_jokes()
+        # Jokes owned by someone else are left alone and counted as not deleted.
+        deleted = await delete_owned_jokes(joke_ids, current_user)
         return {
             "status": "success",
-            "jokes": jokes  
+            "deleted": deleted,
+            "not_deleted": len(joke_ids) - deleted
         }
     except Exception as e:
         raise HTTPException(
@@ -57,9 +348,11 @@ async def list_jokes_endpoint(current_user: User = Depends(get_current_user)):
             detail=str(e)
         )
 
-@router.get("/jokes/{joke_id}", status_code=status.HTTP_200_OK)
+@router.get("/jokes/{joke_id}", status_code=status.HTTP_200_OK, response_model=JokeDetailOut)
 async def get_joke_endpoint(
     joke_id: str, 
+    request: Request,
+    response: Response,
     current_user: User = Depends(get_current_user)
 ):
     if not current_user:
@@ -81,17 +374,23 @@ async def get_joke_endpoint(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Joke not found."
             )
-        return {
-            "status": "success",
-            "joke": joke 
-        }
+        # revision restarts at 0 when an id is deleted and reused (or replaced by an
+        # import); created_at tells those documents apart.
+        etag = make_etag("joke", joke.id, joke.created_at.isoformat(), joke.revision)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = CACHE_CONTROL
+        return JokeDetailOut(joke=joke)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(e)
         )
 
-@router.put("/jokes/{joke_id}", status_code=status.HTTP_200_OK)
+@router.put("/jokes/{joke_id}", status_code=status.HTTP_200_OK, dependencies=LIMIT_WRITES)
 async def update_joke_endpoint(
     joke_id: str, 
     new_joke_text: str, 
@@ -103,14 +402,13 @@ async def update_joke_endpoint(
             detail="User not authenticated."
         )
     try:
-        is_owner = await verify_joke_owner(joke_id, current_user)
-        if not is_owner:
+        result = await update_owned_joke(joke_id, current_user, new_joke_text)
+        if result is JokeMutation.FORBIDDEN:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="You are not authorized to update this joke."
             )
-        updated = await update_joke(joke_id, new_joke_text)
-        if not updated: 
+        if result is JokeMutation.NOT_FOUND:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Joke not found."
@@ -119,13 +417,20 @@ async def update_joke_endpoint(
             "status": "success",
             "message": "Joke updated successfully."
         }
+    except HTTPException:
+        raise
+    except DuplicateJokeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(e)
         )
 
-@router.delete("/jokes/{joke_id}", status_code=status.HTTP_200_OK)
+@router.delete("/jokes/{joke_id}", status_code=status.HTTP_200_OK, dependencies=LIMIT_WRITES)
 async def delete_joke_endpoint(
     joke_id: str, 
     current_user: User = Depends(get_current_user)
@@ -136,14 +441,13 @@ async def delete_joke_endpoint(
             detail="User not authenticated."
         )
     try:
-        is_owner = await verify_joke_owner(joke_id, current_user)
-        if not is_owner:
+        result = await delete_owned_joke(joke_id, current_user)
+        if result is JokeMutation.FORBIDDEN:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="You are not authorized to delete this joke."
             )
-        deleted = await delete_joke(joke_id)
-        if not deleted:
+        if result is JokeMutation.NOT_FOUND:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Joke not found."
@@ -153,6 +457,8 @@ async def delete_joke_endpoint(
             "status": "success",
             "message": "Joke deleted successfully."
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -160,7 +466,7 @@ async def delete_joke_endpoint(
         )
 
 
-@router.post("/jokes/random_joke_creation/", status_code=status.HTTP_200_OK)
+@router.post("/jokes/random_joke_creation/", status_code=status.HTTP_200_OK, dependencies=LIMIT_WRITES)
 async def random_joke_creation(current_user: User = Depends(get_current_user)):
     if not current_user:
         raise HTTPException(
@@ -168,21 +474,23 @@ async def random_joke_creation(current_user: User = Depends(get_current_user)):
             detail="User not authenticated."
         )
     try:
-        response = requests.get("https://icanhazdadjoke.com/", headers={"Accept": "application/json"})
-        
-        if response.status_code == 200:
-            joke_data = response.json()
-            joke = await create_joke(str(joke_data["joke"]), current_user, joke_id=joke_data["id"])
-            return {
-                "status": "success",
-                "message": "Random joke created successfully.",
-                "joke_id": joke.id 
-            }
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Failed to fetch joke from external API."
-            )
+        joke_data = await get_random_joke()
+        joke = await create_joke(joke_data["joke"], current_user)
+        return {
+            "status": "success",
+            "message": "Random joke created successfully.",
+            "joke_id": joke.id 
+        }
+    except (JokeAPIError, asyncio.TimeoutError):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Failed to fetch joke from external API."
+        )
+    except DuplicateJokeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
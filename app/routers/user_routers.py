@@ -2,11 +2,13 @@ from fastapi import APIRouter, HTTPException, status, Depends
 from app.crud.user_crud import create_user, edit_user, delete_user
 from app.auth.auth_jwt import create_access_token, get_current_user
 from app.models.models import User
-from app.auth.hashing import verify_password
+from app.auth.hashing import verify_password_async
+from app.rate_limit import rate_limit_by_email
+from pymongo.errors import DuplicateKeyError
 
 router = APIRouter()
 
-@router.post("/users/", status_code=status.HTTP_201_CREATED)
+@router.post("/users/", status_code=status.HTTP_201_CREATED, dependencies=[Depends(rate_limit_by_email("signup"))])
 async def create_user_endpoint(email: str, password: str, name: str):
     if not email or not password or not name:
         raise HTTPException(
@@ -20,6 +22,13 @@ async def create_user_endpoint(email: str, password: str, name: str):
             "message": "User created successfully.",
             "user_email": user.email
         }
+    except HTTPException:
+        raise
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A user with this email already exists."
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -52,6 +61,11 @@ async def edit_user_endpoint(email: str, name: str, current_user: User = Depends
         )
     except HTTPException:
         raise
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A user with this email already exists."
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -94,14 +108,14 @@ async def delete_user_endpoint(email: str, current_user: User = Depends(get_curr
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An unexpected error occurred: {e}"
         )
-@router.post("/users/login/", status_code=status.HTTP_200_OK)
+@router.post("/users/login/", status_code=status.HTTP_200_OK, dependencies=[Depends(rate_limit_by_email("login"))])
 async def login_endpoint(email: str, password: str):
     if not email or not password:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email and password are required")
     user = await User.find_one({"email": email})
     if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 
     access_token = create_access_token({"email": email, "name": user.name})
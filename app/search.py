@@ -0,0 +1,152 @@
+import heapq, math, os, re
+from collections import defaultdict
+from typing import Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.models.models import Joke
+from app.models.schemas import JokeSearchResult
+
+# "mongo" ranks with the $text index on Joke.joke. "memory" keeps a BM25 inverted
+# index in this process, fed by joke_crud; it only sees writes made by this process
+# after its first build, so use it for single-process setups and the Mongo stand-in.
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "mongo")
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+STOP_WORDS = frozenset("a an and are as at be but by for from has he i in is it its of on or that the to was were what when why with you".split())
+
+def tokenize(text: str) -> List[str]:
+    return [token.strip("'") for token in TOKEN_PATTERN.findall(text.lower()) if token.strip("'") not in STOP_WORDS]
+
+class MongoTextSearch:
+    async def search(self, query: str, limit: int, offset: int) -> Tuple[List[JokeSearchResult], bool]:
+        cursor = Joke.get_motor_collection().find(
+            {"$text": {"$search": query}},
+            projection=JokeSearchResult.Settings.projection,
+            sort=[("score", {"$meta": "textScore"})],
+            skip=offset,
+            limit=limit + 1,
+        )
+        rows = await cursor.to_list(length=limit + 1)
+        return [JokeSearchResult.model_validate(row) for row in rows[:limit]], len(rows) > limit
+
+    async def add(self, joke_id: str, text: str):
+        pass
+
+    async def remove(self, joke_ids: Iterable[str], verify: bool = False):
+        pass
+
+class InMemorySearch:
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.terms = {}
+        self.total_length = 0
+        self.built = False
+
+    async def build(self):
+        self.postings.clear()
+        self.lengths.clear()
+        self.terms.clear()
+        self.total_length = 0
+        async for row in Joke.get_motor_collection().find({}, projection={"joke": 1}, batch_size=1000):
+            self._add(row["_id"], row.get("joke", ""))
+        self.built = True
+
+    def _add(self, joke_id: str, text: str):
+        self._remove(joke_id)
+        tokens = tokenize(text)
+        counts = defaultdict(int)
+        for token in tokens:
+            counts[token] += 1
+        for token, count in counts.items():
+            self.postings[token][joke_id] = count
+        self.lengths[joke_id] = len(tokens)
+        self.terms[joke_id] = tuple(counts)
+        self.total_length += len(tokens)
+
+    def _remove(self, joke_id: str):
+        length = self.lengths.pop(joke_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for token in self.terms.pop(joke_id, ()):
+            postings = self.postings[token]
+            postings.pop(joke_id, None)
+            if not postings:
+                del self.postings[token]
+
+    def rank(self, query: str) -> List[Tuple[float, str]]:
+        # Only the postings of the query terms are touched, not the whole collection.
+        scores = defaultdict(float)
+        documents = len(self.lengths) or 1
+        average_length = (self.total_length / documents) or 1
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            for joke_id, count in postings.items():
+                norm = count + self.K1 * (1 - self.B + self.B * self.lengths[joke_id] / average_length)
+                scores[joke_id] += idf * count * (self.K1 + 1) / norm
+        return [(score, joke_id) for joke_id, score in scores.items()]
+
+    async def search(self, query: str, limit: int, offset: int) -> Tuple[List[JokeSearchResult], bool]:
+        if not self.built:
+            await self.build()
+        ranked = heapq.nlargest(offset + limit + 1, self.rank(query), key=lambda hit: (hit[0], hit[1]))
+        page = ranked[offset:offset + limit]
+        if not page:
+            return [], False
+        rows = await Joke.get_motor_collection().find(
+            {"_id": {"$in": [joke_id for _, joke_id in page]}},
+            projection={key: 1 for key in JokeSearchResult.Settings.projection if key != "score"},
+        ).to_list(length=len(page))
+        by_id = {row["_id"]: row for row in rows}
+        results = [
+            JokeSearchResult.model_validate({**by_id[joke_id], "score": score})
+            for score, joke_id in page if joke_id in by_id
+        ]
+        return results, len(ranked) > offset + limit
+
+    async def add(self, joke_id: str, text: str):
+        if self.built:
+            self._add(joke_id, text)
+
+    async def remove(self, joke_ids: Iterable[str], verify: bool = False):
+        # verify: the caller does not know which ids were really deleted (delete_many).
+        if not self.built:
+            return
+        joke_ids = list(joke_ids)
+        if verify:
+            remaining = await Joke.get_motor_collection().find(
+                {"_id": {"$in": joke_ids}}, projection={"_id": 1}
+            ).to_list(length=len(joke_ids))
+            kept = {row["_id"] for row in remaining}
+            joke_ids = [joke_id for joke_id in joke_ids if joke_id not in kept]
+        for joke_id in joke_ids:
+            self._remove(joke_id)
+
+_backend = None
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        _backend = InMemorySearch() if SEARCH_BACKEND == "memory" else MongoTextSearch()
+    return _backend
+
+def set_search_backend(backend: Optional[object]):
+    global _backend
+    _backend = backend
+
+async def search_jokes(query: str, limit: int = 20, offset: int = 0):
+    return await get_search_backend().search(query, limit, offset)
+
+async def index_joke(joke_id: str, text: str):
+    await get_search_backend().add(joke_id, text)
+
+async def unindex_jokes(joke_ids: Iterable[str], verify: bool = False):
+    await get_search_backend().remove(joke_ids, verify=verify)
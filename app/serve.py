@@ -0,0 +1,98 @@
+# Production server, run from the project root:
+#
+#   python -m app.serve [--workers N] [--host 0.0.0.0] [--port 8000]
+#
+# main.py's `python3 main.py` is the development server (one process, reloader).
+# This one binds the socket once and hands it to WEB_CONCURRENCY worker
+# processes (default: one per core), restarting any that die. Workers are
+# spawned, not forked: each imports the app and opens its own Mongo pool and
+# Redis client in the lifespan, so nothing is shared across processes except
+# the listening socket.
+import argparse, asyncio, glob, os, sys, tempfile
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+from dotenv import load_dotenv
+load_dotenv()
+
+SERVE_APP = os.getenv("SERVE_APP", "app.main:app")
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# Longer than the idle timeout of the load balancer in front (60s on most), or
+# it reuses connections the server has just closed and answers 502.
+KEEPALIVE_TIMEOUT = int(os.getenv("KEEPALIVE_TIMEOUT", "75"))
+# Connections the kernel queues while every worker is busy; capped by net.core.somaxconn.
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+# On SIGTERM a worker stops accepting, finishes in-flight requests for up to
+# this long, cancels what is left and then runs the lifespan shutdown.
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# /metrics already counts every request; per-request log lines cost throughput.
+ACCESS_LOG = os.getenv("ACCESS_LOG", "false").lower() == "true"
+
+class DrainingServer(uvicorn.Server):
+    # Live feed streams never finish on their own, so they would hold every
+    # drain for the whole GRACEFUL_TIMEOUT. They are ended as soon as the
+    # signal arrives; clients reconnect elsewhere and resume from their last event.
+    async def serve(self, sockets=None):
+        self.loop = asyncio.get_running_loop()
+        await super().serve(sockets=sockets)
+
+    def handle_exit(self, sig, frame):
+        draining = self.should_exit
+        super().handle_exit(sig, frame)
+        if not draining and getattr(self, "loop", None) is not None:
+            from app import joke_feed
+            self.loop.call_soon_threadsafe(joke_feed.close_subscriptions)
+
+def prepare_metrics_dir(workers: int):
+    # Prometheus needs a directory shared by the workers to sum their metrics.
+    # Files left by an earlier run would be counted again, so it starts empty.
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if workers > 1 and not path:
+        path = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="fluvi-metrics-")
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for stale in glob.glob(os.path.join(path, "*.db")):
+            os.remove(stale)
+
+def build_config(args) -> uvicorn.Config:
+    return uvicorn.Config(
+        args.app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        # uvloop and httptools when they are installed, asyncio and h11 otherwise.
+        loop="auto",
+        http="auto",
+        backlog=BACKLOG,
+        timeout_keep_alive=KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        access_log=ACCESS_LOG,
+        proxy_headers=True,
+        server_header=False,
+    )
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m app.serve")
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--app", default=SERVE_APP, help="Import string of the ASGI app.")
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    args.workers = max(1, args.workers)
+    prepare_metrics_dir(args.workers)
+    config = build_config(args)
+    server = DrainingServer(config)
+    print(f"Serving {args.app} on {args.host}:{args.port} with {args.workers} worker(s)")
+    if args.workers == 1:
+        server.run()
+        return 0 if server.started else 1
+    # Multiprocess forwards SIGTERM/SIGINT to the workers and waits for their drain.
+    Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
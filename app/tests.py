@@ -1,26 +1,57 @@
 import pytest
 from app.models.models import User, Joke
-from app.crud.joke_crud import create_joke, get_all_jokes, get_joke_by_id, delete_joke
+from app.crud.joke_crud import (
+    create_joke, create_jokes, get_all_jokes, get_jokes_page, get_joke_by_id, get_jokes_by_ids, delete_joke,
+    update_owned_joke, delete_owned_joke, delete_owned_jokes, get_jokes_version, JokeMutation
+)
 from app.crud.user_crud import create_user, edit_user, delete_user
-from beanie import init_beanie
-from motor.motor_asyncio import AsyncIOMotorClient
-from bson import ObjectId
-import os
+from app.crud import joke_crud
+from app.auth import principal_cache, hashing
+from app.auth import auth_jwt
+from app.auth.auth_jwt import create_access_token, get_current_user
+from fastapi import HTTPException
+from app import joke_api, joke_pool
+from app.celery_worker import ingest_jokes, fetch_and_ingest
+from app.dedup import DuplicateJokeError
+from app import dedup
+from app.utils import new_joke_id, new_joke_ids, make_etag, etag_matches
+from app.indexes import sync_indexes, declared_indexes
+from app import database, search, metrics, rate_limit, insert_batcher, fetch_scheduler, joke_feed, manage, joke_stats, serve, compression
+from pymongo.errors import DuplicateKeyError
+from app.redis_client import set_redis
+import fakeredis
+from fakeredis import aioredis as fake_aioredis
+from pymongo import ASCENDING, DESCENDING
+from datetime import datetime
+from bson import ObjectId, json_util
+import os, asyncio, json, gzip, gc, zlib, hashlib, signal
+import uvicorn
+import httpx
+from fastapi.routing import APIRoute
+from app.main import app
+from app.routers import joke_routers
 
-@pytest.fixture(scope="module")
-async def mock_db():
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
-    yield
+def plan_stages(plan: dict) -> list:
+    stages = [plan["stage"]] if "stage" in plan else []
+    for child in plan.get("inputStages", []) + [plan.get("inputStage", {})]:
+        stages.extend(plan_stages(child))
+    return stages
+
+async def assert_uses_index(collection, query: dict, sort=None):
+    explanation = await collection.find(query, sort=sort).explain()
+    stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+    assert "IXSCAN" in stages, stages
+    assert "COLLSCAN" not in stages, stages
+
+@pytest.mark.asyncio
+async def test_database_is_ready(mock_db):
+    assert database.is_ready()
+    assert await database.ping()
+    # Connecting again reuses the open connection.
+    assert await database.connect() is mock_db
 
 @pytest.mark.asyncio
 async def test_create_joke(mock_db):
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
     author = User(email="test@example.com", hashed_password="hashed", name="Test User")
     await author.insert()
 
@@ -33,22 +64,51 @@ async def test_create_joke(mock_db):
     assert joke.id == joke_id
     assert joke.author == author
 
+def test_new_joke_ids_are_unique_and_time_ordered():
+    ids = [new_joke_id() for _ in range(100)] + new_joke_ids(100)
+    assert len(set(ids)) == len(ids)
+    assert ids == sorted(ids)
+    assert all(len(joke_id) == 26 for joke_id in ids)
+
+@pytest.mark.asyncio
+async def test_create_joke_retries_taken_id(mock_db):
+    first = await create_joke(joke_text="First joke with a fixed id", joke_id="test-taken-joke-id")
+    second = await create_joke(joke_text="Second joke with the same id", joke_id="test-taken-joke-id")
+
+    assert first.id == "test-taken-joke-id"
+    assert second.id != first.id
+    assert (await get_joke_by_id(second.id)).joke == "Second joke with the same id"
+
 @pytest.mark.asyncio
-async def test_get_all_jokes():
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
+async def test_get_all_jokes(mock_db):
+    assert await get_all_jokes() == []
+    joke = await create_joke(joke_text="A joke that is all there is")
     jokes = await get_all_jokes()
-    assert isinstance(jokes, list)
-    assert len(jokes) > 0 
+    assert [fetched.id for fetched in jokes] == [joke.id]
+
+@pytest.mark.asyncio
+async def test_get_jokes_page(mock_db):
+    for i in range(5):
+        # Distinct texts: near-identical ones would be rejected as duplicates.
+        await create_joke(joke_text=f"Paged joke {hashlib.sha1(f'page-{i}'.encode()).hexdigest()}", joke_id=f"test-page-joke-{i}")
+
+    seen = []
+    after = None
+    while True:
+        jokes, after = await get_jokes_page(after=after, limit=2)
+        assert len(jokes) <= 2
+        seen.extend(joke.id for joke in jokes)
+        if after is None:
+            break
+
+    assert len(seen) == len(set(seen))
+    assert {f"test-page-joke-{i}" for i in range(5)} <= set(seen)
+
+    with pytest.raises(ValueError):
+        await get_jokes_page(after="not-a-cursor")
 
 @pytest.mark.asyncio
 async def test_get_joke_by_id(mock_db):
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
     joke_text = "Why did the scarecrow win an award? Because he was outstanding in his field!"
     joke_id = "test-get-joke-id"
 
@@ -67,10 +127,6 @@ async def test_get_joke_by_id(mock_db):
 
 @pytest.mark.asyncio
 async def test_delete_joke(mock_db):
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
     joke_text = "I told my wife she was drawing her eyebrows too high. She seemed surprised."
     joke_id = "test-delete-joke-id"
 
@@ -89,12 +145,228 @@ async def test_delete_joke(mock_db):
     delete_nonexistent = await delete_joke("nonexistent-id")
     assert delete_nonexistent is False
 
+@pytest.mark.asyncio
+async def test_owned_joke_mutations(mock_db):
+    owner = User(email="owner@example.com", hashed_password="hashed", name="Owner")
+    other = User(email="other@example.com", hashed_password="hashed", name="Other")
+    await owner.insert()
+    await other.insert()
+    joke = await create_joke(joke_text="A joke only its owner may change", author=owner)
+    assert joke.author_id == owner.id
+
+    assert await update_owned_joke(joke.id, other, "Hijacked") is JokeMutation.FORBIDDEN
+    assert await update_owned_joke(joke.id, owner, "Edited by owner") is JokeMutation.DONE
+    assert (await get_joke_by_id(joke.id)).joke == "Edited by owner"
+    assert await update_owned_joke("nonexistent-id", owner, "Nothing") is JokeMutation.NOT_FOUND
+
+    assert await delete_owned_joke(joke.id, other) is JokeMutation.FORBIDDEN
+    assert await delete_owned_joke(joke.id, owner) is JokeMutation.DONE
+    assert await delete_owned_joke(joke.id, owner) is JokeMutation.NOT_FOUND
+
+@pytest.mark.asyncio
+async def test_writes_bump_revisions_and_list_version(mock_db):
+    owner = User(email="etagowner@example.com", hashed_password="hashed", name="ETag Owner")
+    await owner.insert()
+    before = await get_jokes_version()
+    joke = await create_joke(joke_text="A joke whose ETag must follow its edits", author=owner)
+    created = await get_jokes_version()
+    assert created != before
+    assert (await get_joke_by_id(joke.id)).revision == 0
+
+    await update_owned_joke(joke.id, owner, "A joke whose ETag followed an edit")
+    fetched = await get_joke_by_id(joke.id)
+    assert fetched.revision == 1
+    assert "revision" not in fetched.model_dump()
+    assert await get_jokes_version() != created
+
+    tag = make_etag("joke", fetched.id, fetched.created_at.isoformat(), fetched.revision)
+    assert etag_matches(tag, tag)
+    assert etag_matches(f'"other", W/{tag}', tag)
+    assert not etag_matches(make_etag("joke", fetched.id, fetched.created_at.isoformat(), 0), tag)
+
+@pytest.mark.asyncio
+async def test_insert_batcher_coalesces_inserts(mock_db):
+    taken = await create_joke("Insert batcher taken joke that is already stored")
+    batcher = insert_batcher.InsertBatcher(delay=0.01, max_size=10)
+    jokes = [Joke(joke=f"Insert batcher joke {n} {hashlib.sha1(str(n).encode()).hexdigest()}", id=new_joke_id()) for n in range(3)]
+    jokes.append(Joke(joke="Insert batcher joke reusing a taken id", id=taken.id))
+    before = metrics.REGISTRY.get_sample_value("joke_insert_batch_size_count") or 0
+
+    results = await asyncio.gather(*(batcher.insert(joke) for joke in jokes), return_exceptions=True)
+    await batcher.close()
+
+    assert results[:3] == [None, None, None]
+    assert isinstance(results[3], DuplicateKeyError)
+    assert metrics.REGISTRY.get_sample_value("joke_insert_batch_size_count") - before == 1
+    assert await Joke.find({"_id": {"$in": [joke.id for joke in jokes[:3]]}}).count() == 3
+
+    # create_joke goes through the batcher once it is started and keeps its retry on a taken id.
+    insert_batcher.start_batching()
+    try:
+        joke = await create_joke("Insert batcher joke asking for a taken id", joke_id=taken.id)
+    finally:
+        await insert_batcher.stop_batching()
+    assert joke.id != taken.id
+    assert (await get_joke_by_id(joke.id)).joke == "Insert batcher joke asking for a taken id"
+
+@pytest.mark.asyncio
+async def test_insert_batcher_cancelled_caller_leaves_no_unretrieved_error(mock_db):
+    taken = await create_joke("Insert batcher joke whose id a cancelled caller wants")
+    batcher = insert_batcher.InsertBatcher(delay=10, max_size=10)
+    unhandled = []
+    loop = asyncio.get_running_loop()
+    handler = loop.get_exception_handler()
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+    try:
+        caller = asyncio.create_task(batcher.insert(Joke(joke="Insert batcher joke with a taken id", id=taken.id)))
+        await asyncio.sleep(0)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await batcher.close()
+        del caller
+        gc.collect()
+    finally:
+        loop.set_exception_handler(handler)
+    assert unhandled == []
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("redis", [None, "fake"])
+async def test_joke_feed_follows_writes_and_resumes(mock_db, redis):
+    joke_feed.set_log(joke_feed.RedisFeedLog(fake_aioredis.FakeRedis()) if redis else joke_feed.MemoryFeedLog())
+    user = User(email=f"feed-{redis}@example.com", hashed_password="x", name="Feed")
+    await user.insert()
+    try:
+        theirs = await create_joke(f"Feed joke {redis} of someone else {hashlib.sha1(f'theirs-{redis}'.encode()).hexdigest()}")
+        live = await joke_feed.subscribe()
+        joke = await create_joke(f"Feed joke {redis} {hashlib.sha1(str(redis).encode()).hexdigest()}", user)
+        await update_owned_joke(joke.id, user, f"Feed joke {redis} edited {hashlib.sha1(f'edited-{redis}'.encode()).hexdigest()}")
+        await delete_owned_jokes([joke.id, theirs.id], user)
+
+        events = [await live.get(timeout=2) for _ in range(3)]
+        assert [event.type for event in events] == ["created", "updated", "deleted"]
+        assert all(json.loads(event.data)["joke_id"] == joke.id for event in events)
+        assert events[0].sse().startswith(f"id: {events[0].id}\nevent: created\ndata: ")
+
+        # A reconnect after the first event gets the other two again, and only them.
+        resumed = await joke_feed.subscribe(after=events[0].id)
+        assert [(await resumed.get(timeout=2)).id for _ in range(2)] == [event.id for event in events[1:]]
+        assert await resumed.get(timeout=0.05) is None
+
+        stale = await joke_feed.subscribe(after="1-0")
+        if redis is None:
+            assert (await stale.get(timeout=1)).type == "resync"
+        with pytest.raises(ValueError):
+            await joke_feed.subscribe(after="not-an-id")
+    finally:
+        await joke_feed.stop()
+        joke_feed.set_log(None)
+
+@pytest.mark.asyncio
+async def test_joke_feed_drops_slow_subscribers():
+    subscription = joke_feed.Subscription(buffer=2)
+    subscription.replay([])
+    for n in range(3):
+        subscription.offer(joke_feed.FeedEvent(f"1-{n}", "created", "{}"))
+    assert subscription.closed
+    assert [(await subscription.get(timeout=0.01)).type for _ in range(3)] == ["created", "created", "resync"]
+
+@pytest.mark.asyncio
+async def test_serve_drain_ends_feed_streams(tmp_path, monkeypatch):
+    joke_feed.set_log(joke_feed.MemoryFeedLog())
+    try:
+        subscription = await joke_feed.subscribe()
+        server = serve.DrainingServer(uvicorn.Config("app.main:app"))
+        server.loop = asyncio.get_running_loop()
+        server.handle_exit(signal.SIGTERM, None)
+        assert server.should_exit
+        with pytest.raises(StopAsyncIteration):
+            await subscription.get(timeout=1)
+        assert joke_feed.subscriber_count() == 0
+    finally:
+        await joke_feed.stop()
+        joke_feed.set_log(None)
+
+    # Several workers share a metrics directory, emptied of the last run's files.
+    (tmp_path / "counter_1.db").write_bytes(b"")
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    serve.prepare_metrics_dir(4)
+    assert list(tmp_path.iterdir()) == []
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR")
+    serve.prepare_metrics_dir(2)
+    assert os.path.isdir(os.environ.pop("PROMETHEUS_MULTIPROC_DIR"))
+
+@pytest.mark.asyncio
+async def test_joke_stats_follow_writes_and_reconcile(mock_db):
+    user = User(email="stats@example.com", hashed_password="x", name="Stats")
+    await user.insert()
+    before = await joke_stats.get_stats(days=1, authors=100)
+
+    mine = await create_joke(f"Stats joke {hashlib.sha1(b'stats-mine').hexdigest()}", user)
+    ingested = await create_jokes([(f"Stats joke {hashlib.sha1(f'stats-{n}'.encode()).hexdigest()}", None) for n in range(2)])
+    await delete_joke(ingested[0]["joke_id"])
+    after = await joke_stats.get_stats(days=1, authors=100)
+
+    assert after["jokes"] - before["jokes"] == 2
+    assert after["user_submitted"] - before["user_submitted"] == 1
+    assert after["ingested"] - before["ingested"] == 1
+    assert after["per_day"][0]["day"] == mine.created_at.strftime("%Y-%m-%d")
+    assert after["per_day"][0]["jokes"] - before["per_day"][0]["jokes"] == 2
+    assert {"author_id": str(user.id), "jokes": 1} in after["top_authors"]
+
+    # Writes that bypass joke_crud are picked up by the rebuild.
+    await Joke(joke=f"Stats joke {hashlib.sha1(b'stats-direct').hexdigest()}", id=new_joke_id()).insert()
+    await joke_stats.reconcile()
+    rebuilt = await joke_stats.get_stats(days=1, authors=100)
+    assert rebuilt["jokes"] == await Joke.get_motor_collection().count_documents({})
+    assert rebuilt["ingested"] == await Joke.get_motor_collection().count_documents({"author_id": None, "author": None})
+    assert {"author_id": str(user.id), "jokes": 1} in rebuilt["top_authors"]
+
+@pytest.mark.asyncio
+async def test_batch_joke_operations(mock_db):
+    owner = User(email="batchowner@example.com", hashed_password="hashed", name="Batch Owner")
+    other = User(email="batchother@example.com", hashed_password="hashed", name="Batch Other")
+    await owner.insert()
+    await other.insert()
+
+    results = await create_jokes([
+        ("First batch joke", None),
+        ("   ", None),
+        ("Batch joke with an id", "test-batch-joke-id"),
+        ("Same id again", "test-batch-joke-id"),
+    ], author=owner)
+    assert [result["status"] for result in results] == ["created", "error", "created", "error"]
+    created_ids = [result["joke_id"] for result in results if result["status"] == "created"]
+
+    fetched = await get_jokes_by_ids(created_ids + ["nonexistent-id"])
+    assert {joke.id for joke in fetched} == set(created_ids)
+
+    assert await delete_owned_jokes(created_ids, other) == 0
+    assert await delete_owned_jokes(created_ids, owner) == 2
+    assert await get_jokes_by_ids(created_ids) == []
+
+@pytest.mark.asyncio
+async def test_duplicate_jokes_are_rejected(mock_db):
+    original = await create_joke(joke_text="I only know 25 letters of the alphabet. I don't know y.")
+
+    with pytest.raises(DuplicateJokeError) as exc_info:
+        await create_joke(joke_text="I only know 25 letters of the alphabet... I DON'T know Y!")
+    assert exc_info.value.kind == "exact"
+    with pytest.raises(DuplicateJokeError) as exc_info:
+        await create_joke(joke_text="I only know 25 letters of the alphabet. I really don't know y.")
+    assert exc_info.value.kind == "near"
+    assert exc_info.value.duplicate_of == original.id
+
+    results = await create_jokes([
+        ("What do you call a fake noodle? An impasta.", None),
+        ("What do you call a fake noodle? An impasta!", None),
+        ("I only know 25 letters of the alphabet, I don't know y", None),
+    ])
+    assert [result["status"] for result in results] == ["created", "duplicate", "duplicate"]
+    assert results[2]["duplicate_of"] == original.id
+
 @pytest.mark.asyncio
 async def test_create_user(mock_db):
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
     email = "newuser@example.com"
     password = "securepassword"
     name = "New User"
@@ -107,10 +379,6 @@ async def test_create_user(mock_db):
 
 @pytest.mark.asyncio
 async def test_edit_user(mock_db):
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
     user = User(email="edituser@example.com", hashed_password="hashedpass", name="Edit User")
     await user.insert()
 
@@ -124,10 +392,6 @@ async def test_edit_user(mock_db):
 
 @pytest.mark.asyncio
 async def test_delete_user(mock_db):
-    MONGO_URI = os.getenv("TEST_MONGO_URI")
-    client = AsyncIOMotorClient(MONGO_URI)
-    database = client["test_db"]
-    await init_beanie(database=database, document_models=[User, Joke])
 
     user = User(email="deleteuser@example.com", hashed_password="hashedpass", name="Delete User")
     await user.insert()
@@ -137,3 +401,800 @@ async def test_delete_user(mock_db):
 
     delete_result = await delete_user(user.email)
     assert delete_result is True
+
+@pytest.mark.asyncio
+async def test_principal_cache_invalidated_on_edit(mock_db):
+    principal_cache.clear()
+    user = User(email="cacheduser@example.com", hashed_password="hashedpass", name="Cached User")
+    await user.insert()
+    token = create_access_token({"email": user.email, "name": user.name})
+
+    hits = principal_cache.stats["hits"]
+    assert (await get_current_user(token)).email == user.email
+    assert (await get_current_user(token)).email == user.email
+    assert principal_cache.stats["hits"] == hits + 1
+
+    await edit_user(name="Renamed User", email="renameduser@example.com", old_email=user.email)
+    assert await get_current_user(token) is None
+
+@pytest.mark.asyncio
+async def test_principal_cache_shared_through_redis(mock_db):
+    redis = fake_aioredis.FakeRedis()
+    set_redis(redis)
+    user = User(email="shareduser@example.com", hashed_password="secret-hash", name="Shared User")
+    await user.insert()
+    token = create_access_token({"email": user.email, "name": user.name})
+    try:
+        assert (await get_current_user(token)).email == user.email
+        keys = [key for key in await redis.keys("principal:*") if not key.startswith(b"principal:email:")]
+        assert b"secret-hash" not in await redis.get(keys[0])
+
+        # Local tier first; a worker that has not seen the token yet gets it from Redis.
+        hits = principal_cache.stats["hits"]
+        assert (await get_current_user(token)).email == user.email
+        assert principal_cache.stats["hits"] == hits + 1
+        principal_cache.clear_local()
+        cached = await get_current_user(token)
+        assert (cached.id, cached.email, cached.name) == (user.id, user.email, user.name)
+        assert principal_cache.stats["redis_hits"] == 1
+        assert principal_cache.cache_stats()["size"] == 1
+
+        # What invalidate() on another worker sends: this worker's copy goes too.
+        await redis.delete(*keys)
+        await redis.publish(principal_cache.PRINCIPAL_INVALIDATE_CHANNEL, user.email)
+        for _ in range(100):
+            if not principal_cache.cache_stats()["size"]:
+                break
+            await asyncio.sleep(0.01)
+        assert principal_cache.cache_stats()["size"] == 0
+        await user.delete()
+        assert await get_current_user(token) is None
+    finally:
+        await principal_cache.stop()
+
+@pytest.mark.asyncio
+async def test_hashing_pool_sheds_when_queue_full(monkeypatch):
+    hashed = await hashing.hash_password_async("securepassword")
+    assert await hashing.verify_password_async("securepassword", hashed)
+    assert not await hashing.verify_password_async("wrongpassword", hashed)
+
+    monkeypatch.setattr(hashing, "HASHING_MAX_QUEUE", 0)
+    monkeypatch.setattr(hashing, "_pending", hashing.HASHING_CONCURRENCY)
+    with pytest.raises(HTTPException) as exc_info:
+        await hashing.hash_password_async("securepassword")
+    assert exc_info.value.status_code == 503
+
+@pytest.mark.asyncio
+async def test_hashing_in_process_pool_is_timed_in_parent(monkeypatch):
+    def count(operation):
+        return metrics.REGISTRY.get_sample_value("password_hashing_duration_seconds_count", {"operation": operation}) or 0
+
+    hashing.shutdown_hashing_pool()
+    monkeypatch.setattr(hashing, "HASHING_EXECUTOR", "process")
+    monkeypatch.setattr(hashing, "HASHING_CONCURRENCY", 1)
+    before = count("hash"), count("verify")
+    try:
+        hashed = await hashing.hash_password_async("securepassword")
+        assert await hashing.verify_password_async("securepassword", hashed)
+    finally:
+        hashing.shutdown_hashing_pool()
+    assert (count("hash"), count("verify")) == (before[0] + 1, before[1] + 1)
+
+@pytest.mark.asyncio
+async def test_ingest_jokes_batch(mock_db, joke_api_stub):
+
+    async with joke_api.create_http_client() as http_client:
+        inserted = await ingest_jokes(6, http_client=http_client)
+        assert inserted == 4
+
+    stored = await Joke.find({"joke": {"$regex": "^Stub joke "}}).to_list()
+    assert len(stored) == 4
+    assert all(joke.author is None for joke in stored)
+
+@pytest.mark.asyncio
+async def test_fetch_and_ingest_reports_failures():
+    async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(503))) as http_client:
+        stats = await fetch_and_ingest(12, http_client=http_client)
+    # The first failing round stops the run.
+    assert stats == {"fetched": 0, "failed": 5, "created": 0}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("redis", [None, "fake"])
+async def test_fetch_scheduler_backs_off_and_breaks(redis, monkeypatch):
+    monkeypatch.setattr(fetch_scheduler, "FETCH_INTERVAL", 60)
+    monkeypatch.setattr(fetch_scheduler, "FETCH_MAX_INTERVAL", 600)
+    monkeypatch.setattr(fetch_scheduler, "FETCH_BREAKER_THRESHOLD", 3)
+    monkeypatch.setattr(fetch_scheduler, "FETCH_BREAKER_COOLDOWN", 900)
+    fetch_scheduler.set_store(fetch_scheduler.RedisFetchState(fake_aioredis.FakeRedis()) if redis else fetch_scheduler.MemoryFetchState())
+    calls = []
+
+    def ingest_returning(**stats):
+        async def ingest(count):
+            calls.append(count)
+            return stats
+        return ingest
+
+    try:
+        store = fetch_scheduler.get_store()
+        useful, repeated = ingest_returning(fetched=4, failed=0, created=4), ingest_returning(fetched=4, failed=0, created=1)
+        failing = ingest_returning(fetched=0, failed=1, created=0)
+
+        assert await fetch_scheduler.run_if_due(repeated, batch_size=4, now=0) == "success"
+        assert (await store.load())["interval"] == 120
+        assert await fetch_scheduler.run_if_due(useful, batch_size=4, now=60) == "skipped"
+        assert await fetch_scheduler.run_if_due(useful, batch_size=4, now=120) == "success"
+        assert (await store.load())["interval"] == 60
+
+        now = 180
+        for failures in range(1, 4):
+            assert await fetch_scheduler.run_if_due(failing, batch_size=4, now=now) == "failure"
+            state = await store.load()
+            assert state["failures"] == failures
+            now = state["next_run"]
+        # Open: the cooldown passes before a single-joke probe closes the breaker.
+        assert now - 180 >= 900
+        assert await fetch_scheduler.run_if_due(useful, batch_size=4, now=now) == "success"
+        assert calls[-1] == 1
+        assert (await store.load())["failures"] == 0
+
+        token = await store.acquire()
+        assert await fetch_scheduler.run_if_due(useful, batch_size=4, now=now + 600) == "busy"
+        await store.release(token)
+    finally:
+        fetch_scheduler.set_store(None)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("redis", [None, "fake"])
+async def test_fetch_scheduler_rechecks_schedule_under_lock(redis, monkeypatch):
+    monkeypatch.setattr(fetch_scheduler, "FETCH_INTERVAL", 60)
+    store = fetch_scheduler.RedisFetchState(fake_aioredis.FakeRedis()) if redis else fetch_scheduler.MemoryFetchState()
+    acquire = store.acquire
+    calls = []
+
+    async def ingest(count):
+        calls.append(count)
+        return {"fetched": count, "failed": 0, "created": count}
+
+    async def acquire_after_other_tick():
+        # The second tick loads, acquires, runs and releases between the first tick's load and acquire.
+        monkeypatch.setattr(store, "acquire", acquire)
+        assert await fetch_scheduler.run_if_due(ingest, now=0) == "success"
+        return await acquire()
+
+    monkeypatch.setattr(store, "acquire", acquire_after_other_tick)
+    fetch_scheduler.set_store(store)
+    try:
+        assert await fetch_scheduler.run_if_due(ingest, now=0) == "skipped"
+        assert calls == [1]
+        assert (await store.load())["next_run"] == 60
+        # The lock was released after the skip.
+        token = await store.acquire()
+        assert token is not None
+        await store.release(token)
+    finally:
+        fetch_scheduler.set_store(None)
+
+@pytest.mark.asyncio
+async def test_export_and_resumable_import(mock_db, tmp_path):
+    user = User(email="export@example.com", hashed_password="x", name="Export")
+    await user.insert()
+    created = await create_jokes([(f"Export joke {hashlib.sha1(f'export-{n}'.encode()).hexdigest()}", None) for n in range(5)], author=user)
+    ids = [result["joke_id"] for result in created]
+    path = str(tmp_path / "jokes.ndjson.gz")
+    parser = manage.build_parser()
+
+    assert await manage.export_command(parser.parse_args(["export", "jokes", path, "--batch-size", "2"])) == 0
+    with gzip.open(path, "rt") as f:
+        lines = f.read().splitlines()
+    total = await Joke.get_motor_collection().count_documents({})
+    assert len(lines) == total
+    # Exported in _id order.
+    exported_ids = [json.loads(line)["_id"] for line in lines]
+    assert exported_ids == sorted(exported_ids)
+    line_numbers = {joke_id: exported_ids.index(joke_id) + 1 for joke_id in ids}
+
+    # A checkpoint after the third new joke: only the jokes after it are written again.
+    await Joke.get_motor_collection().delete_many({"_id": {"$in": ids}})
+    with open(f"{path}.checkpoint", "w") as f:
+        f.write(str(line_numbers[ids[2]]))
+    args = ["import", "jokes", path, "--batch-size", "2", "--concurrency", "2"]
+    assert await manage.import_command(parser.parse_args(args)) == 0
+    assert {joke.id for joke in await Joke.find({"_id": {"$in": ids}}).to_list()} == set(ids[3:])
+    assert not os.path.exists(f"{path}.checkpoint")
+
+    assert await manage.import_command(parser.parse_args(args)) == 0
+    restored = await Joke.find({"_id": {"$in": ids}}).to_list()
+    assert len(restored) == 5
+    assert all(joke.author_id == user.id and joke.author.ref.id == user.id for joke in restored)
+    assert await Joke.get_motor_collection().count_documents({}) == total
+
+@pytest.mark.asyncio
+async def test_user_import_invalidates_cached_principals(mock_db, tmp_path):
+    redis = fake_aioredis.FakeRedis()
+    set_redis(redis)
+    user = User(email="imported@example.com", hashed_password="x", name="Before Import")
+    await user.insert()
+    token = create_access_token({"email": user.email})
+    try:
+        assert (await get_current_user(token)).name == "Before Import"
+        path = str(tmp_path / "users.ndjson")
+        document = {**user.model_dump(by_alias=True), "email": "renamed-by-import@example.com", "name": "After Import"}
+        with open(path, "w") as f:
+            f.write(json_util.dumps(document, json_options=manage.NDJSON_OPTIONS) + "\n")
+        assert await manage.import_command(manage.build_parser().parse_args(["import", "users", path])) == 0
+
+        assert principal_cache.cache_stats()["size"] == 0
+        assert await redis.keys("principal:*") == []
+        assert await get_current_user(token) is None
+    finally:
+        await principal_cache.stop()
+
+@pytest.mark.asyncio
+async def test_sync_indexes_creates_declared_indexes(mock_db):
+    await Joke.get_motor_collection().drop_index("created_at_id")
+    reports = await sync_indexes(dry_run=True)
+    assert "created_at_id" in reports[1]["missing"]
+
+    await sync_indexes()
+    reports = await sync_indexes(dry_run=True)
+    assert all(not report["missing"] and not report["changed"] for report in reports)
+
+    # Same name and key, different options: changed, not in sync.
+    collection = Joke.get_motor_collection()
+    await collection.drop_index("text_hash_unique")
+    await collection.create_index([("text_hash", ASCENDING)], name="text_hash_unique", unique=True)
+    reports = await sync_indexes(dry_run=True)
+    assert reports[1]["changed"] == ["text_hash_unique"]
+
+@pytest.mark.asyncio
+async def test_dedup_command_keeps_oldest_and_announces_deletions(mock_db):
+    joke_feed.set_log(joke_feed.MemoryFeedLog())
+    search.set_search_backend(search.InMemorySearch())
+    collection = Joke.get_motor_collection()
+    original = f"Dedup job joke {hashlib.sha1(b'dedup-original').hexdigest()}"
+    near = original + " indeed"
+    unique = f"Dedup job joke {hashlib.sha1(b'dedup-unique').hexdigest()}"
+    # Registered the usual way, so the live duplicate index knows it.
+    guarded = await create_joke(f"Dedup job joke {hashlib.sha1(b'dedup-guarded').hexdigest()}")
+    # The oldest copy came in through an import: no hash yet. A newer copy holds it.
+    base = datetime(2020, 1, 1)
+    await collection.insert_many([
+        {"_id": "test-dedup-1", "joke": original, "created_at": base, "author_id": None, "author": None},
+        {"_id": "test-dedup-2", "joke": original.upper(), "created_at": base.replace(day=2), "author_id": None, "author": None,
+         **dedup.fingerprint_fields(dedup.Fingerprint(original))},
+        {"_id": "test-dedup-3", "joke": near, "created_at": base.replace(day=3), "author_id": None, "author": None},
+        {"_id": "test-dedup-4", "joke": unique, "created_at": base.replace(day=4), "author_id": None, "author": None},
+    ])
+    await joke_stats.reconcile()
+    version = await get_jokes_version()
+    try:
+        live = await joke_feed.subscribe()
+        parser = manage.build_parser()
+        assert await manage.dedup_command(parser.parse_args(["dedup", "--batch-size", "2"])) == 0
+
+        remaining = {row["_id"]: row for row in await collection.find({}).to_list(length=None)}
+        assert set(remaining) == {"test-dedup-1", "test-dedup-4", guarded.id}
+        assert remaining["test-dedup-1"]["text_hash"] == dedup.Fingerprint(original).text_hash
+        events = [await live.get(timeout=1) for _ in range(2)]
+        assert sorted(json.loads(event.data)["joke_id"] for event in events if event.type == "deleted") == ["test-dedup-2", "test-dedup-3"]
+        assert await get_jokes_version() != version
+        assert (await joke_stats.get_stats(days=1, authors=100))["jokes"] == 3
+        assert "joke_lsh_dedup" not in await collection.database.list_collection_names()
+
+        # Both the kept copies and the jokes registered before the job are still guarded.
+        with pytest.raises(DuplicateJokeError):
+            await create_joke(original)
+        with pytest.raises(DuplicateJokeError):
+            await create_joke(guarded.joke)
+    finally:
+        await joke_feed.stop()
+
+@pytest.mark.asyncio
+@pytest.mark.real_mongo
+async def test_hot_queries_use_indexes(mock_db):
+    users = User.get_motor_collection()
+    jokes = Joke.get_motor_collection()
+    page_sort = [("created_at", DESCENDING), ("_id", DESCENDING)]
+    created_at, joke_id = datetime.now(), new_joke_id()
+
+    await assert_uses_index(users, {"email": "test@example.com"})
+    await assert_uses_index(jokes, {}, sort=page_sort)
+    await assert_uses_index(jokes, {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": joke_id}},
+    ]}, sort=page_sort)
+    await assert_uses_index(jokes, {"author_id": ObjectId()}, sort=[("created_at", DESCENDING)])
+
+def test_hot_query_indexes_are_declared():
+    # What test_hot_queries_use_indexes relies on, without a server: the indexes
+    # exist with these keys. Whether MongoDB picks them is for that test (CI).
+    assert declared_indexes(User)["email_unique"] == {"key": (("email", ASCENDING),), "unique": True}
+    jokes = declared_indexes(Joke)
+    assert jokes["created_at_id"] == {"key": (("created_at", DESCENDING), ("_id", DESCENDING))}
+    assert jokes["author_created_at"] == {"key": (("author_id", ASCENDING), ("created_at", DESCENDING))}
+    assert jokes["text_hash_unique"] == {"key": (("text_hash", ASCENDING),), "unique": True, "sparse": True}
+
+@pytest.mark.asyncio
+async def test_in_memory_search_follows_writes(mock_db):
+    search.set_search_backend(search.InMemorySearch())
+    try:
+        author = User(email="searcher@example.com", hashed_password="hashed", name="Searcher")
+        await author.insert()
+        first = await create_joke(joke_text="The xylophonist xylophone joke", author=author)
+        second = await create_joke(joke_text="A quiet xylophonist", author=author)
+
+        jokes, has_more = await search.search_jokes("xylophonist xylophone", limit=1)
+        assert [joke.id for joke in jokes] == [first.id]
+        assert has_more
+
+        await update_owned_joke(second.id, author, "A quiet drummer")
+        jokes, _ = await search.search_jokes("xylophonist")
+        assert [joke.id for joke in jokes] == [first.id]
+
+        await delete_owned_joke(first.id, author)
+        jokes, _ = await search.search_jokes("xylophonist")
+        assert jokes == []
+    finally:
+        search.set_search_backend(None)
+
+@pytest.mark.asyncio
+async def test_joke_pool_refills_and_falls_back(joke_api_stub, monkeypatch):
+    monkeypatch.setattr(joke_pool, "JOKE_POOL_LOW", 2)
+    monkeypatch.setattr(joke_pool, "JOKE_POOL_HIGH", 4)
+    joke_pool.set_pool(joke_pool.MemoryJokePool())
+    try:
+        assert await joke_pool.refill_once() == 4
+        assert await joke_pool.refill_once() == 0
+
+        for _ in range(4):
+            assert (await joke_pool.get_random_joke())["joke"].startswith("Stub joke")
+        assert await joke_pool.get_pool().size() == 0
+        # An empty pool still answers, straight from the upstream.
+        assert (await joke_pool.get_random_joke())["joke"].startswith("Stub joke")
+    finally:
+        await joke_pool.stop_refill()
+        joke_pool.set_pool(None)
+
+@pytest.mark.asyncio
+async def test_joke_pool_refilled_by_one_worker_at_a_time(joke_api_stub, monkeypatch):
+    monkeypatch.setattr(joke_pool, "JOKE_POOL_LOW", 2)
+    monkeypatch.setattr(joke_pool, "JOKE_POOL_HIGH", 4)
+    server = fakeredis.FakeServer()
+    workers = [joke_pool.RedisJokePool(fake_aioredis.FakeRedis(server=server)) for _ in range(3)]
+
+    async def refill(pool):
+        joke_pool.set_pool(pool)
+        return await joke_pool.refill_once()
+
+    try:
+        # Each worker sees the same empty pool; only the lock holder fetches.
+        assert sorted(await asyncio.gather(*(refill(pool) for pool in workers))) == [0, 0, 4]
+        assert await workers[0].size() == 4
+        assert await workers[1].redis.get(joke_pool.JOKE_POOL_LOCK_KEY) is None
+        assert await refill(workers[2]) == 0
+    finally:
+        await joke_pool.stop_refill()
+        joke_pool.set_pool(None)
+
+@pytest.mark.asyncio
+async def test_metrics_middleware_attributes_mongo_commands():
+    class FakeEvent:
+        command_name = "find"
+        duration_micros = 1500
+
+    listener = metrics.MongoCommandMetrics()
+
+    async def endpoint(scope, receive, send):
+        scope["route"] = APIRoute("/metrics-test/{item_id}", lambda: None)
+        # Motor runs the driver on executor threads with the caller's context copied.
+        for _ in range(3):
+            await asyncio.to_thread(listener.succeeded, FakeEvent())
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    def sample(name, **labels):
+        return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+    labels = {"method": "GET", "route": "/metrics-test/{item_id}"}
+    before = sample("http_request_mongo_commands_sum", **labels)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=metrics.MetricsMiddleware(endpoint)), base_url="http://test") as client:
+        response = await client.get("/metrics-test/1")
+
+    assert response.status_code == 204
+    assert sample("http_request_mongo_commands_sum", **labels) - before == 3
+    assert sample("http_requests_total", status="204", **labels) >= 1
+    assert metrics.current_request_stats() is None
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("redis", [None, "fake"])
+async def test_rate_limit_token_buckets(redis, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_TEST_IP", "3/60")
+    monkeypatch.setenv("RATE_LIMIT_TEST_USER", "2/60")
+    set_redis(fake_aioredis.FakeRedis() if redis else None)
+    rate_limit.reset()
+    try:
+        for _ in range(2):
+            await rate_limit.check("test", {"ip": "10.0.0.1", "user": "a@example.com"})
+        with pytest.raises(HTTPException) as exc_info:
+            await rate_limit.check("test", {"ip": "10.0.0.1", "user": "a@example.com"})
+        assert exc_info.value.status_code == 429
+        assert int(exc_info.value.headers["Retry-After"]) >= 1
+
+        # The refused request did not spend the address's last token.
+        await rate_limit.check("test", {"ip": "10.0.0.1", "user": "b@example.com"})
+        with pytest.raises(HTTPException):
+            await rate_limit.check("test", {"ip": "10.0.0.1", "user": "c@example.com"})
+    finally:
+        set_redis(None)
+        rate_limit.reset()
+
+@pytest.mark.asyncio
+async def test_rate_limit_outage_logged_once_and_token_decoded_once(api, api_user, monkeypatch, caplog):
+    monkeypatch.setenv("RATE_LIMIT_TEST_IP", "100/60")
+    server = fakeredis.FakeServer()
+    server.connected = False
+    set_redis(fake_aioredis.FakeRedis(server=server))
+    with caplog.at_level("INFO", logger="app.rate_limit"):
+        for _ in range(3):
+            await rate_limit.check("test", {"ip": "10.0.0.1"})
+        server.connected = True
+        await rate_limit.check("test", {"ip": "10.0.0.1"})
+    assert [record.getMessage().split(":")[0] for record in caplog.records] == [
+        "Rate limiter falling back to local buckets", "Rate limiter back on Redis"]
+    set_redis(None)
+
+    # The limiter and get_current_user share one decode of the token.
+    _, token = api_user
+    decoded = []
+    verify = auth_jwt.verify_access_token
+    monkeypatch.setattr(auth_jwt, "verify_access_token", lambda value: decoded.append(value) or verify(value))
+    response = await api.post("/jokes/jokes/", params={"token": token, "joke_text": route_joke("decoded-once")})
+    assert response.status_code == 201
+    assert decoded == [token]
+
+@pytest.mark.asyncio
+async def test_concurrency_limit_sheds_excess_requests():
+    release = asyncio.Event()
+
+    async def endpoint(scope, receive, send):
+        await release.wait()
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    app = rate_limit.ConcurrencyLimitMiddleware(endpoint, limit=1, queue_timeout=0.01)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        first = asyncio.create_task(client.get("/slow"))
+        await asyncio.sleep(0.05)
+        shed = await client.get("/other")
+        release.set()
+        assert (await first).status_code == 204
+
+    assert shed.status_code == 503
+    assert shed.headers["Retry-After"] == rate_limit.CONCURRENCY_RETRY_AFTER
+
+@pytest.mark.asyncio
+async def test_compression_negotiates_and_streams():
+    assert compression.choose_encoding("gzip, deflate") == "gzip"
+    assert compression.choose_encoding("gzip;q=0.5, identity") == "gzip"
+    assert compression.choose_encoding("identity, *;q=0") is None
+    assert compression.choose_encoding("*") == next(iter(compression.ENCODINGS))
+
+    lines = [json.dumps({"joke_id": n, "joke": f"Compressible joke {n}"}).encode() + b"\n" for n in range(300)]
+
+    async def endpoint(scope, receive, send):
+        headers = {"/small": [(b"content-type", b"application/json")], "/stream": [(b"content-type", b"application/x-ndjson")],
+                   "/events": [(b"content-type", b"text/event-stream")]}.get(scope["path"], [(b"content-type", b"application/json"), (b"etag", b'"v1"')])
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        if scope["path"] == "/small":
+            await send({"type": "http.response.body", "body": b'{"ok":true}'})
+        elif scope["path"] in ("/stream", "/events"):
+            for chunk in (lines[:150], lines[150:]):
+                await send({"type": "http.response.body", "body": b"".join(chunk), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        else:
+            await send({"type": "http.response.body", "body": b"".join(lines)})
+
+    async def request(path, accept_encoding="gzip"):
+        sent = []
+        async def send(message):
+            sent.append(message)
+        scope = {"type": "http", "method": "GET", "path": path, "headers": [(b"accept-encoding", accept_encoding.encode())]}
+        await compression.CompressionMiddleware(endpoint, min_size=100)(scope, None, send)
+        return dict(sent[0]["headers"]), [message["body"] for message in sent[1:]]
+
+    headers, bodies = await request("/full")
+    assert headers[b"content-encoding"] == b"gzip" and headers[b"etag"] == b'W/"v1"'
+    assert gzip.decompress(bodies[0]) == b"".join(lines)
+    assert int(headers[b"content-length"]) == len(bodies[0]) < len(b"".join(lines)) / 3
+
+    headers, bodies = await request("/small")
+    assert b"content-encoding" not in headers and bodies == [b'{"ok":true}']
+    headers, bodies = await request("/full", "identity")
+    assert b"content-encoding" not in headers
+
+    # Each streamed chunk is flushed on its own, so it decodes as soon as it arrives.
+    headers, bodies = await request("/stream")
+    assert headers[b"content-encoding"] == b"gzip" and b"content-length" not in headers
+    decoder = zlib.decompressobj(31)
+    assert decoder.decompress(bodies[0]) == b"".join(lines[:150])
+    assert decoder.decompress(b"".join(bodies[1:])) == b"".join(lines[150:])
+
+    headers, bodies = await request("/events")
+    assert b"content-encoding" not in headers and b"".join(bodies) == b"".join(lines)
+
+@pytest.mark.asyncio
+async def test_random_joke_routes_return_503_when_upstream_is_down(api, api_user):
+    # Nothing listens at JOKE_API_URL (see conftest) and the pool is empty.
+    _, token = api_user
+    response = await api.get("/jokes/random", params={"token": token})
+    assert response.status_code == 503
+    response = await api.post("/jokes/jokes/random_joke_creation/", params={"token": token})
+    assert response.status_code == 503
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, text="not json"))) as client:
+        with pytest.raises(joke_api.JokeAPIError):
+            await joke_api.fetch_joke(client)
+
+@pytest.mark.asyncio
+async def test_joke_etag_changes_when_id_is_reused(api, api_user):
+    _, token = api_user
+    response = await api.post("/jokes/jokes/", params={"token": token, "joke_text": "The first joke to live under a reused id", "joke_id": "test-reused-id"})
+    assert response.status_code == 201
+    first = await api.get("/jokes/jokes/test-reused-id", params={"token": token})
+    etag = first.headers["ETag"]
+    assert (await api.get("/jokes/jokes/test-reused-id", params={"token": token}, headers={"If-None-Match": etag})).status_code == 304
+
+    assert (await api.delete("/jokes/jokes/test-reused-id", params={"token": token})).status_code == 200
+    await asyncio.sleep(0.002)
+    response = await api.post("/jokes/jokes/", params={"token": token, "joke_text": "Something else entirely, stored under the same id", "joke_id": "test-reused-id"})
+    assert response.status_code == 201
+    second = await api.get("/jokes/jokes/test-reused-id", params={"token": token}, headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != etag
+    assert second.json()["joke"]["joke"].startswith("Something else")
+
+def route_joke(name: str) -> str:
+    # Unrelated texts, so dedup only steps in where a test repeats one on purpose.
+    return f"Route joke {hashlib.sha1(name.encode()).hexdigest()}"
+
+async def other_api_user():
+    user = User(email="api-other@example.com", hashed_password="hashed", name="Other API User")
+    await user.insert()
+    return create_access_token({"email": user.email})
+
+@pytest.mark.asyncio
+async def test_joke_routes_map_ownership_to_status_codes(api, api_user):
+    _, token = api_user
+    other = await other_api_user()
+    response = await api.post("/jokes/jokes/", params={"token": token, "joke_text": route_joke("owned"), "joke_id": "test-owned"})
+    assert response.status_code == 201 and response.json()["joke_id"] == "test-owned"
+
+    assert (await api.get("/jokes/jokes/test-owned", params={"token": "not-a-token"})).status_code == 401
+    assert (await api.put("/jokes/jokes/test-owned", params={"token": other, "new_joke_text": route_joke("theirs")})).status_code == 403
+    assert (await api.delete("/jokes/jokes/test-owned", params={"token": other})).status_code == 403
+    assert (await api.put("/jokes/jokes/test-missing", params={"token": token, "new_joke_text": route_joke("missing")})).status_code == 404
+    assert (await api.delete("/jokes/jokes/test-missing", params={"token": token})).status_code == 404
+    assert (await api.get("/jokes/jokes/test-missing", params={"token": token})).status_code == 404
+    assert (await api.post("/jokes/jokes/", params={"token": token, "joke_text": "   "})).status_code == 400
+
+    response = await api.post("/jokes/jokes/", params={"token": other, "joke_text": route_joke("owned")})
+    assert response.status_code == 409
+    response = await api.post("/jokes/jokes/", params={"token": other, "joke_text": route_joke("second")})
+    assert response.status_code == 201
+    second = response.json()["joke_id"]
+    assert (await api.put(f"/jokes/jokes/{second}", params={"token": other, "new_joke_text": route_joke("owned")})).status_code == 409
+
+    assert (await api.put("/jokes/jokes/test-owned", params={"token": token, "new_joke_text": route_joke("edited")})).status_code == 200
+    assert (await api.get("/jokes/jokes/test-owned", params={"token": token})).json()["joke"]["joke"] == route_joke("edited")
+    assert (await api.delete("/jokes/jokes/test-owned", params={"token": token})).status_code == 200
+    assert (await api.get("/jokes/jokes/test-owned", params={"token": token})).status_code == 404
+
+@pytest.mark.asyncio
+async def test_joke_routes_revalidate_with_304(api, api_user):
+    _, token = api_user
+    response = await api.post("/jokes/jokes/batch", params={"token": token}, json={"jokes": [{"joke": route_joke(f"page-{n}")} for n in range(30)]})
+    assert response.json()["created"] == 30
+
+    page = await api.get("/jokes/jokes/", params={"token": token}, headers={"Accept-Encoding": "identity"})
+    assert page.status_code == 200 and len(page.json()["jokes"]) == 30
+    etag = page.headers["ETag"]
+    assert page.headers["Cache-Control"] == "private, no-cache"
+    unchanged = await api.get("/jokes/jokes/", params={"token": token}, headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304 and unchanged.content == b""
+
+    # A compressed page carries the weak form of the tag, which still revalidates.
+    compressed = await api.get("/jokes/jokes/", params={"token": token}, headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip" and compressed.headers["ETag"] == f"W/{etag}"
+    assert (await api.get("/jokes/jokes/", params={"token": token}, headers={"If-None-Match": compressed.headers["ETag"]})).status_code == 304
+    # Other pages and page sizes have tags of their own.
+    assert (await api.get("/jokes/jokes/", params={"token": token, "limit": 10}, headers={"If-None-Match": etag})).status_code == 200
+
+    joke_id = page.json()["jokes"][0]["id"]
+    detail = await api.get(f"/jokes/jokes/{joke_id}", params={"token": token})
+    assert (await api.get(f"/jokes/jokes/{joke_id}", params={"token": token}, headers={"If-None-Match": detail.headers["ETag"]})).status_code == 304
+
+    assert (await api.put(f"/jokes/jokes/{joke_id}", params={"token": token, "new_joke_text": route_joke("page-edited")})).status_code == 200
+    assert (await api.get(f"/jokes/jokes/{joke_id}", params={"token": token}, headers={"If-None-Match": detail.headers["ETag"]})).status_code == 200
+    assert (await api.get("/jokes/jokes/", params={"token": token}, headers={"If-None-Match": etag})).status_code == 200
+
+@pytest.mark.asyncio
+async def test_joke_batch_routes(api, api_user, monkeypatch):
+    _, token = api_user
+    other = await other_api_user()
+    response = await api.post("/jokes/jokes/batch", params={"token": token}, json={"jokes": [
+        {"joke": route_joke("batch-1")},
+        {"joke": route_joke("batch-2"), "id": "test-batch-route"},
+        {"joke": route_joke("batch-3"), "id": "test-batch-route"},
+        {"joke": route_joke("batch-1")},
+    ]})
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (2, 2)
+    assert [result["status"] for result in body["results"]] == ["created", "created", "error", "duplicate"]
+    created = [result["joke_id"] for result in body["results"] if result["status"] == "created"]
+    assert (await api.post("/jokes/jokes/batch", params={"token": token}, json={"jokes": []})).status_code == 422
+
+    response = await api.get("/jokes/jokes/batch", params={"token": token, "ids": [f"{created[0]},test-batch-missing", created[1], created[0]]})
+    assert response.status_code == 200
+    assert [joke["id"] for joke in response.json()["jokes"]] == created
+    assert response.json()["missing"] == ["test-batch-missing"]
+    assert (await api.get("/jokes/jokes/batch", params={"token": token, "ids": ","})).status_code == 400
+    monkeypatch.setattr(joke_routers, "JOKE_BATCH_MAX", 2)
+    assert (await api.get("/jokes/jokes/batch", params={"token": token, "ids": "a,b,c"})).status_code == 400
+    monkeypatch.undo()
+
+    response = await api.delete("/jokes/jokes/batch", params={"token": other, "ids": created})
+    assert (response.json()["deleted"], response.json()["not_deleted"]) == (0, 2)
+    response = await api.delete("/jokes/jokes/batch", params={"token": token, "ids": created + ["test-batch-missing"]})
+    assert (response.json()["deleted"], response.json()["not_deleted"]) == (2, 1)
+    assert (await api.get("/jokes/jokes/batch", params={"token": token, "ids": created})).json()["missing"] == created
+
+@pytest.mark.asyncio
+async def test_joke_stats_and_random_routes(api, api_user, joke_api_stub):
+    user, token = api_user
+    await api.post("/jokes/jokes/", params={"token": token, "joke_text": route_joke("stats")})
+    response = await api.post("/jokes/jokes/random_joke_creation/", params={"token": token})
+    assert response.status_code == 200
+
+    stats = (await api.get("/jokes/stats", params={"token": token, "days": 1})).json()
+    assert (stats["jokes"], stats["user_submitted"], stats["ingested"]) == (2, 2, 0)
+    assert stats["top_authors"] == [{"author_id": str(user.id), "jokes": 2}]
+    assert (await api.get("/jokes/stats", params={"token": token, "days": 0})).status_code == 422
+
+    response = await api.get("/jokes/random", params={"token": token})
+    assert response.status_code == 200 and response.json()["joke"].startswith("Stub joke ")
+
+@pytest.mark.asyncio
+async def test_joke_feed_routes(api, api_user):
+    _, token = api_user
+
+    async def until(condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("timed out")
+
+    # Server-Sent Events: the stream ends when the feed closes, like on shutdown.
+    assert (await api.get("/jokes/stream", params={"token": token, "after": "not-an-id"})).status_code == 400
+    stream = asyncio.create_task(api.get("/jokes/stream", params={"token": token}))
+    await until(lambda: joke_feed.subscriber_count() == 1)
+    joke_id = (await api.post("/jokes/jokes/", params={"token": token, "joke_text": route_joke("streamed")})).json()["joke_id"]
+    joke_feed.close_subscriptions()
+    response = await stream
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text.startswith("retry: 3000\n\n")
+    assert "event: created\n" in response.text and joke_id in response.text
+
+    sent = []
+    async def socket(query: str):
+        messages = asyncio.Queue()
+        await messages.put({"type": "websocket.connect"})
+        scope = {"type": "websocket", "path": "/jokes/ws", "raw_path": b"/jokes/ws", "query_string": query.encode(), "headers": [],
+                 "scheme": "ws", "server": ("test", 80), "client": ("127.0.0.1", 1), "root_path": "", "subprotocols": []}
+        async def send(message):
+            sent.append(message)
+        return messages, asyncio.create_task(app(scope, messages.get, send))
+
+    _, refused = await socket("token=not-a-token")
+    await refused
+    assert sent.pop() == {"type": "websocket.close", "code": 1008, "reason": ""}
+
+    messages, connection = await socket(f"token={token}")
+    await until(lambda: joke_feed.subscriber_count() == 1)
+    assert sent.pop()["type"] == "websocket.accept"
+    joke_id = (await api.post("/jokes/jokes/", params={"token": token, "joke_text": route_joke("socket")})).json()["joke_id"]
+    await until(lambda: sent)
+    event = json.loads(sent.pop()["text"])
+    assert (event["type"], event["data"]["joke_id"]) == ("created", joke_id)
+    await messages.put({"type": "websocket.disconnect", "code": 1000})
+    await connection
+    assert joke_feed.subscriber_count() == 0
+
+@pytest.mark.asyncio
+async def test_edit_user_to_taken_email_conflicts(api, api_user):
+    user, token = api_user
+    await other_api_user()
+    with pytest.raises(DuplicateKeyError):
+        await edit_user(name="Renamed", email="api-other@example.com", old_email=user.email)
+    response = await api.put("/users/users/edit_user/", params={"token": token, "email": "api-other@example.com", "name": "Renamed"})
+    assert response.status_code == 409
+    assert "E11000" not in response.text
+    response = await api.put("/users/users/edit_user/", params={"token": token, "email": user.email, "name": "Renamed"})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_write_side_effects_run_concurrently(mock_db, monkeypatch):
+    running, overlap, order = set(), [], []
+
+    def tracked(name, effect):
+        async def run(*args, **kwargs):
+            running.add(name)
+            overlap.append(len(running))
+            await asyncio.sleep(0.01)
+            running.discard(name)
+            order.append(name)
+            return await effect(*args, **kwargs)
+        return run
+
+    for name in ("register", "bump_jokes_version", "publish_jokes"):
+        monkeypatch.setattr(joke_crud, name, tracked(name, getattr(joke_crud, name)))
+    monkeypatch.setattr(joke_crud.joke_stats, "record_created", tracked("record_created", joke_stats.record_created))
+    monkeypatch.setattr(joke_crud.joke_stats, "record_deleted", tracked("record_deleted", joke_stats.record_deleted))
+    user = User(email="effects@example.com", hashed_password="x", name="Effects")
+    await user.insert()
+
+    joke = await create_joke(route_joke("effects"), user)
+    assert max(overlap) == 3 and order[-1] == "publish_jokes"
+    overlap.clear()
+    order.clear()
+    assert await update_owned_joke(joke.id, user, route_joke("effects-edited")) is JokeMutation.DONE
+    assert max(overlap) == 2 and order[-1] == "publish_jokes"
+    overlap.clear()
+    order.clear()
+    assert await delete_owned_joke(joke.id, user) is JokeMutation.DONE
+    assert max(overlap) == 2 and order[-1] == "publish_jokes"
+
+@pytest.mark.asyncio
+async def test_search_route_pages_within_bounds(api, api_user):
+    _, token = api_user
+    search.set_search_backend(search.InMemorySearch())
+    await api.post("/jokes/jokes/", params={"token": token, "joke_text": "The xylophonist searched route joke"})
+    response = await api.get("/jokes/search", params={"token": token, "q": "xylophonist"})
+    assert response.status_code == 200 and len(response.json()["jokes"]) == 1
+    max_offset = joke_routers.SEARCH_MAX_OFFSET
+    assert (await api.get("/jokes/search", params={"token": token, "q": "xylophonist", "offset": max_offset})).json()["jokes"] == []
+    assert (await api.get("/jokes/search", params={"token": token, "q": "xylophonist", "offset": max_offset + 1})).status_code == 422
+
+@pytest.mark.asyncio
+async def test_joke_socket_retrieves_failed_send(api, api_user):
+    _, token = api_user
+    unhandled = []
+    loop = asyncio.get_running_loop()
+    handler = loop.get_exception_handler()
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+    messages = asyncio.Queue()
+    await messages.put({"type": "websocket.connect"})
+    scope = {"type": "websocket", "path": "/jokes/ws", "raw_path": b"/jokes/ws", "query_string": f"token={token}".encode(), "headers": [],
+             "scheme": "ws", "server": ("test", 80), "client": ("127.0.0.1", 1), "root_path": "", "subprotocols": []}
+
+    async def send(message):
+        if message["type"] == "websocket.send":
+            raise OSError("connection lost")
+
+    try:
+        connection = asyncio.create_task(app(scope, messages.get, send))
+        for _ in range(200):
+            if joke_feed.subscriber_count():
+                break
+            await asyncio.sleep(0.01)
+        await api.post("/jokes/jokes/", params={"token": token, "joke_text": route_joke("lost-socket")})
+        await asyncio.sleep(0.05)
+        await messages.put({"type": "websocket.disconnect", "code": 1006})
+        await connection
+        del connection
+        gc.collect()
+    finally:
+        loop.set_exception_handler(handler)
+    assert unhandled == []
+    assert joke_feed.subscriber_count() == 0
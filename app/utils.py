@@ -1,20 +1,60 @@
-import random, string
-from app.models.models import Joke, User
-from fastapi import HTTPException, status
-from beanie import PydanticObjectId
-
-async def create_verify_joke_id(joke_id=None):
-    characters = string.ascii_letters + string.digits
-    while not joke_id or await Joke.find_one(Joke.id == joke_id):
-        joke_id = ''.join(random.choices(characters, k=11))
-    return str(joke_id)
-
-async def verify_joke_owner(joke_id: str, current_user: User):
-    joke = await Joke.find_one({"_id": joke_id})
-    if not joke:
+import base64, hashlib, json, os, threading, time
+from datetime import datetime
+
+# Crockford base32, as used by ULID: IDs sort lexicographically by creation time.
+ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_ulid_lock = threading.Lock()
+_last_ulid = (0, 0)
+
+def _encode_ulid(value: int) -> str:
+    chars = []
+    for _ in range(26):
+        chars.append(ULID_ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+def new_joke_ids(count: int) -> list:
+    # Monotonic within a process: IDs minted in the same millisecond increment the
+    # random part instead of drawing a new one, so a reserved block stays ordered.
+    global _last_ulid
+    with _ulid_lock:
+        timestamp_ms = int(time.time() * 1000)
+        last_ms, randomness = _last_ulid
+        if timestamp_ms > last_ms:
+            randomness = int.from_bytes(os.urandom(10), "big") >> 1
+        else:
+            timestamp_ms = last_ms
+        ids = []
+        for _ in range(count):
+            randomness += 1
+            ids.append(_encode_ulid((timestamp_ms << 80) | (randomness & ((1 << 80) - 1))))
+        _last_ulid = (timestamp_ms, randomness)
+    return ids
+
+def new_joke_id() -> str:
+    return new_joke_ids(1)[0]
+
+def encode_cursor(created_at: datetime, joke_id: str) -> str:
+    raw = json.dumps([created_at.isoformat(), joke_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, joke_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), str(joke_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid pagination cursor.")
+
+def make_etag(*parts) -> str:
+    # Strong validator: the same parts always describe byte-identical bodies.
+    digest = hashlib.sha1("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so a W/ prefix from a proxy still matches.
+    if not if_none_match:
         return False
-    if hasattr(joke.author, "fetch"):
-        author = await joke.author.fetch()
-        return author.id == current_user.id
-    
-    return joke.author == current_user.id
\ No newline at end of file
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
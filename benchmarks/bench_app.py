@@ -0,0 +1,146 @@
+# Load test for app.main:app, in process, against mongomock and fakeredis.
+#
+#   python benchmarks/bench_app.py --requests 500 --concurrency 16
+#   python benchmarks/bench_app.py --scenarios list,get --output results.json --thresholds
+#
+# Each scenario sends --requests requests from --concurrency concurrent clients
+# through httpx's ASGI transport, so the numbers are the app's own overhead
+# (routing, auth, validation, Beanie, serialization) without network or a real
+# database. Compare runs on the same machine; absolute numbers move between hosts.
+import argparse, asyncio, contextlib, os, sys, time, uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "app")]
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+# mongomock has no indexes, so every LSH bucket upsert scans the whole bucket
+# collection and create/update would measure that instead of the app. The
+# fingerprint cost itself is in bench_micro.py; set DEDUP_ENABLED=true to include it.
+os.environ.setdefault("DEDUP_ENABLED", "false")
+os.environ.setdefault("AUTO_SYNC_INDEXES", "false")
+# One user sends every request, which the per-user limits would refuse after a burst.
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+import httpx
+from fakeredis import aioredis as fake_aioredis
+from mongomock_motor import AsyncMongoMockClient
+
+from app.main import app
+from app.models.models import User
+from app.crud.joke_crud import create_jokes
+from app.auth import hashing, principal_cache
+from app.redis_client import set_redis
+from app import database, joke_pool
+
+import report
+
+SCENARIOS = ("login", "list", "get", "create", "update", "delete")
+EMAIL, PASSWORD = "bench@example.com", "bench-password"
+
+def unique_text(label: str) -> str:
+    # Random enough that the duplicate check never rejects a benchmark joke.
+    return f"{label} {uuid.uuid4().hex} {uuid.uuid4().hex}"
+
+async def setup(seed: int, requests: int) -> dict:
+    await database.connect(AsyncMongoMockClient()["bench"], indexes="wait", warm=False)
+    set_redis(fake_aioredis.FakeRedis())
+    joke_pool.set_pool(joke_pool.MemoryJokePool())
+    principal_cache.clear()
+
+    user = User(email=EMAIL, hashed_password=hashing.hash_password(PASSWORD), name="Bench")
+    await user.insert()
+    seeded = await create_jokes([(unique_text("Seeded joke"), None) for _ in range(seed)], author=user)
+    # Delete needs one fresh joke per request.
+    doomed = await create_jokes([(unique_text("Doomed joke"), None) for _ in range(requests)], author=user)
+    return {
+        "user": user,
+        "joke_ids": [result["joke_id"] for result in seeded],
+        "doomed_ids": [result["joke_id"] for result in doomed],
+    }
+
+def build_requests(scenario: str, state: dict, token: str, count: int):
+    joke_ids = state["joke_ids"]
+    for n in range(count):
+        if scenario == "login":
+            yield "POST", "/users/users/login/", {"email": EMAIL, "password": PASSWORD}
+        elif scenario == "list":
+            yield "GET", "/jokes/jokes/", {"token": token, "limit": 50}
+        elif scenario == "get":
+            yield "GET", f"/jokes/jokes/{joke_ids[n % len(joke_ids)]}", {"token": token}
+        elif scenario == "create":
+            yield "POST", "/jokes/jokes/", {"token": token, "joke_text": unique_text("Created joke")}
+        elif scenario == "update":
+            yield "PUT", f"/jokes/jokes/{joke_ids[n % len(joke_ids)]}", {"token": token, "new_joke_text": unique_text("Updated joke")}
+        elif scenario == "delete":
+            yield "DELETE", f"/jokes/jokes/{state['doomed_ids'][n]}", {"token": token}
+
+async def run_scenario(client: httpx.AsyncClient, scenario: str, state: dict, token: str, count: int, concurrency: int) -> dict:
+    pending = iter(list(build_requests(scenario, state, token, count)))
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        for method, url, params in pending:
+            start = time.perf_counter()
+            response = await client.request(method, url, params=params)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return report.summarize(latencies, time.perf_counter() - start, errors)
+
+def scenario_requests(args, scenario: str) -> int:
+    # Every login is a bcrypt verify, tens to hundreds of ms of CPU each.
+    return args.login_requests if scenario == "login" else args.requests
+
+async def run(args) -> dict:
+    state = await setup(args.seed, args.requests)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.post("/users/users/login/", params={"email": EMAIL, "password": PASSWORD})
+        token = response.json()["access_token"]
+        for scenario in args.scenarios:
+            count = scenario_requests(args, scenario)
+            # A few untimed requests first so imports and caches are not billed to the run.
+            await run_scenario(client, scenario if scenario != "delete" else "get", state, token, min(args.warmup, count), 1)
+            results[scenario] = await run_scenario(client, scenario, state, token, count, args.concurrency)
+    return results
+
+def print_routes(routes: dict):
+    print(f"{'scenario':<8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, result in routes.items():
+        print(
+            f"{name:<8} {result['rps']:9.1f} {result.get('p50_ms', 0):8.2f} "
+            f"{result.get('p95_ms', 0):8.2f} {result.get('p99_ms', 0):8.2f} {result['errors']:7d}"
+        )
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario.")
+    parser.add_argument("--login-requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1000, help="Jokes stored before the run.")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS))
+    report.add_result_arguments(parser)
+    return parser
+
+async def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        print(f"unknown scenarios: {', '.join(sorted(unknown))}")
+        return 2
+    # The app prints on every login; keep the report readable.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        routes = await run(args)
+    hashing.shutdown_hashing_pool()
+    print_routes(routes)
+    return report.finish(args, {"meta": report.metadata(args), "routes": routes})
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,94 @@
+# Measures how a burst of logins affects an unrelated endpoint on the same event loop.
+#
+#   python benchmarks/bench_hashing.py --logins 200 --concurrency 32
+#
+# "sync" verifies passwords inline, the way login_endpoint used to; "async" goes
+# through the bounded hashing pool. The interesting column is the p99 of /ping.
+import argparse, asyncio, os, statistics, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import FastAPI
+
+from app.auth import hashing
+
+def build_app(hashed: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    @app.post("/login/sync")
+    async def login_sync(password: str):
+        return {"ok": hashing.verify_password(password, hashed)}
+
+    @app.post("/login/async")
+    async def login_async(password: str):
+        return {"ok": await hashing.verify_password_async(password, hashed)}
+
+    return app
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def run(mode: str, app: FastAPI, logins: int, concurrency: int, ping_interval: float):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        remaining = iter(range(logins))
+        rejected = 0
+
+        async def login_worker():
+            nonlocal rejected
+            for _ in remaining:
+                response = await client.post(f"/login/{mode}", params={"password": "secret"})
+                if response.status_code == 503:
+                    rejected += 1
+
+        async def pinger(done: asyncio.Event):
+            latencies = []
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get("/ping")
+                latencies.append((time.perf_counter() - start) * 1000)
+                await asyncio.sleep(ping_interval)
+            return latencies
+
+        done = asyncio.Event()
+        ping_task = asyncio.create_task(pinger(done))
+        start = time.perf_counter()
+        await asyncio.gather(*(login_worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        latencies = await ping_task
+
+    return {
+        "mode": mode,
+        "logins_per_sec": logins / elapsed,
+        "rejected": rejected,
+        "ping_samples": len(latencies),
+        "ping_p50_ms": statistics.median(latencies),
+        "ping_p99_ms": percentile(latencies, 99),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--ping-interval", type=float, default=0.005)
+    args = parser.parse_args()
+
+    app = build_app(hashing.hash_password("secret"))
+    for mode in ("sync", "async"):
+        result = await run(mode, app, args.logins, args.concurrency, args.ping_interval)
+        print(
+            f"{result['mode']:>5}: {result['logins_per_sec']:8.1f} logins/s  "
+            f"rejected={result['rejected']:<4} ping p50={result['ping_p50_ms']:7.2f}ms  "
+            f"p99={result['ping_p99_ms']:7.2f}ms  (n={result['ping_samples']})"
+        )
+    hashing.shutdown_hashing_pool()
+
+if __name__ == "__main__":
+    asyncio.run(main())
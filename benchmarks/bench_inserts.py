@@ -0,0 +1,91 @@
+# Joke creation throughput with one insert per call versus coalesced inserts.
+#
+#   python benchmarks/bench_inserts.py --jokes 2000 --concurrency 64
+#   python benchmarks/bench_inserts.py --mongo-uri mongodb://localhost:27017 --output inserts.json
+#
+# Runs create_joke from --concurrency concurrent callers, first inserting each
+# joke on its own and then through the insert batcher. Against mongomock this
+# measures per-insert overhead in the app and driver only; pass --mongo-uri for
+# the round trips and server-side batching that matter in production.
+import argparse, asyncio, os, sys, time, uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "app")]
+# The fingerprint lookups would dominate both modes; this compares inserts.
+os.environ.setdefault("DEDUP_ENABLED", "false")
+
+from mongomock_motor import AsyncMongoMockClient
+
+from app.crud.joke_crud import create_joke
+from app.models.models import Joke
+from app import database, insert_batcher
+
+import report
+
+MODES = ("direct", "batched")
+
+async def run_mode(mode: str, jokes: int, concurrency: int) -> dict:
+    await Joke.get_motor_collection().delete_many({})
+    if mode == "batched":
+        insert_batcher.start_batching()
+    pending = iter(range(jokes))
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        for _ in pending:
+            start = time.perf_counter()
+            try:
+                await create_joke(f"Benchmark joke {uuid.uuid4().hex}")
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await insert_batcher.stop_batching()
+    return report.summarize(latencies, time.perf_counter() - start, errors)
+
+async def run(args) -> dict:
+    if args.mongo_uri:
+        await database.connect(uri=args.mongo_uri, name=args.database, indexes="wait", warm=False)
+    else:
+        await database.connect(AsyncMongoMockClient()[args.database], indexes="wait", warm=False)
+    try:
+        return {mode: await run_mode(mode, args.jokes, args.concurrency) for mode in args.modes}
+    finally:
+        await Joke.get_motor_collection().delete_many({})
+        await database.disconnect()
+
+def print_inserts(inserts: dict):
+    print(f"{'mode':<8} {'jokes/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, result in inserts.items():
+        print(
+            f"{name:<8} {result['rps']:9.1f} {result.get('p50_ms', 0):8.2f} "
+            f"{result.get('p95_ms', 0):8.2f} {result.get('p99_ms', 0):8.2f} {result['errors']:7d}"
+        )
+    if "direct" in inserts and "batched" in inserts and inserts["direct"]["rps"]:
+        print(f"batched/direct throughput: {inserts['batched']['rps'] / inserts['direct']['rps']:.2f}x")
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jokes", type=int, default=2000, help="Jokes created per mode.")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--modes", type=lambda value: value.split(","), default=list(MODES))
+    parser.add_argument("--mongo-uri", default=None, help="Run against a real MongoDB instead of mongomock.")
+    parser.add_argument("--database", default="bench_inserts")
+    report.add_result_arguments(parser)
+    return parser
+
+async def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        print(f"unknown modes: {', '.join(sorted(unknown))}")
+        return 2
+    inserts = await run(args)
+    print_inserts(inserts)
+    return report.finish(args, {"meta": report.metadata(args), "inserts": inserts})
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,92 @@
+# Micro-benchmarks for the per-request building blocks: password hashing, JWTs,
+# duplicate fingerprints and response serialization.
+#
+#   python benchmarks/bench_micro.py --output micro.json --thresholds
+import argparse, contextlib, os, sys, time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "app")]
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+
+from bson import ObjectId
+from fastapi.responses import ORJSONResponse
+
+from app.auth import hashing
+from app.auth.auth_jwt import create_access_token, verify_access_token
+from app.dedup import Fingerprint
+from app.models.schemas import JokeOut, JokeListOut
+from app.utils import new_joke_ids
+
+import report
+
+def measure(fn, iterations: int, min_seconds: float) -> dict:
+    # Repeats fn in rounds of `iterations` until min_seconds have passed.
+    fn()
+    calls, start = 0, time.perf_counter()
+    while True:
+        for _ in range(iterations):
+            fn()
+        calls += iterations
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+    return {"calls": calls, "mean_us": elapsed / calls * 1e6, "ops_per_sec": calls / elapsed}
+
+def joke_page(count: int) -> list:
+    author, start = ObjectId(), datetime.now()
+    return [
+        JokeOut(id=joke_id, joke=f"Benchmark joke number {index} walks into a bar.", created_at=start - timedelta(seconds=index), author_id=author)
+        for index, joke_id in enumerate(new_joke_ids(count))
+    ]
+
+def cases(page_size: int) -> dict:
+    hashed = hashing.hash_password("bench-password")
+    token = create_access_token({"email": "bench@example.com", "name": "Bench"})
+    page = joke_page(page_size)
+    rows = [joke.model_dump(by_alias=True) for joke in page]
+    text = "I only know 25 letters of the alphabet. I don't know y."
+    # (callable, calls per round): bcrypt is slow enough to time a few at a time.
+    return {
+        "bcrypt_hash": (lambda: hashing.hash_password("bench-password"), 2),
+        "bcrypt_verify": (lambda: hashing.verify_password("bench-password", hashed), 2),
+        "jwt_encode": (lambda: create_access_token({"email": "bench@example.com", "name": "Bench"}), 200),
+        "jwt_decode": (lambda: verify_access_token(token), 200),
+        "dedup_fingerprint": (lambda: Fingerprint(text), 200),
+        "joke_page_validate": (lambda: [JokeOut.model_validate(row) for row in rows], 10),
+        "joke_page_render": (lambda: ORJSONResponse(content=JokeListOut(jokes=page).model_dump(mode="json")).body, 10),
+    }
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="Minimum timed duration per case.")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--cases", type=lambda value: value.split(","), default=None)
+    report.add_result_arguments(parser)
+    return parser
+
+def run(args) -> dict:
+    results = {}
+    for name, (fn, iterations) in cases(args.page_size).items():
+        if args.cases and name not in args.cases:
+            continue
+        results[name] = measure(fn, iterations, args.min_seconds)
+    return results
+
+def print_micro(micro: dict):
+    print(f"{'case':<20} {'mean us':>12} {'ops/s':>12}")
+    for name, result in micro.items():
+        print(f"{name:<20} {result['mean_us']:12.1f} {result['ops_per_sec']:12.1f}")
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    # create_access_token prints on every call.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        micro = run(args)
+    print_micro(micro)
+    return report.finish(args, {"meta": report.metadata(args), "micro": micro})
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+# Serialization cost of a joke list response, per 10k jokes.
+#
+#   python benchmarks/bench_serialization.py --jokes 10000 --repeat 5
+#
+# "before" parses full Joke documents (Link author included) and renders them the
+# way FastAPI did without a response model: jsonable_encoder + JSONResponse.
+# "after" parses the projected JokeOut rows and renders JokeListOut with orjson.
+import argparse, asyncio, os, statistics, sys, time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from beanie import init_beanie
+from bson import DBRef, ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from mongomock_motor import AsyncMongoMockClient
+
+from app.models.models import User, Joke
+from app.models.schemas import JokeOut, JokeListOut
+from app.utils import new_joke_ids
+
+def raw_jokes(count: int) -> list:
+    authors = [ObjectId() for _ in range(50)]
+    start = datetime.now()
+    return [
+        {
+            "_id": joke_id,
+            "joke": f"Why did benchmark joke number {index} cross the road? To get to the other page.",
+            "created_at": start - timedelta(seconds=index),
+            "author": DBRef("users", authors[index % len(authors)]),
+            "author_id": authors[index % len(authors)],
+        }
+        for index, joke_id in enumerate(new_joke_ids(count))
+    ]
+
+def render_before(rows: list) -> bytes:
+    jokes = [Joke.model_validate(row) for row in rows]
+    return JSONResponse(content=jsonable_encoder({"status": "success", "jokes": jokes})).body
+
+def render_after(rows: list) -> bytes:
+    projection = JokeOut.Settings.projection
+    jokes = [JokeOut.model_validate({key: row[key] for key in projection if key in row}) for row in rows]
+    return ORJSONResponse(content=JokeListOut(jokes=jokes).model_dump(mode="json")).body
+
+def timed(fn, rows, repeat: int):
+    samples, body = [], b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn(rows)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), len(body)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jokes", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    await init_beanie(database=AsyncMongoMockClient()["bench"], document_models=[User, Joke])
+    rows = raw_jokes(args.jokes)
+    per_10k = 10000 / args.jokes
+
+    results = {}
+    for name, fn in (("before", render_before), ("after", render_after)):
+        seconds, size = timed(fn, rows, args.repeat)
+        results[name] = seconds
+        print(f"{name:>6}: {seconds * per_10k * 1000:8.1f} ms per 10k jokes, {size / 1024:8.1f} KiB body")
+    print(f"speedup: {results['before'] / results['after']:.1f}x")
+
+if __name__ == "__main__":
+    asyncio.run(main())
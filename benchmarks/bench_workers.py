@@ -0,0 +1,166 @@
+# Throughput of `python -m app.serve` as the worker count grows.
+#
+#   python benchmarks/bench_workers.py --workers 1,2,4,8 --seconds 10
+#   python benchmarks/bench_workers.py --scenario health --output workers.json
+#   python benchmarks/bench_workers.py --mongo-uri mongodb://localhost:27017
+#
+# For each worker count a real server is started on --port, loaded for
+# --seconds by --clients load processes holding --connections keep-alive
+# connections between them, then stopped with SIGTERM. Without --mongo-uri the
+# workers each serve their own mongomock database (see mock_server.py), which
+# keeps the work CPU-bound in the workers. The load processes compete with the
+# workers for cores: on a single machine, leave cores free for them (e.g.
+# --workers 1,2,4 on 8 cores) or the curve flattens because of the client.
+import argparse, asyncio, multiprocessing, os, signal, subprocess, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "app")]
+
+import httpx
+
+import report
+
+SCENARIOS = ("health", "list")
+
+def default_worker_counts() -> list:
+    cores = os.cpu_count() or 1
+    return sorted({1, 2, 4, cores})
+
+def scenario_request(scenario: str, token: str):
+    if scenario == "health":
+        return "/healthz", {}
+    return "/jokes/jokes/", {"token": token, "limit": 50}
+
+async def load(url: str, params: dict, connections: int, seconds: float) -> tuple:
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + seconds
+
+        async def connection():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url, params=params)
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(connection() for _ in range(connections)))
+        return latencies, errors, time.perf_counter() - start
+
+def load_process(job: tuple) -> tuple:
+    return asyncio.run(load(*job))
+
+def start_server(args, workers: int) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, "app"), BENCH_DIR]), ACCESS_LOG="false")
+    command = [sys.executable, "-m", "app.serve", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(args.port)]
+    if not args.mongo_uri:
+        command += ["--app", "mock_server:app"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None)
+
+def wait_until_ready(base_url: str, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}; rerun with --verbose")
+        try:
+            if httpx.get(f"{base_url}/readyz", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+def stop_server(server: subprocess.Popen):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+def run_level(args, workers: int, token: str, pool) -> dict:
+    base_url = f"http://127.0.0.1:{args.port}"
+    path, params = scenario_request(args.scenario, token)
+    per_client = max(1, args.connections // args.clients)
+    server = start_server(args, workers)
+    try:
+        wait_until_ready(base_url, server)
+        # Untimed, so every worker has imported, connected and warmed its caches.
+        pool.map(load_process, [(base_url + path, params, per_client, args.warmup)] * args.clients)
+        runs = pool.map(load_process, [(base_url + path, params, per_client, args.seconds)] * args.clients)
+    finally:
+        stop_server(server)
+    latencies = [latency for run_latencies, _, _ in runs for latency in run_latencies]
+    errors = sum(run_errors for _, run_errors, _ in runs)
+    return report.summarize(latencies, max(elapsed for _, _, elapsed in runs), errors)
+
+async def seed_database(args):
+    from mock_server import seed
+    from app import database
+    await database.connect(uri=args.mongo_uri, name=args.database, indexes="wait", warm=False)
+    try:
+        await seed()
+    finally:
+        await database.disconnect()
+
+def run(args) -> dict:
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        os.environ["MONGO_DB_NAME"] = args.database
+        asyncio.run(seed_database(args))
+    from mock_server import EMAIL
+    from app.auth.auth_jwt import create_access_token
+    token = create_access_token({"email": EMAIL})
+
+    results = {}
+    with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+        for workers in args.workers:
+            results[str(workers)] = run_level(args, workers, token, pool)
+            print(f"{workers} worker(s): {results[str(workers)]['rps']:.1f} req/s", file=sys.stderr)
+    return results
+
+def print_workers(levels: dict):
+    single = levels.get("1", {}).get("rps")
+    print(f"{'workers':>7} {'req/s':>9} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for workers, result in levels.items():
+        speedup = f"{result['rps'] / single:7.2f}x" if single else f"{'-':>8}"
+        print(
+            f"{workers:>7} {result['rps']:9.1f} {speedup} {result.get('p50_ms', 0):8.2f} "
+            f"{result.get('p95_ms', 0):8.2f} {result.get('p99_ms', 0):8.2f} {result['errors']:7d}"
+        )
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=lambda value: [int(count) for count in value.split(",")], default=default_worker_counts(),
+                        help="Worker counts to measure (default 1,2,4 and the number of cores).")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="list")
+    parser.add_argument("--seconds", type=float, default=5, help="Measured load per worker count.")
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--connections", type=int, default=64, help="Keep-alive connections across all load processes.")
+    parser.add_argument("--clients", type=int, default=os.cpu_count() or 1, help="Load generator processes.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mongo-uri", default=None, help="Serve app.main:app against this MongoDB instead of mongomock.")
+    parser.add_argument("--database", default="bench_workers")
+    parser.add_argument("--verbose", action="store_true", help="Show the server's log.")
+    report.add_result_arguments(parser)
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    levels = run(args)
+    print_workers(levels)
+    return report.finish(args, {"meta": report.metadata(args), "workers": levels})
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# app.main:app backed by mongomock and in-process fallbacks instead of MongoDB
+# and Redis, for benchmarks that start real server processes:
+#
+#   python -m app.serve --app mock_server:app --workers 4   (with benchmarks/ on PYTHONPATH)
+#
+# Every worker process gets its own in-memory database, seeded with the same
+# user and jokes, so a token minted with SECRET_KEY works against any worker.
+import os, sys, uuid
+from contextlib import asynccontextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "app")]
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+os.environ.setdefault("DEDUP_ENABLED", "false")
+os.environ.setdefault("AUTO_SYNC_INDEXES", "false")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+from mongomock_motor import AsyncMongoMockClient
+
+from app.main import app
+from app.models.models import User
+from app.crud.joke_crud import create_jokes
+from app import database
+
+EMAIL = "bench@example.com"
+SEED_JOKES = int(os.getenv("BENCH_SEED_JOKES", "1000"))
+
+async def seed(jokes: int = SEED_JOKES) -> User:
+    user = await User.find_one({"email": EMAIL})
+    if user is None:
+        # Never logged into: the benchmark mints its tokens, so no bcrypt hash is needed.
+        user = User(email=EMAIL, hashed_password="-", name="Bench")
+        await user.insert()
+        await create_jokes([(f"Seeded joke {uuid.uuid4().hex} {uuid.uuid4().hex}", None) for _ in range(jokes)], author=user)
+    return user
+
+app_lifespan = app.router.lifespan_context
+
+@asynccontextmanager
+async def lifespan(app):
+    # Connected first, so the app's own lifespan finds the database in place.
+    await database.connect(AsyncMongoMockClient()["bench"], indexes="wait", warm=False)
+    await seed()
+    async with app_lifespan(app):
+        yield
+
+app.router.lifespan_context = lifespan
@@ -0,0 +1,102 @@
+# Shared by the benchmark scripts: latency summaries, JSON results and the
+# regression check against thresholds.json or an earlier results file.
+import json, os, platform, statistics, sys, time
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+
+# Metrics where a larger number is better; every other metric is a time.
+HIGHER_IS_BETTER = {"rps", "ops_per_sec"}
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def summarize(latencies_ms: list, elapsed: float, errors: int = 0) -> dict:
+    if not latencies_ms:
+        return {"requests": 0, "errors": errors, "rps": 0.0}
+    return {
+        "requests": len(latencies_ms),
+        "errors": errors,
+        "rps": len(latencies_ms) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies_ms, 50),
+        "p95_ms": percentile(latencies_ms, 95),
+        "p99_ms": percentile(latencies_ms, 99),
+        "max_ms": max(latencies_ms),
+        "mean_ms": statistics.fmean(latencies_ms),
+    }
+
+def metadata(args) -> dict:
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }
+
+def write_results(path: str, results: dict):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def load_json(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+def check_thresholds(results: dict, thresholds: dict) -> list:
+    # thresholds mirror the results layout: {"routes": {"list": {"p99_ms": 250}}}.
+    # Times are upper bounds, throughputs lower bounds. Sections or entries that
+    # were not run are skipped rather than failed.
+    failures = []
+    for section, entries in thresholds.items():
+        for name, limits in entries.items():
+            measured = results.get(section, {}).get(name)
+            if measured is None:
+                continue
+            for metric, limit in limits.items():
+                value = measured.get(metric)
+                if value is None:
+                    continue
+                if metric in HIGHER_IS_BETTER and value < limit:
+                    failures.append(f"{section}.{name}.{metric} = {value:.2f}, expected >= {limit}")
+                elif metric not in HIGHER_IS_BETTER and value > limit:
+                    failures.append(f"{section}.{name}.{metric} = {value:.2f}, expected <= {limit}")
+    return failures
+
+def compare_baseline(results: dict, baseline: dict, tolerance: float, metrics=("p95_ms", "rps", "mean_us", "ops_per_sec")) -> list:
+    # Relative check against an earlier run on the same machine.
+    failures = []
+    for section in ("routes", "micro"):
+        for name, measured in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name, {})
+            for metric in metrics:
+                if metric not in measured or not previous.get(metric):
+                    continue
+                change = measured[metric] / previous[metric] - 1
+                worse = -change if metric in HIGHER_IS_BETTER else change
+                if worse > tolerance:
+                    failures.append(
+                        f"{section}.{name}.{metric} = {measured[metric]:.2f}, "
+                        f"{worse:.0%} worse than baseline {previous[metric]:.2f}"
+                    )
+    return failures
+
+def finish(args, results: dict) -> int:
+    # Writes results and runs the regression checks the flags ask for; returns the exit code.
+    if args.output:
+        write_results(args.output, results)
+        print(f"results written to {args.output}")
+    failures = []
+    if args.thresholds:
+        failures += check_thresholds(results, load_json(args.thresholds))
+    if args.baseline:
+        failures += compare_baseline(results, load_json(args.baseline), args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+def add_result_arguments(parser):
+    parser.add_argument("--output", help="Write results as JSON to this path.")
+    parser.add_argument("--thresholds", nargs="?", const=THRESHOLDS_PATH, help="Fail on limits from this file (default benchmarks/thresholds.json).")
+    parser.add_argument("--baseline", help="Fail when worse than this earlier results file by more than --tolerance.")
+    parser.add_argument("--tolerance", type=float, default=0.25)
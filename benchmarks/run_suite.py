@@ -0,0 +1,35 @@
+# Runs the load test and the micro-benchmarks and checks both against the same
+# thresholds, e.g. before a deploy:
+#
+#   python benchmarks/run_suite.py --output results.json --thresholds
+#   python benchmarks/run_suite.py --baseline results.json --tolerance 0.2
+import argparse, asyncio, contextlib, os, sys
+
+import bench_app, bench_micro, report
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--login-requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--min-seconds", type=float, default=0.5)
+    report.add_result_arguments(parser)
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    app_args = bench_app.build_parser().parse_args([
+        "--requests", str(args.requests), "--login-requests", str(args.login_requests), "--concurrency", str(args.concurrency),
+    ])
+    micro_args = bench_micro.build_parser().parse_args(["--min-seconds", str(args.min_seconds)])
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        routes = asyncio.run(bench_app.run(app_args))
+        micro = bench_micro.run(micro_args)
+    bench_app.hashing.shutdown_hashing_pool()
+    bench_app.print_routes(routes)
+    print()
+    bench_micro.print_micro(micro)
+    return report.finish(args, {"meta": report.metadata(args), "routes": routes, "micro": micro})
+
+if __name__ == "__main__":
+    sys.exit(main())